@@ -59,8 +59,57 @@ CREATE TABLE IF NOT EXISTS actuators (
 CREATE INDEX idx_actuators_device ON actuators(device_name);
 
 -- ================================
---  TABLA: alerts
+--  TABLA: sensor_readings (histórico bruto)
 -- ================================
+-- Sin FK: inserción en lote barata y retención independiente del inventario.
+-- La PK (device, sensor, ts) sirve los rangos de system/select 'history'.
+CREATE TABLE IF NOT EXISTS sensor_readings (
+  device_name VARCHAR(64) NOT NULL,
+  sensor_id INT NOT NULL,
+  ts DATETIME(3) NOT NULL,
+  value FLOAT NOT NULL,
+
+  PRIMARY KEY (device_name, sensor_id, ts),
+  KEY idx_readings_ts (ts)
+);
+
+-- ================================
+--  TABLAS: sensor_readings_1m / sensor_readings_1h (agregados)
+-- ================================
+CREATE TABLE IF NOT EXISTS sensor_readings_1m (
+  device_name VARCHAR(64) NOT NULL,
+  sensor_id INT NOT NULL,
+  bucket DATETIME NOT NULL,
+
+  min_value FLOAT NOT NULL,
+  max_value FLOAT NOT NULL,
+  avg_value FLOAT NOT NULL,
+  samples INT NOT NULL,
+
+  PRIMARY KEY (device_name, sensor_id, bucket),
+  KEY idx_readings_1m_bucket (bucket)
+);
+
+CREATE TABLE IF NOT EXISTS sensor_readings_1h (
+  device_name VARCHAR(64) NOT NULL,
+  sensor_id INT NOT NULL,
+  bucket DATETIME NOT NULL,
+
+  min_value FLOAT NOT NULL,
+  max_value FLOAT NOT NULL,
+  avg_value FLOAT NOT NULL,
+  samples INT NOT NULL,
+
+  PRIMARY KEY (device_name, sensor_id, bucket),
+  KEY idx_readings_1h_bucket (bucket)
+);
+
+-- ================================
+--  TABLA: alerts (histórico, solo inserción)
+-- ================================
+-- Cada alerta recibida es una fila nueva. severity_rank ordena la gravedad
+-- numéricamente (low=1, medium=2, high=3, critical=4). La retención la
+-- aplica el router (ALERT_RETENTION_D / ALERT_MAX_ROWS).
 CREATE TABLE IF NOT EXISTS alerts (
   id INT AUTO_INCREMENT PRIMARY KEY,
 
@@ -73,35 +122,44 @@ CREATE TABLE IF NOT EXISTS alerts (
   status VARCHAR(128),
   message TEXT,
   severity VARCHAR(16) DEFAULT 'medium',
+  severity_rank TINYINT NOT NULL DEFAULT 2,
   code INT,
   timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
 
-  UNIQUE KEY uniq_alert_component (
-    device_name,
-    component_type,
-    component_id
-  ),
-
   FOREIGN KEY (device_name)
     REFERENCES devices(device_name)
     ON DELETE CASCADE
 );
 
+-- Paginación por clave (timestamp, id): InnoDB añade la PK al final de
+-- cada índice secundario, así que ambos cubren el orden completo.
 CREATE INDEX idx_alerts_severity
-  ON alerts(severity, timestamp);
+  ON alerts(severity_rank, timestamp);
 
 CREATE INDEX idx_alerts_device
-  ON alerts(device_name);
+  ON alerts(device_name, timestamp);
+
+CREATE INDEX idx_alerts_timestamp
+  ON alerts(timestamp);
 
 -- ================================
 --  TABLA: system_logs (opcional)
 -- ================================
+-- Particionada por día: la retención del router borra particiones
+-- completas (DROP PARTITION) en lugar de recorrer la tabla con DELETE.
+-- El router crea las particiones diarias (pYYYYMMDD) por adelantado
+-- dividiendo p_future; la PK incluye 'timestamp' como exige MariaDB.
 CREATE TABLE IF NOT EXISTS system_logs (
-  id INT AUTO_INCREMENT PRIMARY KEY,
+  id BIGINT AUTO_INCREMENT,
   timestamp DATETIME NOT NULL,
   topic VARCHAR(255),
   event_type VARCHAR(50),
-  payload JSON
+  payload JSON,
+
+  PRIMARY KEY (id, timestamp)
+)
+PARTITION BY RANGE (TO_DAYS(timestamp)) (
+  PARTITION p_future VALUES LESS THAN MAXVALUE
 );
 
 CREATE INDEX idx_logs_event ON system_logs(event_type);
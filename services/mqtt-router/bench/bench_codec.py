@@ -0,0 +1,134 @@
+"""
+Micro-benchmark del codec JSON del router.
+
+Compara, por mensaje, el coste de decodificar payloads entrantes y de
+codificar las respuestas con cada backend disponible frente a la ruta
+anterior (json.loads + safe_json_dumps con closure y strftime). La tabla
+MENSAJE TIPADO mide lo que hace el listener: payload -> estructura de
+core/messages.py, en dos pasadas (dict + from_payload) o en una
+(decode_as, decoder tipado de msgspec).
+
+Uso (desde services/mqtt-router, idealmente en la propia Raspberry Pi):
+
+    python3 bench/bench_codec.py
+    python3 bench/bench_codec.py --number 50000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from core.codec import available_backends, decode_as, make_codec  # noqa: E402
+from core.messages import (  # noqa: E402
+    AnnounceMsg, UpdateMsg, AlertMsg, SetRequest, GetRequest, SelectRequest
+)
+
+
+# ==========================================================
+#  MENSAJES REPRESENTATIVOS
+# ==========================================================
+INBOUND = {
+    "update": b'{"value": 22.5, "unit": "\xc2\xb0C"}',
+    "announce": b'{"name": "LuzPrincipal", "location": "salon", "state": "OFF"}',
+    "alert": b'{"status": "ALERT", "message": "Temperatura fuera de rango", "severity": "high", "code": 12}',
+    "set": b'{"device": "esp32_salon", "type": "actuator", "id": 0, "command": "OPEN", "speed": 80}',
+    "get": b'{"device": "esp32_cocina", "type": "sensor", "id": 1}',
+    "select": b'{"request": "sensors", "device": "esp32_cocina"}',
+}
+
+# Clase de mensaje de cada payload entrante (como en la tabla de rutas)
+MESSAGES = {
+    "update": UpdateMsg,
+    "announce": AnnounceMsg,
+    "alert": AlertMsg,
+    "set": SetRequest,
+    "get": GetRequest,
+    "select": SelectRequest,
+}
+
+OUTBOUND = {
+    "notify_update": {
+        "device": "esp32_cocina", "type": "sensor", "id": 1,
+        "timestamp": "2025-01-01 12:00:00", "value": 22.5, "units": "°C",
+        "source": "mqtt-router",
+    },
+    "select_row": {
+        "id": 1, "device_name": "esp32_cocina", "name": "Temperatura",
+        "location": "cocina", "enabled": 1, "value": 22.5, "unit": "°C",
+        "last_seen": datetime(2025, 1, 1, 12, 0, 0),
+    },
+}
+
+
+def _legacy_safe_json_dumps(obj):
+    """Implementación previa de handlers.utils.safe_json_dumps."""
+    def default(o):
+        if isinstance(o, datetime):
+            return o.strftime("%Y-%m-%d %H:%M:%S")
+        raise TypeError(f"Type {type(o)} not serializable")
+
+    return json.dumps(obj, default=default)
+
+
+def _bench(fn, number):
+    best = min(timeit.repeat(fn, number=number, repeat=5))
+    return best / number * 1e6  # µs por llamada
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    backends = available_backends()
+    codecs = {name: make_codec(name) for name in backends}
+
+    print(f"Backends disponibles: {', '.join(backends)}")
+    print(f"Iteraciones: {args.number} x 5 (se toma la mejor)\n")
+
+    header = f"{'mensaje':<16}{'anterior':>10}" + "".join(f"{b:>10}" for b in backends)
+
+    # === Decodificación ===
+    print("DECODE (µs/mensaje)")
+    print(header)
+    for name, raw in INBOUND.items():
+        base = _bench(lambda: json.loads(raw.decode("utf-8")), args.number)
+        row = f"{name:<16}{base:>10.2f}"
+        for b in backends:
+            c = codecs[b]
+            row += f"{_bench(lambda: c.decode(raw), args.number):>10.2f}"
+        print(row)
+
+    # === Decodificación a mensaje tipado ===
+    print("\nMENSAJE TIPADO (µs/mensaje: dict + from_payload por backend, decode_as)")
+    print(header + f"{'tipado':>10}")
+    for name, raw in INBOUND.items():
+        msg_type = MESSAGES[name]
+        base = _bench(
+            lambda: msg_type.from_payload(json.loads(raw.decode("utf-8"))), args.number
+        )
+        row = f"{name:<16}{base:>10.2f}"
+        for b in backends:
+            c = codecs[b]
+            row += f"{_bench(lambda: msg_type.from_payload(c.decode(raw)), args.number):>10.2f}"
+        row += f"{_bench(lambda: decode_as(raw, msg_type), args.number):>10.2f}"
+        print(row)
+
+    # === Codificación ===
+    print("\nENCODE (µs/mensaje)")
+    print(header)
+    for name, obj in OUTBOUND.items():
+        base = _bench(lambda: _legacy_safe_json_dumps(obj).encode("utf-8"), args.number)
+        row = f"{name:<16}{base:>10.2f}"
+        for b in backends:
+            c = codecs[b]
+            row += f"{_bench(lambda: c.encode(obj), args.number):>10.2f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
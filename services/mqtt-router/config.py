@@ -23,6 +23,9 @@ MQTT_CFG = {
 
         # --- Notificaciones internas del sistema ---
         ("system/notify/#", 0),
+
+        # --- Diagnóstico del propio router ---
+        ("system/diag/mqtt-router", 0),
     ]
 }
 
@@ -34,6 +37,172 @@ DB_CFG = {
     "database": os.getenv("DB_NAME", "devices_db"),
 }
 
+# Hilos en segundo plano que usan la BBDD además de los workers: volcados de
+# telemetría, last_seen, lecturas y system_logs, rollups, retención y
+# resúmenes de alertas
+DB_BACKGROUND_USERS = 7
+
+# Pool de conexiones (una por worker del dispatcher + una por hilo en segundo
+# plano + margen): los handlers no deben esperar a que termine un volcado
+DB_POOL_CFG = {
+    "size": int(os.getenv(
+        "DB_POOL_SIZE", int(os.getenv("ROUTER_WORKERS", 4)) + DB_BACKGROUND_USERS + 1
+    )),
+    # Segundos máximos de espera por una conexión libre
+    "timeout_s": float(os.getenv("DB_POOL_TIMEOUT_S", 5)),
+    # Conexiones libres más antiguas que esto se cierran
+    "max_idle_s": float(os.getenv("DB_POOL_MAX_IDLE_S", 300)),
+    # Una conexión libre se valida con ping si no se usó en este intervalo
+    "health_check_s": float(os.getenv("DB_POOL_HEALTHCHECK_S", 30)),
+}
+
+# Buffer write-behind de telemetría (update/<device>/sensor/<id>)
+TELEMETRY_CFG = {
+    # Intervalo de volcado a BBDD (solo se guarda el último valor por sensor)
+    "flush_ms": int(os.getenv("TELEMETRY_FLUSH_MS", 1000)),
+    # Filas máximas por INSERT multi-fila
+    "max_rows": int(os.getenv("TELEMETRY_MAX_ROWS", 500)),
+}
+
+# Heartbeats de dispositivos (devices.last_seen) persistidos en lote
+HEARTBEAT_CFG = {
+    "interval_s": float(os.getenv("HEARTBEAT_INTERVAL_S", 30)),
+}
+
+# Registro en memoria (core/registry.py): segundos que se recuerda que un
+# dispositivo/componente no existe en BBDD antes de volver a consultarlo
+REGISTRY_CFG = {
+    "miss_ttl_s": float(os.getenv("REGISTRY_MISS_TTL_S", 5)),
+}
+
+# === DESPACHO DE MENSAJES (pool de workers por dispositivo) ===
+DISPATCH_CFG = {
+    # Nº de workers; cada dispositivo se asigna siempre al mismo worker
+    "workers": int(os.getenv("ROUTER_WORKERS", 4)),
+    # Máx. mensajes pendientes por worker antes de descartar
+    "queue_size": int(os.getenv("ROUTER_QUEUE_SIZE", 1000)),
+    # Mensajes pendientes en un worker a partir de los cuales la telemetría
+    # en cola se reduce al último valor por sensor
+    "coalesce_depth": int(os.getenv("ROUTER_COALESCE_DEPTH", 100)),
+}
+
+# === RESPUESTAS system/select POR LOTES ===
+SELECT_CFG = {
+    # Tamaño de página con {"batch": true} (sin page_size explícito)
+    "page_size": int(os.getenv("SELECT_PAGE_SIZE", 50)),
+    # Límite superior para page_size pedido por el cliente
+    "max_page_size": int(os.getenv("SELECT_MAX_PAGE_SIZE", 500)),
+}
+
+# === PETICIONES GET/SET EN VUELO ===
+INFLIGHT_CFG = {
+    # Segundos sin respuesta del ESP32 antes de responder timeout al requester
+    "timeout_s": float(os.getenv("INFLIGHT_TIMEOUT_S", 5)),
+    # Periodo de revisión de peticiones caducadas
+    "reap_interval_s": float(os.getenv("INFLIGHT_REAP_INTERVAL_S", 0.5)),
+    # Muestras de latencia conservadas por dispositivo (percentiles)
+    "samples": int(os.getenv("INFLIGHT_SAMPLES", 200)),
+}
+
+# === HISTÓRICO DE SENSORES (sensor_readings + agregados) ===
+HISTORY_CFG = {
+    # Volcado de lecturas brutas en lote
+    "flush_ms": float(os.getenv("HISTORY_FLUSH_MS", 2000)),
+    # Lecturas pendientes máximas en memoria (se descartan las más antiguas)
+    "max_pending": int(os.getenv("HISTORY_MAX_PENDING", 20000)),
+    # Periodo de los agregados 1m/1h y de la retención
+    "rollup_interval_s": float(os.getenv("HISTORY_ROLLUP_INTERVAL_S", 60)),
+    # Retención por nivel
+    "raw_retention_h": float(os.getenv("HISTORY_RAW_RETENTION_H", 48)),
+    "m1_retention_d": float(os.getenv("HISTORY_1M_RETENTION_D", 30)),
+    "h1_retention_d": float(os.getenv("HISTORY_1H_RETENTION_D", 365)),
+    # Filas borradas por sentencia en la retención (evita bloqueos largos)
+    "delete_batch": int(os.getenv("HISTORY_DELETE_BATCH", 5000)),
+    # Puntos máximos por respuesta de 'history'
+    "max_points": int(os.getenv("HISTORY_MAX_POINTS", 2000)),
+}
+
+# === HISTÓRICO DE ALERTAS ===
+ALERT_CFG = {
+    # Retención por antigüedad y tope de filas de la tabla alerts
+    "retention_d": float(os.getenv("ALERT_RETENTION_D", 90)),
+    "max_rows": int(os.getenv("ALERT_MAX_ROWS", 100000)),
+    # Alertas máximas por respuesta de system/select 'alerts'
+    "max_limit": int(os.getenv("ALERT_MAX_LIMIT", 500)),
+    # Supresión de tormentas: ventana de repeticiones por componente
+    # y periodo de los resúmenes "N repeticiones suprimidas"
+    "dedupe_s": float(os.getenv("ALERT_DEDUPE_S", 60)),
+    "summary_s": float(os.getenv("ALERT_SUMMARY_S", 300)),
+}
+
+# === AUDITORÍA (system_logs) ===
+LOG_CFG = {
+    # Volcado en lote de los eventos auditados
+    "flush_ms": float(os.getenv("SYSTEM_LOG_FLUSH_MS", 2000)),
+    # Eventos pendientes máximos en memoria (se descartan los más antiguos)
+    "max_pending": int(os.getenv("SYSTEM_LOG_MAX_PENDING", 5000)),
+    # Días conservados (particiones diarias) y días creados por adelantado
+    "retention_d": int(os.getenv("SYSTEM_LOG_RETENTION_D", 14)),
+    "ahead_d": int(os.getenv("SYSTEM_LOG_AHEAD_D", 3)),
+}
+
+# === RETENCIÓN (tareas periódicas de borrado) ===
+RETENTION_CFG = {
+    "interval_s": float(os.getenv("RETENTION_INTERVAL_S", 3600)),
+    # Filas borradas por sentencia (evita bloqueos largos)
+    "delete_batch": int(os.getenv("RETENTION_DELETE_BATCH", 5000)),
+}
+
+# === SALIDA HACIA LOS ESP32 (token bucket por dispositivo) ===
+OUTBOUND_CFG = {
+    # Mensajes por segundo sostenidos hacia cada dispositivo (get/ + set/)
+    "rate": float(os.getenv("OUTBOUND_RATE", 5)),
+    # Ráfaga máxima permitida sin esperar
+    "burst": float(os.getenv("OUTBOUND_BURST", 10)),
+    # Mensajes en cola por dispositivo antes de descartar
+    "max_queue": int(os.getenv("OUTBOUND_MAX_QUEUE", 100)),
+    # Muestras de retardo en cola conservadas (percentiles)
+    "samples": int(os.getenv("OUTBOUND_SAMPLES", 1000)),
+}
+
+# === ÓRDENES SET ===
+SET_CFG = {
+    # Ventana de agrupación por actuador: dentro de ella solo se envía la última orden
+    "coalesce_ms": float(os.getenv("SET_COALESCE_MS", 300)),
+    # Reenvío de SET sin confirmar (response/): espera inicial, tope y nº de reintentos
+    "retry_base_ms": float(os.getenv("SET_RETRY_BASE_MS", 1000)),
+    "retry_max_ms": float(os.getenv("SET_RETRY_MAX_MS", 8000)),
+    "max_retries": int(os.getenv("SET_MAX_RETRIES", 3)),
+}
+
+# === MÉTRICAS (formato Prometheus en http://<host>:<port>/metrics) ===
+METRICS_CFG = {
+    "host": os.getenv("METRICS_HOST", "0.0.0.0"),
+    # 0 desactiva el servidor
+    "port": int(os.getenv("METRICS_PORT", 9108)),
+}
+
+# === PERFILADO DE CPU BAJO DEMANDA (system/diag/mqtt-router) ===
+DIAG_CFG = {
+    # Directorio de los ficheros .folded (volumen montado)
+    "dir": os.getenv("PROFILE_DIR", "/app/profiles"),
+    # Duración por defecto y tope de una sesión
+    "duration_s": float(os.getenv("PROFILE_DURATION_S", 30)),
+    "max_duration_s": float(os.getenv("PROFILE_MAX_DURATION_S", 300)),
+    # Intervalo entre muestras de las pilas
+    "interval_ms": int(os.getenv("PROFILE_INTERVAL_MS", 10)),
+    # Funciones incluidas en el resumen publicado
+    "top": int(os.getenv("PROFILE_TOP", 20)),
+}
+
+# === CODEC JSON ===
+CODEC_CFG = {
+    # auto | orjson | msgspec | json  (auto: el más rápido instalado)
+    "backend": os.getenv("ROUTER_CODEC", "auto"),
+    # False: fechas '%Y-%m-%d %H:%M:%S' (formato histórico); True: ISO 8601 nativo
+    "iso_datetimes": os.getenv("ROUTER_ISO_DATETIMES", "0") == "1",
+}
+
 # === LOGGING ===
 logging.basicConfig(
     format="[%(asctime)s] [%(levelname)s] %(message)s",
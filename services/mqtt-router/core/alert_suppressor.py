@@ -0,0 +1,222 @@
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from config import ALERT_CFG, logger
+
+
+@dataclass(slots=True)
+class _Track:
+    """Estado de las alertas de un componente dentro de su ventana."""
+    # status emitido (BBDD + notify) y último recibido
+    status: str
+    current: str
+    rank: int
+    emitted_at: float
+    seen_at: float
+    # Repeticiones y cambios de status suprimidos pendientes de resumir
+    suppressed: int = 0
+    flips: int = 0
+    peak_rank: int = 0
+    peak_severity: str = None
+    last_message: str = None
+    first_ts: datetime = None
+    last_ts: datetime = None
+
+
+@dataclass(slots=True)
+class Summary:
+    """Resumen "N repeticiones suprimidas" (o "flapping") de un componente."""
+    device: str
+    type: str
+    id: int
+    count: int
+    severity: str
+    severity_rank: int
+    # Último status recibido (tras los cambios suprimidos)
+    status: str
+    message: str
+    first_ts: datetime
+    last_ts: datetime
+    # Cambios de status dentro de la ventana (0 = solo repeticiones)
+    flips: int = 0
+
+
+class AlertSuppressor:
+    """
+    Supresión de tormentas de alertas por componente (device, type, id).
+
+    - La primera alerta de una ventana ('dedupe_s') pasa: BBDD + notify.
+    - Las repeticiones dentro de la ventana solo incrementan un contador
+      en memoria (sin BBDD ni publicación).
+    - Una alerta de mayor gravedad que la emitida (escalado) pasa siempre
+      y abre ventana nueva.
+    - Un cambio de 'status' (ALERT <-> OK) dentro de la ventana no pasa:
+      se cuenta como oscilación ("flapping"). Fuera de ella pasa y abre
+      ventana nueva.
+    - Cada 'summary_s' un hilo entrega, por componente con repeticiones u
+      oscilaciones, un único resumen a 'on_summary' (con el último status).
+
+    check() es O(1) y se ejecuta en el worker antes de tocar la BBDD.
+    """
+
+    def __init__(self, dedupe_s=None, summary_s=None):
+        self.dedupe_s = dedupe_s if dedupe_s is not None else ALERT_CFG["dedupe_s"]
+        self.summary_s = summary_s or ALERT_CFG["summary_s"]
+
+        self._lock = threading.Lock()
+        # (device, type, id) -> _Track
+        self._tracks = {}
+
+        self.emitted = 0
+        self.escalated = 0
+        self.suppressed = 0
+        self.flapping = 0
+        self.summaries = 0
+
+        self._on_summary = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self, on_summary):
+        """on_summary(Summary) publica/persiste cada resumen (hilo propio)."""
+        if self._thread is not None:
+            return
+
+        self._on_summary = on_summary
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="alert-summary", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"[ALERT] Supresión activa (ventana {self.dedupe_s}s, resumen cada {self.summary_s}s)"
+        )
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join(5)
+        self._thread = None
+
+        # Último resumen con lo suprimido hasta ahora
+        self._emit_summaries()
+
+    def _loop(self):
+        while not self._stop.wait(self.summary_s):
+            self._emit_summaries()
+
+    def _emit_summaries(self):
+        if self._on_summary is None:
+            return
+        for summary in self.drain_summaries():
+            try:
+                self._on_summary(summary)
+            except Exception as e:
+                logger.error(
+                    f"[ALERT] Error publicando resumen de {summary.device}/{summary.type}/{summary.id}: {e}"
+                )
+
+    # ==========================================================
+    #  DECISIÓN
+    # ==========================================================
+    def check(self, key, status, severity, rank, message=None, now=None):
+        """
+        Decide si una alerta pasa. Devuelve (decisión, suprimidas):
+          - decisión: "new", "escalated", "changed", "suppressed" o
+            "flapping" (cambio de status suprimido dentro de la ventana)
+          - suprimidas: repeticiones y cambios aún no resumidos que la
+            alerta emitida absorbe (van en su notificación y dejan de resumirse)
+        """
+        now = now if now is not None else time.monotonic()
+
+        with self._lock:
+            track = self._tracks.get(key)
+
+            if track is None:
+                decision = "new"
+            elif rank > track.rank:
+                decision = "escalated"
+            elif now - track.emitted_at >= self.dedupe_s:
+                decision = "changed" if status != track.current else "new"
+            else:
+                # Dentro de la ventana: solo contadores
+                if status != track.current:
+                    track.flips += 1
+                    track.current = status
+                    self.flapping += 1
+                    decision = "flapping"
+                else:
+                    track.suppressed += 1
+                    self.suppressed += 1
+                    decision = "suppressed"
+                track.seen_at = now
+                ts = datetime.now()
+                track.first_ts = track.first_ts or ts
+                track.last_ts = ts
+                track.last_message = message
+                if rank > track.peak_rank:
+                    track.peak_rank, track.peak_severity = rank, severity
+                return decision, 0
+
+            absorbed = track.suppressed + track.flips if track is not None else 0
+            self._tracks[key] = _Track(status, status, rank, now, now)
+            self.emitted += 1
+            if decision == "escalated":
+                self.escalated += 1
+
+        return decision, absorbed
+
+    def drain_summaries(self, now=None):
+        """Resúmenes pendientes (y poda de componentes inactivos)."""
+        now = now if now is not None else time.monotonic()
+        idle_s = 2 * max(self.dedupe_s, self.summary_s)
+        summaries = []
+
+        with self._lock:
+            for key, track in list(self._tracks.items()):
+                if track.suppressed or track.flips:
+                    device, comp_type, comp_id = key
+                    summaries.append(Summary(
+                        device, comp_type, comp_id,
+                        track.suppressed,
+                        track.peak_severity,
+                        track.peak_rank,
+                        track.current,
+                        track.last_message,
+                        track.first_ts,
+                        track.last_ts,
+                        track.flips,
+                    ))
+                    # El resumen publica el último status: pasa a ser el emitido
+                    track.status = track.current
+                    track.suppressed = track.flips = 0
+                    track.peak_rank, track.peak_severity = 0, None
+                    track.first_ts = track.last_ts = None
+                elif now - track.seen_at >= idle_s:
+                    del self._tracks[key]
+
+            self.summaries += len(summaries)
+
+        return summaries
+
+    # ==========================================================
+    #  MÉTRICAS
+    # ==========================================================
+    def stats(self):
+        with self._lock:
+            return {
+                "tracked": len(self._tracks),
+                "emitted": self.emitted,
+                "escalated": self.escalated,
+                "suppressed": self.suppressed,
+                "flapping": self.flapping,
+                "summaries": self.summaries,
+            }
+
+
+# Instancia compartida por handlers/alert.py (el hilo se arranca desde listener.py)
+alert_suppressor = AlertSuppressor()
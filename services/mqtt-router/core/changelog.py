@@ -0,0 +1,71 @@
+import threading
+import time
+import uuid
+
+
+TABLES = ("devices", "sensors", "actuators")
+
+
+def table_for(comp_type):
+    """'sensor' -> 'sensors', 'actuator' -> 'actuators'."""
+    return f"{comp_type}s"
+
+
+class ChangeLog:
+    """
+    Secuencia monótona de cambios sobre devices, sensors y actuators.
+
+    Cada escritura confirmada (tras el commit) anota la clave de la fila con
+    un nuevo número de secuencia. Solo se guarda el último cambio por clave,
+    así que la memoria está acotada por el inventario de la casa.
+
+    Los consumidores guardan (epoch, seq) tras un volcado y después piden
+    system/select con since=<seq> para recibir solo lo modificado. El epoch
+    cambia en cada arranque del router: un epoch distinto obliga a un
+    volcado completo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.epoch = f"{int(time.time())}-{uuid.uuid4().hex[:6]}"
+        self._seq = 0
+        # (table, device, id|None) -> (seq, op)
+        self._changes = {}
+
+    def record(self, table, device, comp_id=None, op="upsert"):
+        """Anota un cambio en la fila (op: 'upsert' o 'delete')."""
+        if not device:
+            return
+        key = (table, device, int(comp_id) if comp_id is not None else None)
+        with self._lock:
+            self._seq += 1
+            self._changes[key] = (self._seq, op)
+
+    def record_device(self, device, op="upsert"):
+        self.record("devices", device, None, op)
+
+    def record_component(self, comp_type, device, comp_id, op="upsert"):
+        self.record(table_for(comp_type), device, comp_id, op)
+
+    def current(self):
+        """(epoch, seq) del último cambio anotado."""
+        with self._lock:
+            return self.epoch, self._seq
+
+    def since(self, seq):
+        """
+        Cambios posteriores a 'seq', en orden de secuencia:
+        [(seq, table, device, id, op), ...]
+        """
+        with self._lock:
+            changes = [
+                (change_seq, table, device, comp_id, op)
+                for (table, device, comp_id), (change_seq, op) in self._changes.items()
+                if change_seq > seq
+            ]
+        changes.sort()
+        return changes
+
+
+# Instancia compartida por handlers y escritores en lote
+changelog = ChangeLog()
@@ -0,0 +1,214 @@
+import json
+from datetime import datetime, date
+from decimal import Decimal
+import msgspec
+from config import CODEC_CFG, logger
+from core.messages import MessageError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depende de la imagen
+    orjson = None
+
+
+# Formato histórico de fechas en los payloads del router
+DATETIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+class DecodeError(ValueError):
+    """Payload que no es JSON válido (independiente del backend)."""
+
+
+def _legacy_default(o):
+    if isinstance(o, (datetime, date)):
+        return o.strftime(DATETIME_FMT)
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError(f"Type {type(o)} not serializable")
+
+
+def _iso_default(o):
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    return _legacy_default(o)
+
+
+# Tipos que pueden contener (o ser) fechas; el resto se serializa tal cual
+_DATED = {dict, list, tuple, datetime, date}
+
+
+def _legacy_datetimes(obj):
+    """
+    Fechas -> formato histórico antes de codificar con msgspec, que serializa
+    datetime de forma nativa (RFC 3339) sin opción de formato y sin pasar por
+    enc_hook. Solo se desciende por contenedores y fechas (un type() por
+    valor); los contenedores sin fechas se devuelven tal cual, sin copiarlos.
+    """
+    cls = type(obj)
+    if cls is dict:
+        converted = None
+        for k, v in obj.items():
+            if type(v) in _DATED:
+                new = _legacy_datetimes(v)
+                if new is not v:
+                    if converted is None:
+                        converted = dict(obj)
+                    converted[k] = new
+        return obj if converted is None else converted
+    if cls is list or cls is tuple:
+        converted = None
+        for idx, v in enumerate(obj):
+            if type(v) in _DATED:
+                new = _legacy_datetimes(v)
+                if new is not v:
+                    if converted is None:
+                        converted = list(obj)
+                    converted[idx] = new
+        return obj if converted is None else converted
+    if cls is datetime and obj.tzinfo is None:
+        # Mismo texto que strftime(DATETIME_FMT), en C y ~3x más rápido
+        return obj.isoformat(" ", "seconds")
+    if cls is datetime or cls is date:
+        return obj.strftime(DATETIME_FMT)
+    return obj
+
+
+# ==========================================================
+#  BACKENDS
+# ==========================================================
+class JsonCodec:
+    """Biblioteca estándar (siempre disponible)."""
+
+    name = "json"
+
+    def __init__(self, iso_datetimes):
+        self._default = _iso_default if iso_datetimes else _legacy_default
+
+    def decode(self, data):
+        try:
+            if isinstance(data, (bytes, bytearray)):
+                data = data.decode("utf-8")
+            return json.loads(data)
+        except (ValueError, UnicodeDecodeError) as e:
+            raise DecodeError(str(e)) from None
+
+    def encode(self, obj):
+        return json.dumps(obj, default=self._default).encode("utf-8")
+
+
+class OrjsonCodec:
+    """orjson: parseo/serialización en Rust; datetimes nativos o formato histórico."""
+
+    name = "orjson"
+
+    def __init__(self, iso_datetimes):
+        # Decimal (AVG/SUM de MariaDB) siempre pasa por default
+        self._default = _legacy_default
+        self._option = orjson.OPT_NON_STR_KEYS
+        if not iso_datetimes:
+            # orjson delega los datetimes a una función de módulo (sin closures por llamada)
+            self._option |= orjson.OPT_PASSTHROUGH_DATETIME
+
+    def decode(self, data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise DecodeError(str(e)) from None
+
+    def encode(self, obj):
+        return orjson.dumps(obj, default=self._default, option=self._option)
+
+
+class MsgspecCodec:
+    """msgspec: encoder/decoder reutilizables; datetimes nativos (RFC 3339)."""
+
+    name = "msgspec"
+
+    def __init__(self, iso_datetimes):
+        self._iso = iso_datetimes
+        self._encoder = msgspec.json.Encoder(decimal_format="number")
+        self._decoder = msgspec.json.Decoder()
+
+    def decode(self, data):
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise DecodeError(str(e)) from None
+
+    def encode(self, obj):
+        if not self._iso:
+            obj = _legacy_datetimes(obj)
+        return self._encoder.encode(obj)
+
+
+BACKENDS = {
+    "json": JsonCodec,
+    "orjson": OrjsonCodec,
+    "msgspec": MsgspecCodec,
+}
+
+
+def available_backends():
+    names = ["json"]
+    if orjson is not None:
+        names.append("orjson")
+    names.append("msgspec")
+    return names
+
+
+def make_codec(backend="auto", iso_datetimes=False):
+    """
+    Crea el codec pedido. 'auto' elige orjson si está instalado y si no
+    msgspec (dependencia fija); un backend no disponible cae a json con un aviso.
+    """
+    available = available_backends()
+
+    if backend == "auto":
+        backend = "orjson" if "orjson" in available else "msgspec"
+    elif backend not in available:
+        logger.warning(f"[CODEC] Backend '{backend}' no disponible. Usando json.")
+        backend = "json"
+
+    return BACKENDS[backend](iso_datetimes)
+
+
+# Codec activo del router
+codec = make_codec(CODEC_CFG["backend"], CODEC_CFG["iso_datetimes"])
+
+
+def decode(data):
+    """bytes/str JSON -> objeto Python. Payload vacío -> {}."""
+    if not data or not data.strip():
+        return {}
+    return codec.decode(data)
+
+
+def encode(obj):
+    """Objeto Python -> bytes JSON (listo para client.publish)."""
+    return codec.encode(obj)
+
+
+# Decoders tipados por clase de mensaje (reutilizables y thread-safe)
+_typed_decoders = {}
+
+
+def decode_as(data, msg_type):
+    """
+    bytes JSON -> mensaje de core.messages en una sola pasada: msgspec
+    parsea, valida y construye la estructura sin dict intermedio (con
+    cualquier backend). Payload vacío -> mensaje con los valores por
+    defecto. DecodeError si no es JSON; MessageError si no es válido.
+    """
+    decoder = _typed_decoders.get(msg_type)
+    if decoder is None:
+        decoder = _typed_decoders.setdefault(
+            msg_type, msgspec.json.Decoder(msg_type, strict=False)
+        )
+    if not data or not data.strip():
+        data = b"{}"
+    try:
+        return decoder.decode(data)
+    except msgspec.ValidationError as e:
+        raise MessageError(str(e)) from None
+    except msgspec.DecodeError as e:
+        raise DecodeError(str(e)) from None
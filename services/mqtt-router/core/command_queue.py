@@ -0,0 +1,155 @@
+import threading
+import time
+from config import SET_CFG, logger
+
+
+class _Slot:
+    __slots__ = ("last_sent_at", "last_signature", "pending", "timer")
+
+    def __init__(self):
+        self.last_sent_at = float("-inf")
+        self.last_signature = None
+        # (signature, send_fn, on_drop) a la espera de que cierre la ventana
+        self.pending = None
+        self.timer = None
+
+
+class CommandQueue:
+    """
+    Cola de órdenes SET por actuador con ventana de agrupación.
+
+    - La primera orden de una ráfaga se envía al momento.
+    - Las que llegan dentro de la ventana ('window_ms') no se envían: cada
+      una sustituye a la anterior pendiente (last-writer-wins) y al cerrar
+      la ventana solo se envía la última.
+    - Una orden idéntica a la última enviada dentro de la ventana se descarta.
+
+    send_fn se ejecuta en el worker (envío inmediato) o en el hilo del
+    temporizador. on_drop(motivo) avisa de una orden que no llega a enviarse
+    ("superseded" o "duplicate").
+    """
+
+    def __init__(self, window_ms=None):
+        self.window_s = (window_ms if window_ms is not None else SET_CFG["coalesce_ms"]) / 1000.0
+
+        self._lock = threading.Lock()
+        # (device, type, id) -> _Slot
+        self._slots = {}
+
+        self.sent = 0
+        self.superseded = 0
+        self.duplicates = 0
+        self.skipped = 0
+
+    def submit(self, key, signature, send_fn, on_drop=None):
+        """
+        Encola una orden. 'signature' identifica la orden (sin requester/cid)
+        para detectar duplicados. Devuelve "sent", "queued" o "duplicate".
+        """
+        now = time.monotonic()
+        dropped = None
+
+        with self._lock:
+            slot = self._slots.setdefault(key, _Slot())
+            in_window = now - slot.last_sent_at < self.window_s
+
+            if slot.pending is not None:
+                # Última orden gana: la pendiente queda sustituida
+                self.superseded += 1
+                dropped = slot.pending[2]
+                slot.pending = (signature, send_fn, on_drop)
+                result = "queued"
+
+            elif in_window and signature == slot.last_signature:
+                self.duplicates += 1
+                dropped, result = on_drop, "duplicate"
+
+            elif in_window:
+                slot.pending = (signature, send_fn, on_drop)
+                wait = slot.last_sent_at + self.window_s - now
+                slot.timer = threading.Timer(wait, self._flush, (key,))
+                slot.timer.daemon = True
+                slot.timer.start()
+                result = "queued"
+
+            else:
+                slot.last_sent_at = now
+                slot.last_signature = signature
+                result = "sent"
+
+        if result == "sent":
+            self._run(key, send_fn)
+        elif dropped is not None:
+            self._drop(key, dropped, "superseded" if result == "queued" else "duplicate")
+        return result
+
+    def is_idle(self, key):
+        """True si no hay ninguna orden pendiente para el actuador."""
+        with self._lock:
+            slot = self._slots.get(key)
+            return slot is None or slot.pending is None
+
+    def record_skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def stop(self):
+        """Cancela los temporizadores (las órdenes pendientes se descartan)."""
+        with self._lock:
+            for slot in self._slots.values():
+                if slot.timer is not None:
+                    slot.timer.cancel()
+                slot.pending = None
+
+    def _flush(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None or slot.pending is None:
+                return
+
+            signature, send_fn, on_drop = slot.pending
+            slot.pending = None
+            slot.timer = None
+
+            duplicate = signature == slot.last_signature
+            if duplicate:
+                self.duplicates += 1
+            else:
+                slot.last_sent_at = time.monotonic()
+                slot.last_signature = signature
+
+        if duplicate:
+            if on_drop is not None:
+                self._drop(key, on_drop, "duplicate")
+            return
+
+        self._run(key, send_fn)
+
+    def _drop(self, key, on_drop, reason):
+        try:
+            on_drop(reason)
+        except Exception as e:
+            logger.error(f"[SET] Error notificando orden descartada ({'/'.join(map(str, key))}): {e}")
+
+    def _run(self, key, send_fn):
+        try:
+            send_fn()
+        except Exception as e:
+            logger.error(f"[SET] Error enviando orden a {'/'.join(map(str, key))}: {e}")
+            return
+
+        with self._lock:
+            self.sent += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sent": self.sent,
+                "superseded": self.superseded,
+                "duplicates": self.duplicates,
+                "skipped": self.skipped,
+            }
+
+
+# Instancia compartida por esp_set
+command_queue = CommandQueue()
@@ -0,0 +1,324 @@
+import itertools
+import threading
+import time
+import zlib
+from collections import deque
+from config import DISPATCH_CFG, logger
+
+
+# Prioridades (menor = antes)
+PRIORITY_HIGH = 0       # alert/, response/, system/set, system/get
+PRIORITY_NORMAL = 1     # announce/, update/ de actuadores, system/notify
+PRIORITY_LOW = 2        # update/ de sensores (telemetría), system/select
+
+PRIORITY_NAMES = ("high", "normal", "low")
+
+
+class _KeyQueue:
+    __slots__ = ("items", "counts", "level", "ticket")
+
+    def __init__(self):
+        # Mensajes de la clave en orden de llegada: [fn, args, coalesce_key, prioridad]
+        self.items = deque()
+        # Mensajes pendientes por prioridad
+        self.counts = [0] * len(PRIORITY_NAMES)
+        # Prioridad con la que está planificada (la mayor de sus pendientes)
+        self.level = None
+        self.ticket = None
+
+    def top_level(self):
+        for level, count in enumerate(self.counts):
+            if count:
+                return level
+        return None
+
+
+class _Shard:
+    __slots__ = ("cond", "queues", "ready", "tickets", "latest", "size")
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # clave -> _KeyQueue (FIFO por dispositivo)
+        self.queues = {}
+        # Por prioridad, turnos de claves con pendientes: (clave, ticket).
+        # Un turno cuyo ticket ya no es el de la clave está obsoleto y se salta.
+        self.ready = tuple(deque() for _ in PRIORITY_NAMES)
+        self.tickets = itertools.count()
+        # coalesce_key -> elemento más reciente aún en cola
+        self.latest = {}
+        self.size = 0
+
+
+class ShardedDispatcher:
+    """
+    Pool de workers acotado y particionado por clave (normalmente el dispositivo).
+
+    - Cada clave se asigna siempre al mismo worker (crc32 % workers) y sus
+      mensajes se procesan en orden de llegada, sea cual sea su prioridad.
+    - Claves distintas se reparten entre workers y avanzan en paralelo.
+    - La prioridad decide qué clave atiende antes cada worker: la de una
+      clave es la mayor de sus mensajes pendientes (alertas, GET/SET y sus
+      respuestas > resto > telemetría y volcados de select). Una alerta
+      adelanta así a su dispositivo entero sin desordenarlo. Entre claves
+      de la misma prioridad se alterna un mensaje por turno.
+    - submit() nunca bloquea. Con el shard saturado:
+        * telemetría con 'coalesce_key' ya en cola: se sustituye el
+          mensaje pendiente por el nuevo (último valor por sensor);
+        * cola llena: un mensaje de más prioridad expulsa al más antiguo
+          de menor prioridad de la clave con más pendientes (shed); si no
+          hay ninguno, se descarta.
+    """
+
+    def __init__(self, workers=None, queue_size=None, coalesce_depth=None):
+        self.num_workers = max(1, int(workers or DISPATCH_CFG["workers"]))
+        self.queue_size = max(1, int(queue_size or DISPATCH_CFG["queue_size"]))
+        self.coalesce_depth = max(
+            1, int(coalesce_depth if coalesce_depth is not None else DISPATCH_CFG["coalesce_depth"])
+        )
+
+        self._shards = [_Shard() for _ in range(self.num_workers)]
+        self._threads = []
+        self._running = False
+        self._stopping = False
+
+        self._stats_lock = threading.Lock()
+        self.dropped = 0
+        self.processed = 0
+        self.coalesced = 0
+        self.shed = [0] * len(PRIORITY_NAMES)
+        self._last_warning = 0.0
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self):
+        if self._running:
+            return
+
+        self._running = True
+        self._stopping = False
+        for idx, shard in enumerate(self._shards):
+            t = threading.Thread(
+                target=self._worker_loop,
+                args=(idx, shard),
+                name=f"dispatch-{idx}",
+                daemon=True
+            )
+            t.start()
+            self._threads.append(t)
+
+        logger.info(
+            f"[DISPATCH] {self.num_workers} workers iniciados "
+            f"(cola máx. {self.queue_size} por worker)"
+        )
+
+    def stop(self, timeout=5.0):
+        """Detiene los workers tras vaciar lo ya encolado."""
+        if not self._running:
+            return
+
+        self._running = False
+        self._stopping = True
+        for shard in self._shards:
+            with shard.cond:
+                shard.cond.notify_all()
+
+        for t in self._threads:
+            t.join(timeout)
+
+        self._threads = []
+        logger.info("[DISPATCH] Workers detenidos")
+
+    # ==========================================================
+    #  ENCOLADO
+    # ==========================================================
+    def shard_for(self, key):
+        if not key:
+            return 0
+        return zlib.crc32(str(key).encode("utf-8")) % self.num_workers
+
+    def submit(self, key, fn, *args, priority=PRIORITY_NORMAL, coalesce_key=None):
+        """
+        Encola fn(*args) en el shard de 'key' con la prioridad indicada.
+        'coalesce_key' (p. ej. el topic de un sensor) permite sustituir un
+        mensaje aún en cola cuando el shard está saturado.
+        Devuelve False si se descarta por cola llena o dispatcher parado.
+        """
+        if not self._running:
+            return False
+
+        idx = self.shard_for(key)
+        shard = self._shards[idx]
+        shed_level = None
+
+        with shard.cond:
+            # === Saturado: la telemetría pendiente se reduce al último valor ===
+            if coalesce_key is not None and shard.size >= self.coalesce_depth:
+                item = shard.latest.get(coalesce_key)
+                if item is not None:
+                    item[0], item[1] = fn, args
+                    with self._stats_lock:
+                        self.coalesced += 1
+                    return True
+
+            if shard.size >= self.queue_size:
+                shed_level = self._shed(shard, priority)
+                if shed_level is None:
+                    with self._stats_lock:
+                        self.dropped += 1
+                        dropped = self.dropped
+                    logger.warning(
+                        f"[DISPATCH] Cola del worker {idx} llena ({self.queue_size}). "
+                        f"Mensaje descartado (clave={key}, total descartados={dropped})"
+                    )
+                    return False
+
+            item = [fn, args, coalesce_key, priority]
+            queue = shard.queues.get(key)
+            if queue is None:
+                queue = shard.queues[key] = _KeyQueue()
+            queue.items.append(item)
+            queue.counts[priority] += 1
+            if queue.level is None or priority < queue.level:
+                self._schedule(shard, key, queue, priority)
+
+            if coalesce_key is not None:
+                shard.latest[coalesce_key] = item
+            shard.size += 1
+            shard.cond.notify()
+
+        if shed_level is not None:
+            self._warn_shed(idx, shed_level)
+        return True
+
+    @staticmethod
+    def _schedule(shard, key, queue, level):
+        """Da turno a la clave en la prioridad 'level' (con el lock del shard)."""
+        queue.level = level
+        queue.ticket = next(shard.tickets)
+        shard.ready[level].append((key, queue.ticket))
+
+    def _shed(self, shard, priority):
+        """
+        Expulsa el mensaje más antiguo de la prioridad más baja inferior a
+        'priority', de la clave con más mensajes de esa prioridad (se llama
+        con el lock del shard). Devuelve su nivel o None.
+        """
+        for level in range(len(PRIORITY_NAMES) - 1, priority, -1):
+            key, queue = max(
+                shard.queues.items(), key=lambda kv: kv[1].counts[level], default=(None, None)
+            )
+            if queue is None or not queue.counts[level]:
+                continue
+
+            idx = next(i for i, item in enumerate(queue.items) if item[3] == level)
+            item = queue.items[idx]
+            del queue.items[idx]
+            self._forget(shard, key, queue, item)
+            with self._stats_lock:
+                self.shed[level] += 1
+            return level
+        return None
+
+    def _forget(self, shard, key, queue, item):
+        """Se llama con el lock del shard tras sacar 'item' de la cola de 'key'."""
+        shard.size -= 1
+        queue.counts[item[3]] -= 1
+        coalesce_key = item[2]
+        if coalesce_key is not None and shard.latest.get(coalesce_key) is item:
+            del shard.latest[coalesce_key]
+
+        if not queue.items:
+            del shard.queues[key]
+        elif queue.counts[queue.level] == 0:
+            # Ya no le queda nada de su prioridad: turno en la siguiente
+            self._schedule(shard, key, queue, queue.top_level())
+
+    def _warn_shed(self, idx, level):
+        # Como mucho un aviso por segundo: bajo sobrecarga el log no debe sumar carga
+        now = time.monotonic()
+        with self._stats_lock:
+            if now - self._last_warning < 1.0:
+                return
+            self._last_warning = now
+            shed = dict(zip(PRIORITY_NAMES, self.shed))
+        logger.warning(
+            f"[DISPATCH] Worker {idx} saturado: se descartan mensajes de prioridad "
+            f"{PRIORITY_NAMES[level]} (acumulado {shed})"
+        )
+
+    # ==========================================================
+    #  MÉTRICAS
+    # ==========================================================
+    def queue_depths(self):
+        depths = []
+        for shard in self._shards:
+            with shard.cond:
+                depths.append(shard.size)
+        return depths
+
+    def stats(self):
+        # Los locks de los shards se toman antes (y no a la vez) que _stats_lock
+        depths = self.queue_depths()
+        by_priority = [0] * len(PRIORITY_NAMES)
+        for shard in self._shards:
+            with shard.cond:
+                for queue in shard.queues.values():
+                    for level, count in enumerate(queue.counts):
+                        by_priority[level] += count
+
+        with self._stats_lock:
+            return {
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+                "shed": dict(zip(PRIORITY_NAMES, self.shed)),
+                "queued": dict(zip(PRIORITY_NAMES, by_priority)),
+                "depths": depths,
+            }
+
+    # ==========================================================
+    #  WORKERS
+    # ==========================================================
+    def _next(self, shard):
+        """
+        Siguiente mensaje (se llama con el lock del shard): el primero de la
+        clave con turno en la mayor prioridad. La clave vuelve al final de
+        la cola de su prioridad si le quedan mensajes.
+        """
+        for level, ready in enumerate(shard.ready):
+            while ready:
+                key, ticket = ready.popleft()
+                queue = shard.queues.get(key)
+                if queue is None or queue.ticket != ticket:
+                    continue
+
+                item = queue.items.popleft()
+                self._forget(shard, key, queue, item)
+                if queue.items and queue.ticket == ticket:
+                    self._schedule(shard, key, queue, queue.top_level())
+                return item
+        return None
+
+    def _worker_loop(self, idx, shard):
+        while True:
+            with shard.cond:
+                item = self._next(shard)
+                while item is None:
+                    if self._stopping:
+                        return
+                    shard.cond.wait()
+                    item = self._next(shard)
+
+            fn, args = item[0], item[1]
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"[DISPATCH] Error en worker {idx}: {e}")
+            finally:
+                with self._stats_lock:
+                    self.processed += 1
+
+
+# Instancia compartida (se arranca desde listener.py)
+dispatcher = ShardedDispatcher()
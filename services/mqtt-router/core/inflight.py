@@ -0,0 +1,425 @@
+import itertools
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from config import INFLIGHT_CFG, SET_CFG, logger
+from core.codec import encode
+from core.outbound import outbound
+from core.stats import summarize
+
+
+@dataclass(slots=True)
+class Inflight:
+    """Petición reenviada a un ESP32 pendiente de su response/#."""
+    cid: str
+    kind: str               # "get" | "set"
+    device: str
+    type: str
+    id: int
+    requester: str
+    sent_at: float = field(default_factory=time.monotonic)
+    sent_ts: datetime = field(default_factory=datetime.now)
+    # Requesters adicionales de un GET agrupado (reciben la misma respuesta)
+    waiters: list = field(default_factory=list)
+    # Entrega confirmada de SET: publicación a reenviar y nº de envíos
+    topic: str = None
+    payload: bytes = None
+    attempts: int = 1
+    first_sent_at: float = field(default_factory=time.monotonic)
+    # SET: campos confirmados que deja la orden ({"state": 1}, {"enabled": 0}...)
+    # o None si no lleva a un estado estable (p. ej. STOP)
+    expect: dict = None
+
+    @property
+    def key(self):
+        return (self.device, self.type, self.id)
+
+    @property
+    def requesters(self):
+        """Requester original + los agrupados, sin duplicados y en orden."""
+        return list(dict.fromkeys([self.requester, *self.waiters]))
+
+
+class InflightTable:
+    """
+    Tabla de peticiones GET/SET en vuelo, indexadas por correlation id (cid).
+
+    - begin() registra el reenvío y devuelve el cid que viaja en el payload
+      hacia el ESP32.
+    - complete() empareja la response/# por cid (si el firmware lo devuelve)
+      o, si no, con el GET más antiguo pendiente del mismo componente o, a
+      falta de GET, con el SET más antiguo cuyo estado pedido coincide con
+      el informado.
+      Anota la latencia de ida y vuelta del dispositivo.
+    - begin_get() agrupa los GET concurrentes del mismo componente: si ya hay
+      uno en vuelo, el nuevo requester espera esa misma respuesta.
+    - Los SET con track_delivery() se reenvían (mismo cid) si no llega su
+      response/#, con espera exponencial y un máximo de reintentos.
+    - Un hilo revisa periódicamente las caducadas y publica un timeout
+      explícito a cada requester en system/response/<requester>/<type>/<device>/<id>.
+    """
+
+    def __init__(self, timeout_s=None, reap_interval_s=None, samples=None):
+        self.timeout_s = timeout_s or INFLIGHT_CFG["timeout_s"]
+        self.reap_interval_s = reap_interval_s or INFLIGHT_CFG["reap_interval_s"]
+        self.samples = samples or INFLIGHT_CFG["samples"]
+        self.retry_base_s = SET_CFG["retry_base_ms"] / 1000.0
+        self.retry_max_s = SET_CFG["retry_max_ms"] / 1000.0
+        self.max_retries = SET_CFG["max_retries"]
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._prefix = f"{int(time.time()) % 100000:05d}"
+        # cid -> Inflight (en orden de envío)
+        self._entries = {}
+        # (device, type, id) -> deque[cid]
+        self._by_component = {}
+        # device -> deque[ms]
+        self._latency = {}
+        # device -> deque[ms] desde el primer envío de un SET hasta su confirmación
+        self._delivery = {}
+
+        self.completed = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.coalesced = 0
+        self.sets_tracked = 0
+        self.sets_delivered = 0
+        self.sets_failed = 0
+        self.retransmits = 0
+        self.superseded = 0
+
+        self._client = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self, client):
+        if self._thread is not None:
+            return
+
+        self._client = client
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="inflight-reaper", daemon=True)
+        self._thread.start()
+        logger.info(f"[INFLIGHT] Seguimiento iniciado (timeout {self.timeout_s}s)")
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join(self.reap_interval_s + 5)
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.reap_interval_s):
+            try:
+                for entry in self.retransmit_due():
+                    self._retransmit(entry)
+                for entry in self.expire():
+                    self._publish_timeout(entry)
+            except Exception as e:
+                logger.error(f"[INFLIGHT] Error revisando peticiones caducadas: {e}")
+
+    # ==========================================================
+    #  REGISTRO
+    # ==========================================================
+    def begin(self, kind, device, comp_type, comp_id, requester, expect=None):
+        with self._lock:
+            entry = self._add(kind, device, comp_type, comp_id, requester)
+            entry.expect = expect
+            return entry
+
+    def _add(self, kind, device, comp_type, comp_id, requester):
+        """Se llama con el lock tomado."""
+        entry = Inflight(
+            f"{self._prefix}-{next(self._ids)}", kind, device, comp_type, int(comp_id), requester
+        )
+        self._entries[entry.cid] = entry
+        self._by_component.setdefault(entry.key, deque()).append(entry.cid)
+        return entry
+
+    def begin_get(self, device, comp_type, comp_id, requester):
+        """
+        Registra un GET o lo agrupa con el que ya está en vuelo para el mismo
+        componente. Devuelve (Inflight, agrupado): si agrupado es True no hay
+        que reenviar nada al ESP32.
+        """
+        key = (device, comp_type, int(comp_id))
+
+        with self._lock:
+            for cid in self._by_component.get(key, ()):
+                entry = self._entries[cid]
+                if entry.kind == "get":
+                    entry.waiters.append(requester)
+                    self.coalesced += 1
+                    return entry, True
+
+            return self._add("get", device, comp_type, comp_id, requester), False
+
+    def track_delivery(self, entry, topic, payload):
+        """Activa el reenvío con backoff de un SET hasta que llegue su response/#."""
+        with self._lock:
+            entry.topic = topic
+            entry.payload = payload
+            self.sets_tracked += 1
+
+    def _backoff(self, attempts):
+        """Espera de confirmación tras el envío nº 'attempts'."""
+        return min(self.retry_base_s * (2 ** (attempts - 1)), self.retry_max_s)
+
+    def _retrying(self, entry):
+        return entry.payload is not None
+
+    def mark_sent(self, cid):
+        """
+        Renueva la hora de envío cuando la publicación sale realmente al
+        broker (p. ej. tras esperar en la cola de salida del dispositivo).
+        """
+        with self._lock:
+            entry = self._entries.get(cid)
+            if entry is not None:
+                entry.sent_at = time.monotonic()
+                entry.sent_ts = datetime.now()
+
+    def has_pending(self, device, comp_type, comp_id, kind=None):
+        """True si hay una petición (de 'kind', si se indica) en vuelo para el componente."""
+        with self._lock:
+            return any(
+                kind is None or self._entries[cid].kind == kind
+                for cid in self._by_component.get((device, comp_type, int(comp_id)), ())
+            )
+
+    def complete(self, device, comp_type, comp_id, cid=None, reported=None):
+        """
+        Cierra la petición que corresponde a una response/#.
+        'reported' son los campos confirmados por el ESP32 ({"state": 0/1},
+        {"enabled": 0/1}); sin cid solo cierran un SET si coinciden con
+        lo que pedía la orden.
+        Devuelve (Inflight, latencia_ms) o None si no había ninguna pendiente.
+        """
+        key = (device, comp_type, int(comp_id))
+
+        with self._lock:
+            entry = self._entries.get(cid) if cid else None
+            if entry is None or entry.key != key:
+                entry = self._match(self._by_component.get(key, ()), reported or {})
+
+            if entry is None:
+                self.unmatched += 1
+                return None
+
+            if entry.kind == "set":
+                self._supersede(entry)
+            self._remove(entry)
+            now = time.monotonic()
+            latency_ms = (now - entry.sent_at) * 1000.0
+            self._latency.setdefault(device, deque(maxlen=self.samples)).append(latency_ms)
+            self.completed += 1
+
+            if self._retrying(entry):
+                self.sets_delivered += 1
+                self._delivery.setdefault(device, deque(maxlen=self.samples)).append(
+                    (now - entry.first_sent_at) * 1000.0
+                )
+
+        return entry, latency_ms
+
+    def _match(self, pending, reported):
+        """
+        Petición sin cid para una respuesta (se llama con el lock): el GET
+        más antiguo o, si no hay, el SET más antiguo que la respuesta confirma.
+        Así una lectura no detiene el reenvío de un SET que no ha confirmado.
+        """
+        entries = [self._entries[cid] for cid in pending]
+        for entry in entries:
+            if entry.kind == "get":
+                return entry
+
+        for entry in entries:
+            if entry.expect is None:
+                # Orden sin estado estable (STOP): la confirma una respuesta
+                # que tampoco informa de uno
+                if not reported:
+                    return entry
+                continue
+            if all(
+                reported.get(field) is not None and int(reported[field]) == int(value)
+                for field, value in entry.expect.items()
+            ):
+                return entry
+        return None
+
+    def _supersede(self, entry):
+        """
+        Retira los SET anteriores del mismo componente (se llama con el lock):
+        el estado confirmado ya es posterior y reenviarlos lo desharía.
+        Sus requesters reciben la misma respuesta.
+        """
+        for cid in list(self._by_component.get(entry.key, ())):
+            if cid == entry.cid:
+                break
+            older = self._entries[cid]
+            if older.kind == "set":
+                self._remove(older)
+                entry.waiters.extend(older.requesters)
+                self.superseded += 1
+
+    def retransmit_due(self, now=None):
+        """
+        SET sin confirmar cuya espera (backoff) ha vencido y que aún tienen
+        reintentos. Se marcan como reenviados antes de devolverlos.
+        """
+        now = now if now is not None else time.monotonic()
+        due = []
+
+        with self._lock:
+            for entry in self._entries.values():
+                if (
+                    self._retrying(entry)
+                    and entry.attempts <= self.max_retries
+                    and now - entry.sent_at >= self._backoff(entry.attempts)
+                ):
+                    entry.attempts += 1
+                    entry.sent_at = now
+                    due.append(entry)
+            self.retransmits += len(due)
+
+        return due
+
+    def expire(self, now=None):
+        """Retira y devuelve las peticiones que superan el timeout (o agotan los reintentos)."""
+        now = now if now is not None else time.monotonic()
+
+        with self._lock:
+            # sent_at puede renovarse (mark_sent), así que se revisan todas
+            expired = [entry for entry in self._entries.values() if self._expired(entry, now)]
+
+            for entry in expired:
+                self._remove(entry)
+                if self._retrying(entry):
+                    self.sets_failed += 1
+            self.timeouts += len(expired)
+
+        return expired
+
+    def _expired(self, entry, now):
+        if self._retrying(entry):
+            # Solo tras agotar los reintentos y su última espera
+            return (
+                entry.attempts > self.max_retries
+                and now - entry.sent_at >= self._backoff(entry.attempts)
+            )
+        return now - entry.sent_at >= self.timeout_s
+
+    def _retransmit(self, entry):
+        logger.warning(
+            f"[INFLIGHT] SET {entry.device}/{entry.type}/{entry.id} sin confirmar; "
+            f"reenvío {entry.attempts - 1}/{self.max_retries} (cid={entry.cid})"
+        )
+        if self._client is not None:
+            outbound.publish(
+                self._client, entry.device, entry.topic, entry.payload, qos=1,
+                on_sent=lambda: self.mark_sent(entry.cid)
+            )
+
+    def _remove(self, entry):
+        """Se llama con el lock tomado."""
+        self._entries.pop(entry.cid, None)
+        pending = self._by_component.get(entry.key)
+        if pending is not None:
+            try:
+                pending.remove(entry.cid)
+            except ValueError:
+                pass
+            if not pending:
+                del self._by_component[entry.key]
+
+    def _publish_timeout(self, entry):
+        waited_ms = int((time.monotonic() - entry.sent_at) * 1000)
+        logger.warning(
+            f"[INFLIGHT] Timeout {entry.kind.upper()} {entry.device}/{entry.type}/{entry.id} "
+            f"(cid={entry.cid}, requester={entry.requester}, {waited_ms} ms)"
+        )
+
+        if self._client is None:
+            return
+
+        payload = encode({
+            "error": "timeout",
+            "request": entry.kind,
+            "cid": entry.cid,
+            "device": entry.device,
+            "type": entry.type,
+            "id": entry.id,
+            "timeout_ms": int(
+                (time.monotonic() - entry.first_sent_at if self._retrying(entry) else self.timeout_s)
+                * 1000
+            ),
+            "attempts": entry.attempts,
+            "sent_ts": entry.sent_ts.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+
+        for requester in entry.requesters:
+            if requester:
+                self._client.publish(
+                    f"system/response/{requester}/{entry.type}/{entry.device}/{entry.id}",
+                    payload,
+                    qos=1
+                )
+
+    # ==========================================================
+    #  MÉTRICAS
+    # ==========================================================
+    def pending(self):
+        with self._lock:
+            return len(self._entries)
+
+    def latency(self, device=None):
+        """
+        Percentiles de latencia de ida y vuelta (ms) por dispositivo:
+        {device: {"count", "p50", "p90", "p99", "max"}}
+        """
+        with self._lock:
+            samples = {
+                dev: list(values)
+                for dev, values in self._latency.items()
+                if device is None or dev == device
+            }
+
+        return {dev: summarize(values) for dev, values in samples.items() if values}
+
+    def delivery(self, device=None):
+        """Percentiles (ms) desde el primer envío de un SET hasta su confirmación."""
+        with self._lock:
+            samples = {
+                dev: list(values)
+                for dev, values in self._delivery.items()
+                if device is None or dev == device
+            }
+        return {dev: summarize(values) for dev, values in samples.items() if values}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._entries),
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "unmatched": self.unmatched,
+                "coalesced": self.coalesced,
+                "sets_delivered": self.sets_delivered,
+                "sets_failed": self.sets_failed,
+                "retransmits": self.retransmits,
+                "superseded": self.superseded,
+                # Reenvíos por SET con entrega confirmada activada
+                "retry_rate": round(self.retransmits / self.sets_tracked, 3) if self.sets_tracked else 0.0,
+            }
+
+
+# Instancia compartida (el reaper se arranca desde listener.py)
+inflight = InflightTable()
@@ -0,0 +1,234 @@
+from datetime import datetime
+from typing import Annotated, Any, Optional
+import msgspec
+from config import SELECT_CFG
+
+
+COMPONENT_TYPES = ("sensor", "actuator")
+
+# Gravedad de alertas -> rango numérico (alerts.severity_rank)
+SEVERITY_RANK = {"low": 1, "medium": 2, "high": 3, "critical": 4}
+
+# Enteros/segundos no negativos (los valores en texto se convierten: "10" -> 10)
+NonNegInt = Annotated[int, msgspec.Meta(ge=0)]
+NonNegFloat = Annotated[float, msgspec.Meta(ge=0)]
+
+
+class MessageError(ValueError):
+    """Payload con campos ausentes o inválidos (el texto va al log)."""
+
+
+def _parse_type(raw):
+    return str(raw).strip().lower() if raw else None
+
+
+class Message(msgspec.Struct):
+    """
+    Base de los mensajes tipados. msgspec valida y construye la estructura
+    en la misma pasada que parsea el JSON (ver core.codec.decode_as); los
+    campos desconocidos se ignoran y los números en texto se convierten.
+    Las comprobaciones entre campos van en __post_init__ (MessageError).
+    """
+
+    @classmethod
+    def from_payload(cls, payload):
+        """dict ya decodificado -> mensaje (mismas reglas que decode_as)."""
+        try:
+            return msgspec.convert(payload, cls, strict=False)
+        except msgspec.ValidationError as e:
+            raise MessageError(str(e)) from None
+
+
+# ==========================================================
+#  DOMINIO FIELD (ESP32 -> router)
+# ==========================================================
+class AnnounceMsg(Message):
+    name: Optional[str] = None
+    location: Optional[str] = None
+    state: Any = None
+
+    def __post_init__(self):
+        if not self.name or not self.location:
+            raise MessageError("Payload incompleto (name/location)")
+
+
+class UpdateMsg(Message):
+    value: Any = None
+    unit: Optional[str] = None
+    # Alias histórico de 'unit' en algunos firmwares (tiene prioridad)
+    units: Optional[str] = None
+    state: Any = None
+
+    def __post_init__(self):
+        if self.units:
+            self.unit = self.units
+
+
+class AlertMsg(Message):
+    status: Any = "ALERT"
+    message: Any = "Sin mensaje"
+    severity: Any = "medium"
+    code: Any = None
+    name: Optional[str] = None
+    location: Optional[str] = None
+
+    def __post_init__(self):
+        self.severity = str(self.severity or "medium").strip().lower()
+
+    @property
+    def severity_rank(self):
+        """Rango numérico para ordenar; una gravedad desconocida cuenta como 'medium'."""
+        return SEVERITY_RANK.get(self.severity, SEVERITY_RANK["medium"])
+
+
+# ==========================================================
+#  DOMINIO SYSTEM (microservicios -> router)
+# ==========================================================
+def _check_component(msg, what):
+    msg.type = _parse_type(msg.type)
+    if not (msg.device and msg.type and msg.id is not None):
+        raise MessageError(f"{what} (device/type/id)")
+    if msg.type not in COMPONENT_TYPES:
+        raise MessageError(f"Tipo inválido: {msg.type}")
+
+
+class GetRequest(Message):
+    device: Optional[str] = None
+    type: Optional[str] = None
+    id: Optional[int] = None
+    # Segundos: si el router tiene una lectura más reciente, responde él
+    max_age: Optional[NonNegFloat] = None
+
+    def __post_init__(self):
+        _check_component(self, "Payload incompleto")
+
+
+class SetRequest(Message):
+    device: Optional[str] = None
+    type: Optional[str] = None
+    id: Optional[int] = None
+    state: Any = None
+    enable: Any = None
+    command: Any = None
+    speed: Any = None
+
+    def __post_init__(self):
+        _check_component(self, "Petición incompleta")
+
+        # Validación mínima del comando según tipo
+        if self.type == "sensor" and self.enable is None:
+            raise MessageError("Petición incompleta (sensor sin enable)")
+        if self.type == "actuator" and self.state is None and self.command is None:
+            raise MessageError("Petición incompleta (actuator sin state/command)")
+
+
+def _parse_time(raw, field):
+    """Fecha ISO ('2024-05-01T10:00:00') o epoch en segundos."""
+    if raw is None or raw == "":
+        return None
+    try:
+        if isinstance(raw, (int, float)) and not isinstance(raw, bool):
+            return datetime.fromtimestamp(raw)
+        value = datetime.fromisoformat(str(raw).strip())
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise MessageError(f"{field} inválido: {raw}") from None
+    # Con zona horaria: a hora local (las columnas DATETIME no la guardan)
+    if value.tzinfo is not None:
+        value = value.astimezone().replace(tzinfo=None)
+    return value
+
+
+HISTORY_RESOLUTIONS = ("auto", "raw", "1m", "1h")
+ALERT_ORDERS = ("severity", "time")
+
+
+def _parse_severity(raw):
+    """'high' o ['high', 'critical'] -> tupla de gravedades válidas."""
+    if raw is None or raw == "":
+        return None
+    values = raw if isinstance(raw, (list, tuple)) else [raw]
+    severities = tuple(dict.fromkeys(str(v).strip().lower() for v in values))
+    unknown = [v for v in severities if v not in SEVERITY_RANK]
+    if unknown:
+        raise MessageError(f"severity inválida: {unknown}")
+    return severities
+
+
+def _parse_before(raw):
+    """Cursor de paginación por clave: enteros separados por comas."""
+    if raw is None or raw == "":
+        return None
+    try:
+        return tuple(int(part) for part in str(raw).split(","))
+    except ValueError:
+        raise MessageError(f"before inválido: {raw}") from None
+
+
+class SelectRequest(Message):
+    request: Optional[str] = None
+    device: Optional[str] = None
+    id: Optional[int] = None
+    limit: Any = 10
+    # Modo por lotes (None = una publicación por fila)
+    page_size: Optional[NonNegInt] = None
+    batch: Any = False
+    cursor: Optional[NonNegInt] = None
+    max_pages: Optional[NonNegInt] = None
+    # Sincronización delta (since=<seq> del último volcado + su epoch)
+    since: Optional[NonNegInt] = None
+    epoch: Optional[str] = None
+    # Histórico de un sensor (request='history'): rango [start, end) y nivel
+    start: Any = msgspec.field(default=None, name="from")
+    end: Any = msgspec.field(default=None, name="to")
+    resolution: Optional[str] = "auto"
+    # Filtros de alertas y paginación por clave ('before' = cursor 'next')
+    severity: Any = None
+    comp_type: Optional[str] = msgspec.field(default=None, name="type")
+    order: Optional[str] = "severity"
+    before: Any = None
+
+    def __post_init__(self):
+        if not self.request:
+            raise MessageError("Falta campo 'request'")
+
+        self.resolution = str(self.resolution or "auto").strip().lower()
+        if self.resolution not in HISTORY_RESOLUTIONS:
+            raise MessageError(f"resolution inválida: {self.resolution}")
+
+        self.order = str(self.order or "severity").strip().lower()
+        if self.order not in ALERT_ORDERS:
+            raise MessageError(f"order inválido: {self.order}")
+
+        self.comp_type = _parse_type(self.comp_type)
+        if self.comp_type and self.comp_type not in COMPONENT_TYPES:
+            raise MessageError(f"Tipo inválido: {self.comp_type}")
+
+        if self.page_size is None and self.batch:
+            self.page_size = SELECT_CFG["page_size"]
+        if self.page_size:
+            self.page_size = min(self.page_size, SELECT_CFG["max_page_size"])
+        self.page_size = self.page_size or None
+
+        self.start = _parse_time(self.start, "from")
+        self.end = _parse_time(self.end, "to")
+        self.severity = _parse_severity(self.severity)
+        self.before = _parse_before(self.before)
+
+
+DIAG_ACTIONS = ("start", "stop", "status")
+
+
+class DiagRequest(Message):
+    action: Any = None
+    duration_s: Optional[NonNegInt] = None
+    interval_ms: Optional[NonNegInt] = None
+    top: Optional[NonNegInt] = None
+    # Incluir hilos bloqueados en esperas (por defecto solo CPU)
+    idle: Any = False
+
+    def __post_init__(self):
+        action = str(self.action or "").strip().lower()
+        if action not in DIAG_ACTIONS:
+            raise MessageError(f"action inválida: {self.action}")
+        self.action = action
+        self.idle = bool(self.idle)
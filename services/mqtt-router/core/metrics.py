@@ -0,0 +1,291 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_CFG, logger
+
+
+# Límites (segundos) de los histogramas de latencia
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monótono con etiquetas (inc(route="...")."""
+
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name, _labels(self.labels, key), value
+
+
+class Histogram:
+    """Histograma acumulado por etiquetas (observe(segundos, route="..."))."""
+
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # etiquetas -> [cuentas por bucket (+Inf al final), suma, nº]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(e[0]), e[1], e[2]) for key, e in self._values.items()}
+
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float("inf")), counts):
+                cumulative += n
+                yield (
+                    f"{self.name}_bucket",
+                    _labels((*self.labels, "le"), (*key, _number(bound))),
+                    cumulative,
+                )
+            yield f"{self.name}_sum", _labels(self.labels, key), total
+            yield f"{self.name}_count", _labels(self.labels, key), count
+
+
+class Collected:
+    """
+    Métrica leída al servir /metrics desde una función que devuelve
+    {tupla_de_etiquetas: valor} (o un número si no hay etiquetas).
+    Sirve para exponer contadores que ya llevan otros módulos.
+    """
+
+    def __init__(self, name, doc, fn, labels=(), kind="gauge"):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.labels = tuple(labels)
+        self.kind = kind
+
+    def samples(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            if not isinstance(key, tuple):
+                key = (key,)
+            yield self.name, _labels(self.labels, key), value
+
+
+class MetricsRegistry:
+    """Conjunto de métricas y su exposición en formato de texto de Prometheus."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def collect(self, name, doc, fn, labels=(), kind="gauge"):
+        """Registra (o sustituye) una métrica leída de 'fn' en cada scrape."""
+        metric = Collected(name, doc, fn, labels, kind)
+        with self._lock:
+            self._metrics[name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                logger.error(f"[METRICS] Error leyendo {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.doc}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Registro compartido: los módulos instrumentados crean aquí sus métricas
+metrics = MetricsRegistry()
+
+
+# ==========================================================
+#  MÉTRICAS DEL ROUTER
+# ==========================================================
+MESSAGES = metrics.counter(
+    "mqtt_router_messages_total", "Mensajes MQTT recibidos por ruta", ("route",)
+)
+HANDLER_SECONDS = metrics.histogram(
+    "mqtt_router_handler_seconds", "Duración de los handlers por ruta", ("route",)
+)
+DB_QUERY_SECONDS = metrics.histogram(
+    "mqtt_router_db_query_seconds", "Duración de las consultas de DBManager.execute", ("op",)
+)
+DB_COMMIT_SECONDS = metrics.histogram(
+    "mqtt_router_db_commit_seconds", "Duración de los commits de MariaDB"
+)
+DB_ERRORS = metrics.counter(
+    "mqtt_router_db_errors_total", "Errores de MariaDB por tipo", ("kind",)
+)
+PUBLISHED = metrics.counter(
+    "mqtt_router_published_total", "Publicaciones MQTT por familia de topic", ("family",)
+)
+MQTT_CONNECTS = metrics.counter(
+    "mqtt_router_mqtt_connects_total", "Conexiones al broker (la primera y las reconexiones)"
+)
+MQTT_DISCONNECTS = metrics.counter(
+    "mqtt_router_mqtt_disconnects_total", "Desconexiones del broker"
+)
+
+
+def query_op(query):
+    """'select', 'insert', 'update', 'delete'... (primera palabra de la sentencia)."""
+    head = query.lstrip().split(None, 1)
+    return head[0].lower() if head else "other"
+
+
+def topic_family(topic):
+    """system/response/... -> 'system/response'; get/<device>/... -> 'get'."""
+    parts = topic.split("/", 2)
+    if parts[0] == "system" and len(parts) > 1:
+        return f"system/{parts[1]}"
+    return parts[0]
+
+
+def instrument_publish(client):
+    """Envuelve client.publish para contar las publicaciones por familia de topic."""
+    publish = client.publish
+
+    def counted(topic, *args, **kwargs):
+        PUBLISHED.inc(family=topic_family(topic))
+        return publish(topic, *args, **kwargs)
+
+    client.publish = counted
+    return client
+
+
+# ==========================================================
+#  SERVIDOR HTTP
+# ==========================================================
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        # Sin una línea de log por scrape
+        pass
+
+
+class MetricsServer:
+    """Expone /metrics en METRICS_HOST:METRICS_PORT (METRICS_PORT=0 lo desactiva)."""
+
+    def __init__(self, host=None, port=None):
+        self.host = host if host is not None else METRICS_CFG["host"]
+        self.port = port if port is not None else METRICS_CFG["port"]
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        if self._server is not None or not self.port:
+            return
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        except OSError as e:
+            logger.error(f"[METRICS] No se pudo abrir {self.host}:{self.port}: {e}")
+            return
+
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics-http", daemon=True
+        )
+        self._thread.start()
+        logger.info(f"[METRICS] Exponiendo /metrics en {self.host}:{self.port}")
+
+    def stop(self):
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join(5)
+        self._server = None
+        self._thread = None
+
+
+# Instancia compartida (se arranca desde listener.py)
+metrics_server = MetricsServer()
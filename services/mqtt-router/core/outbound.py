@@ -0,0 +1,194 @@
+import threading
+import time
+from collections import deque
+from config import OUTBOUND_CFG, logger
+from core.stats import summarize
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "queue")
+
+    def __init__(self, burst):
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # (client, topic, payload, qos, on_sent, encolado_monotonic)
+        self.queue = deque()
+
+
+class OutboundScheduler:
+    """
+    Planificador de publicaciones hacia los ESP32 (get/<device>/#, set/<device>/#).
+
+    Cada dispositivo tiene un token bucket ('rate' mensajes/s, ráfaga 'burst').
+    Si hay token y nada en cola, la publicación sale al momento desde el
+    worker. Si no, se encola y un hilo la envía en cuanto hay token,
+    recorriendo los dispositivos por turnos (round-robin). Así un dispositivo
+    saturado por una escena no retrasa a los demás.
+
+    Se mide el retardo en cola de cada publicación para dimensionar rate/burst.
+    """
+
+    def __init__(self, rate=None, burst=None, max_queue=None):
+        self.rate = float(rate or OUTBOUND_CFG["rate"])
+        self.burst = max(1.0, float(burst or OUTBOUND_CFG["burst"]))
+        self.max_queue = int(max_queue or OUTBOUND_CFG["max_queue"])
+
+        self._cond = threading.Condition()
+        # device -> _Bucket
+        self._buckets = {}
+        # Dispositivos con cola pendiente, en orden de turno
+        self._ready = deque()
+
+        self._delays = deque(maxlen=OUTBOUND_CFG["samples"])
+        self.sent = 0
+        self.delayed = 0
+        self.dropped = 0
+
+        self._running = False
+        self._thread = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="outbound", daemon=True)
+        self._thread.start()
+        logger.info(
+            f"[OUTBOUND] Planificador iniciado ({self.rate}/s por dispositivo, ráfaga {self.burst:g})"
+        )
+
+    def stop(self, timeout=5.0):
+        """Detiene el hilo tras intentar vaciar lo encolado durante 'timeout'."""
+        if self._thread is None:
+            return
+
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._ready and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self._running = False
+            self._cond.notify_all()
+
+        self._thread.join(timeout)
+        self._thread = None
+
+    # ==========================================================
+    #  PUBLICACIÓN
+    # ==========================================================
+    def publish(self, client, device, topic, payload, qos=1, on_sent=None):
+        """
+        Publica (o encola) hacia un dispositivo. on_sent() se llama justo
+        después de publicar. Devuelve "sent", "queued" o "dropped".
+        """
+        now = time.monotonic()
+
+        with self._cond:
+            bucket = self._buckets.get(device)
+            if bucket is None:
+                bucket = self._buckets[device] = _Bucket(self.burst)
+
+            if not bucket.queue and self._take(bucket, now):
+                immediate = True
+            elif len(bucket.queue) >= self.max_queue:
+                self.dropped += 1
+                logger.warning(
+                    f"[OUTBOUND] Cola de {device} llena ({self.max_queue}); se descarta {topic}"
+                )
+                return "dropped"
+            else:
+                immediate = False
+                if not bucket.queue:
+                    self._ready.append(device)
+                bucket.queue.append((client, topic, payload, qos, on_sent, now))
+                self.delayed += 1
+                self._cond.notify()
+
+        if immediate:
+            self._send(client, topic, payload, qos, on_sent, now)
+            return "sent"
+        return "queued"
+
+    def _take(self, bucket, now):
+        """Repone tokens según el tiempo transcurrido y consume uno si hay."""
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        if bucket.tokens >= 1.0:
+            bucket.tokens -= 1.0
+            return True
+        return False
+
+    def _send(self, client, topic, payload, qos, on_sent, queued_at):
+        delay_ms = (time.monotonic() - queued_at) * 1000.0
+        try:
+            client.publish(topic, payload, qos=qos)
+            if on_sent is not None:
+                on_sent()
+        except Exception as e:
+            logger.error(f"[OUTBOUND] Error publicando {topic}: {e}")
+            return
+
+        with self._cond:
+            self.sent += 1
+            self._delays.append(delay_ms)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                item, wait = self._next(time.monotonic())
+                while item is None:
+                    if not self._running:
+                        return
+                    self._cond.wait(wait)
+                    item, wait = self._next(time.monotonic())
+
+            self._send(*item)
+
+    def _next(self, now):
+        """
+        Siguiente publicación en turno con token disponible (se llama con el
+        lock tomado). Devuelve (item, None) o (None, segundos_hasta_el_próximo_token).
+        """
+        wait = None
+        for _ in range(len(self._ready)):
+            device = self._ready.popleft()
+            bucket = self._buckets[device]
+
+            if self._take(bucket, now):
+                item = bucket.queue.popleft()
+                # El dispositivo vuelve al final del turno si le queda cola
+                if bucket.queue:
+                    self._ready.append(device)
+                self._cond.notify_all()
+                return item, None
+
+            self._ready.append(device)
+            missing = (1.0 - bucket.tokens) / self.rate
+            wait = missing if wait is None else min(wait, missing)
+
+        return None, wait
+
+    # ==========================================================
+    #  MÉTRICAS
+    # ==========================================================
+    def queue_depths(self):
+        with self._cond:
+            return {device: len(b.queue) for device, b in self._buckets.items() if b.queue}
+
+    def stats(self):
+        with self._cond:
+            delays = list(self._delays)
+            return {
+                "sent": self.sent,
+                "delayed": self.delayed,
+                "dropped": self.dropped,
+                "queued": {device: len(b.queue) for device, b in self._buckets.items() if b.queue},
+                "queue_delay_ms": summarize(delays),
+            }
+
+
+# Instancia compartida por esp_get/esp_set (el hilo se arranca desde listener.py)
+outbound = OutboundScheduler()
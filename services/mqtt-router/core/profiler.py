@@ -0,0 +1,229 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from config import DIAG_CFG, logger
+
+
+# Hojas de pila de un hilo bloqueado esperando (no consumen CPU)
+IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("socketserver.py", "serve_forever"),
+    ("queue.py", "get"),
+    ("client.py", "_loop"),     # paho: select() del bucle de red
+}
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Perfilado de CPU bajo demanda por muestreo de pilas.
+
+    Un hilo lee sys._current_frames() cada 'interval_ms' y cuenta la pila
+    de cada hilo del proceso (workers del dispatcher, paho, escritores...).
+    A diferencia de cProfile, ve todos los hilos y no instrumenta cada
+    llamada, por lo que se puede usar con el router en producción.
+
+    Al terminar (duración cumplida o stop()) escribe las pilas en formato
+    "collapsed" (una línea 'hilo;f1;f2;... N', compatible con flamegraph.pl
+    y speedscope) en DIAG_CFG["dir"] y entrega el resumen a 'on_done'.
+    """
+
+    def __init__(self, out_dir=None, max_duration_s=None):
+        self.out_dir = out_dir or DIAG_CFG["dir"]
+        self.max_duration_s = max_duration_s or DIAG_CFG["max_duration_s"]
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._session = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self, duration_s=None, interval_ms=None, top=None, idle=False, on_done=None):
+        """
+        Inicia una sesión acotada a max_duration_s. Devuelve su descripción,
+        o None si ya hay otra en curso.
+        """
+        duration_s = min(
+            float(duration_s or DIAG_CFG["duration_s"]), float(self.max_duration_s)
+        )
+        interval_ms = max(1, int(interval_ms or DIAG_CFG["interval_ms"]))
+
+        with self._lock:
+            if self._thread is not None:
+                return None
+
+            self._stop.clear()
+            self._session = {
+                "started_at": datetime.now(),
+                "duration_s": duration_s,
+                "interval_ms": interval_ms,
+                "top": max(1, int(top or DIAG_CFG["top"])),
+                "idle": bool(idle),
+            }
+            self._thread = threading.Thread(
+                target=self._run, args=(self._session, on_done), name="profiler", daemon=True
+            )
+            self._thread.start()
+            session = self.status()
+
+        logger.info(
+            f"[DIAG] Perfilado iniciado ({duration_s}s, muestra cada {interval_ms} ms)"
+        )
+        return session
+
+    def stop(self, wait=True):
+        """
+        Termina la sesión en curso antes de tiempo; el hilo del perfilador
+        escribe el fichero y entrega el resultado igualmente. Con wait=False
+        solo se avisa (para no bloquear un worker del dispatcher).
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return False
+
+        self._stop.set()
+        if wait:
+            thread.join(10)
+        return True
+
+    def status(self):
+        session = self._session
+        if self._thread is None or session is None:
+            return {"state": "idle"}
+
+        elapsed = (datetime.now() - session["started_at"]).total_seconds()
+        return {
+            "state": "running",
+            "started_at": session["started_at"].strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed_s": round(elapsed, 1),
+            "duration_s": session["duration_s"],
+            "interval_ms": session["interval_ms"],
+        }
+
+    # ==========================================================
+    #  MUESTREO
+    # ==========================================================
+    def _run(self, session, on_done):
+        stacks = Counter()
+        samples = 0
+        own = threading.get_ident()
+        interval = session["interval_ms"] / 1000
+        started = time.monotonic()
+        deadline = started + session["duration_s"]
+
+        try:
+            while not self._stop.is_set() and time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = self._stack(frame, session["idle"])
+                    if stack is not None:
+                        stacks[(names.get(ident, str(ident)), stack)] += 1
+                samples += 1
+                self._stop.wait(interval)
+
+            result = self._summarize(session, stacks, samples, time.monotonic() - started)
+            try:
+                result["file"] = self._write(session, stacks)
+            except OSError as e:
+                # Sin volumen escribible el resumen se publica igualmente
+                logger.error(f"[DIAG] No se pudo escribir el perfil en {self.out_dir}: {e}")
+                result["file"] = None
+
+        except Exception as e:
+            logger.error(f"[DIAG] Error durante el perfilado: {e}")
+            result = {"state": "error", "error": str(e)}
+
+        finally:
+            with self._lock:
+                self._thread = None
+                self._session = None
+
+        logger.info(
+            f"[DIAG] Perfilado terminado: {result.get('samples', 0)} muestras -> {result.get('file')}"
+        )
+        if on_done is not None:
+            try:
+                on_done(result)
+            except Exception as e:
+                logger.error(f"[DIAG] Error entregando el resultado: {e}")
+
+    @staticmethod
+    def _stack(frame, idle):
+        """Pila del hilo (raíz primero) o None si está bloqueado y no se piden esperas."""
+        code = frame.f_code
+        if not idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES:
+            return None
+
+        labels = []
+        while frame is not None:
+            labels.append(_frame_label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return tuple(labels)
+
+    # ==========================================================
+    #  RESULTADO
+    # ==========================================================
+    @staticmethod
+    def _summarize(session, stacks, samples, elapsed):
+        """Top-N de funciones por muestras propias (hoja) e inclusivas (en la pila)."""
+        own = Counter()
+        inclusive = Counter()
+        threads = Counter()
+        total = 0
+
+        for (thread, stack), count in stacks.items():
+            total += count
+            threads[thread] += count
+            own[stack[-1]] += count
+            for label in set(stack):
+                inclusive[label] += count
+
+        def top(counter):
+            return [
+                {"function": label, "samples": n, "pct": round(100 * n / total, 1)}
+                for label, n in counter.most_common(session["top"])
+            ]
+
+        return {
+            "state": "done",
+            "started_at": session["started_at"].strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed_s": round(elapsed, 1),
+            "interval_ms": session["interval_ms"],
+            "samples": samples,
+            "stacks": total,
+            "threads": dict(threads.most_common()),
+            "self": top(own) if total else [],
+            "inclusive": top(inclusive) if total else [],
+        }
+
+    def _write(self, session, stacks):
+        """Escribe el fichero .folded (escritura atómica) y devuelve su ruta."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(
+            self.out_dir, f"mqtt-router-{session['started_at']:%Y%m%d-%H%M%S}.folded"
+        )
+        tmp = f"{path}.tmp"
+
+        with open(tmp, "w", encoding="utf-8") as f:
+            for (thread, stack), count in stacks.most_common():
+                f.write(f"{';'.join((thread, *stack))} {count}\n")
+        os.replace(tmp, path)
+        return path
+
+
+# Instancia compartida por handlers/system_diag.py
+profiler = SamplingProfiler()
@@ -0,0 +1,238 @@
+import threading
+import time
+from config import REGISTRY_CFG, logger
+
+
+class ComponentRegistry:
+    """
+    Registro en memoria de dispositivos y componentes ya existentes en BBDD.
+
+    Se precarga desde devices/sensors/actuators al arrancar y se actualiza
+    con cada alta (announce, ensure_*). Permite omitir los upserts de
+    ensure_device/ensure_component para lo que el router ya conoce y validar
+    system/get y system/set sin leer la BBDD (lookup()).
+
+    invalidate() marca un dispositivo (o todo el registro) como obsoleto: la
+    siguiente consulta sobre él se relee de BBDD una sola vez.
+
+    Un fallo de lookup() se confirma con una SELECT de una fila (hay altas
+    que no pasan por el registro, p. ej. filas creadas fuera del router) y
+    el resultado se cachea: el positivo sin caducidad, el negativo durante
+    'miss_ttl_s' para no consultar la BBDD en cada petición inválida.
+    """
+
+    def __init__(self, miss_ttl_s=None):
+        self.miss_ttl_s = miss_ttl_s if miss_ttl_s is not None else REGISTRY_CFG["miss_ttl_s"]
+        self._lock = threading.Lock()
+        self._devices = set()
+        # (comp_type, device, id) -> {"name": ..., "location": ...}
+        self._components = {}
+        # Dispositivos invalidados pendientes de releer
+        self._stale = set()
+        # device o (comp_type, device, id) -> monotonic de caducidad del fallo
+        self._misses = {}
+        self.warmed = False
+
+    def warm(self, db):
+        """Carga el registro desde BBDD. Devuelve False si la lectura falla."""
+        devices = db.execute("SELECT device_name FROM devices")
+        sensors = db.execute("SELECT id, device_name, name, location FROM sensors")
+        actuators = db.execute("SELECT id, device_name, name, location FROM actuators")
+
+        if devices is None or sensors is None or actuators is None:
+            logger.warning("[REGISTRY] No se pudo precargar el registro desde BBDD")
+            return False
+
+        with self._lock:
+            self._devices = {row["device_name"] for row in devices}
+            self._components = {}
+            for comp_type, rows in (("sensor", sensors), ("actuator", actuators)):
+                for row in rows:
+                    self._components[(comp_type, row["device_name"], int(row["id"]))] = {
+                        "name": row.get("name"),
+                        "location": row.get("location"),
+                    }
+            self._stale.clear()
+            self._misses.clear()
+            self.warmed = True
+
+        logger.info(
+            f"[REGISTRY] Precargados {len(self._devices)} dispositivos y "
+            f"{len(self._components)} componentes"
+        )
+        return True
+
+    # ==========================================================
+    #  DISPOSITIVOS
+    # ==========================================================
+    def has_device(self, device):
+        with self._lock:
+            return device in self._devices
+
+    def add_device(self, device):
+        with self._lock:
+            self._devices.add(device)
+            self._misses.pop(device, None)
+
+    # ==========================================================
+    #  COMPONENTES
+    # ==========================================================
+    def get_component(self, comp_type, device, comp_id):
+        with self._lock:
+            info = self._components.get((comp_type, device, int(comp_id)))
+            return dict(info) if info is not None else None
+
+    def has_component(self, comp_type, device, comp_id, name=None, location=None):
+        """
+        True si el componente es conocido y no hay nada nuevo que persistir:
+        un name/location recibido solo rellena huecos (como ensure_component).
+        """
+        with self._lock:
+            info = self._components.get((comp_type, device, int(comp_id)))
+
+        if info is None:
+            return False
+        if name is not None and info["name"] is None:
+            return False
+        if location is not None and info["location"] is None:
+            return False
+        return True
+
+    def add_component(self, comp_type, device, comp_id, name=None, location=None, overwrite=False):
+        key = (comp_type, device, int(comp_id))
+        with self._lock:
+            self._devices.add(device)
+            self._misses.pop(device, None)
+            self._misses.pop(key, None)
+            info = self._components.setdefault(key, {"name": None, "location": None})
+            if name is not None and (overwrite or info["name"] is None):
+                info["name"] = name
+            if location is not None and (overwrite or info["location"] is None):
+                info["location"] = location
+
+    def invalidate(self, device=None):
+        """
+        Olvida un dispositivo (y sus componentes) o todo el registro.
+        La próxima consulta lookup() lo relee de BBDD.
+        """
+        with self._lock:
+            if device is None:
+                self._devices.clear()
+                self._components.clear()
+                self._stale.clear()
+                self._misses.clear()
+                self.warmed = False
+                return
+
+            self._forget(device)
+            self._stale.add(device)
+
+    def _forget(self, device):
+        self._devices.discard(device)
+        for key in [k for k in self._components if k[1] == device]:
+            del self._components[key]
+        self._misses.pop(device, None)
+        for key in [k for k in self._misses if isinstance(k, tuple) and k[1] == device]:
+            del self._misses[key]
+
+    def reload_device(self, db, device):
+        """Relee de BBDD un dispositivo y sus componentes. False si la lectura falla."""
+        devices = db.execute("SELECT device_name FROM devices WHERE device_name=%s", (device,))
+        sensors = db.execute(
+            "SELECT id, name, location FROM sensors WHERE device_name=%s", (device,)
+        )
+        actuators = db.execute(
+            "SELECT id, name, location FROM actuators WHERE device_name=%s", (device,)
+        )
+
+        if devices is None or sensors is None or actuators is None:
+            logger.warning(f"[REGISTRY] No se pudo releer el dispositivo {device}")
+            return False
+
+        with self._lock:
+            self._forget(device)
+            if devices:
+                self._devices.add(device)
+            for comp_type, rows in (("sensor", sensors), ("actuator", actuators)):
+                for row in rows:
+                    self._components[(comp_type, device, int(row["id"]))] = {
+                        "name": row.get("name"),
+                        "location": row.get("location"),
+                    }
+            self._stale.discard(device)
+
+        logger.info(f"[REGISTRY] Dispositivo {device} releído desde BBDD")
+        return True
+
+    # ==========================================================
+    #  VALIDACIÓN (system/get, system/set)
+    # ==========================================================
+    def _ensure_fresh(self, db, device):
+        """Precarga o relectura pendiente. False si hay que ir a BBDD."""
+        if not self.warmed and not self.warm(db):
+            return False
+
+        with self._lock:
+            stale = device in self._stale
+        return not stale or self.reload_device(db, device)
+
+    def _missed(self, key):
+        """True si 'key' se buscó en BBDD hace menos de miss_ttl_s sin encontrarlo."""
+        with self._lock:
+            expires = self._misses.get(key)
+            if expires is None:
+                return False
+            if time.monotonic() < expires:
+                return True
+            del self._misses[key]
+            return False
+
+    def _miss(self, key):
+        with self._lock:
+            self._misses[key] = time.monotonic() + self.miss_ttl_s
+
+    def lookup_device(self, db, device):
+        """True si el dispositivo existe (memoria; BBDD solo si no está en el registro)."""
+        cached = self._ensure_fresh(db, device)
+        if cached and (self.has_device(device) or self._missed(device)):
+            return self.has_device(device)
+
+        found = db.execute(
+            "SELECT device_name FROM devices WHERE device_name=%s", (device,)
+        )
+        if found:
+            self.add_device(device)
+            return True
+        if cached and found is not None:
+            self._miss(device)
+        return False
+
+    def lookup(self, db, comp_type, device, comp_id):
+        """
+        {"name", "location"} del componente o None si no existe.
+        Sin lecturas de BBDD salvo en frío, tras invalidate() o si el
+        componente no está en el registro.
+        """
+        key = (comp_type, device, int(comp_id))
+        cached = self._ensure_fresh(db, device)
+        if cached:
+            info = self.get_component(comp_type, device, comp_id)
+            if info is not None or self._missed(key):
+                return info
+
+        result = db.execute(
+            f"SELECT name, location FROM {comp_type}s WHERE device_name=%s AND id=%s",
+            (device, comp_id)
+        )
+        if not result:
+            if cached and result is not None:
+                self._miss(key)
+            return None
+
+        info = {"name": result[0].get("name"), "location": result[0].get("location")}
+        self.add_component(comp_type, device, comp_id, info["name"], info["location"])
+        return info
+
+
+# Instancia compartida (se precarga desde listener.py)
+registry = ComponentRegistry()
@@ -0,0 +1,164 @@
+from config import logger
+
+
+# ==========================================================
+#  CONVERSORES DE CAPTURAS
+# ==========================================================
+def _to_str(segment):
+    return segment if segment else None
+
+
+def _to_int(segment):
+    try:
+        return int(segment)
+    except ValueError:
+        return None
+
+
+def _to_comp(segment):
+    return segment if segment in ("sensor", "actuator") else None
+
+
+CONVERTERS = {
+    "str": _to_str,
+    "int": _to_int,
+    "comp": _to_comp,
+}
+
+
+class Route:
+    """
+    Resultado de resolver un topic: handler + parámetros ya convertidos.
+    Los parámetros son accesibles como atributos (route.device, route.comp_id...).
+    'message' es la clase de core.messages en la que se decodifica el
+    payload (None = dict).
+    """
+
+    __slots__ = ("topic", "pattern", "handler", "message", "params")
+
+    def __init__(self, topic, pattern, handler, params, message=None):
+        self.topic = topic
+        self.pattern = pattern
+        self.handler = handler
+        self.message = message
+        self.params = params
+
+    def __getattr__(self, name):
+        try:
+            return self.params[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def get(self, name, default=None):
+        return self.params.get(name, default)
+
+    def __repr__(self):
+        return f"Route({self.pattern!r}, {self.params!r})"
+
+
+class _Node:
+    __slots__ = ("literals", "captures", "leaf", "tail")
+
+    def __init__(self):
+        self.literals = {}      # segmento -> _Node
+        self.captures = []      # [(nombre, conversor, _Node)]
+        self.leaf = None        # (pattern, handler, message) si el topic termina aquí
+        self.tail = None        # (pattern, handler, message) para '#' (0..n niveles extra)
+
+
+class TopicRouter:
+    """
+    Tabla de rutas compilada en un trie por segmentos de topic.
+
+    Patrones:
+      - segmento literal:       announce
+      - captura tipada:         {device}  {comp_id:int}  {comp_type:comp}
+      - comodín final:          # (acepta cero o más niveles adicionales)
+
+    resolve() recorre el topic una sola vez y devuelve un Route con los
+    parámetros convertidos y validados, o None si no hay ruta.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self.roots = set()
+
+    def add(self, pattern, handler, message=None):
+        node = self._root
+        segments = pattern.split("/")
+
+        for idx, segment in enumerate(segments):
+            if segment == "#":
+                if idx != len(segments) - 1:
+                    raise ValueError(f"'#' solo puede ir al final: {pattern}")
+                node.tail = (pattern, handler, message)
+                break
+
+            if segment.startswith("{") and segment.endswith("}"):
+                name, _, conv = segment[1:-1].partition(":")
+                converter = CONVERTERS[conv or "str"]
+                for cap_name, cap_conv, child in node.captures:
+                    if cap_name == name and cap_conv is converter:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.captures.append((name, converter, child))
+                    node = child
+            else:
+                node = node.literals.setdefault(segment, _Node())
+        else:
+            node.leaf = (pattern, handler, message)
+
+        self.roots.add(segments[0])
+        return self
+
+    def resolve(self, topic):
+        parts = topic.split("/")
+        params = {}
+        found = self._match(self._root, parts, 0, params)
+        if found is None:
+            return None
+
+        pattern, handler, message = found
+        return Route(topic, pattern, handler, params, message)
+
+    def _match(self, node, parts, idx, params):
+        if idx == len(parts):
+            if node.leaf is not None:
+                return node.leaf
+            return node.tail
+
+        segment = parts[idx]
+
+        # 1) Literal exacto
+        child = node.literals.get(segment)
+        if child is not None:
+            found = self._match(child, parts, idx + 1, params)
+            if found is not None:
+                return found
+
+        # 2) Capturas tipadas
+        for name, converter, child in node.captures:
+            value = converter(segment)
+            if value is None:
+                continue
+            params[name] = value
+            found = self._match(child, parts, idx + 1, params)
+            if found is not None:
+                return found
+            del params[name]
+
+        # 3) Comodín final
+        return node.tail
+
+    def is_known_root(self, topic):
+        """True si el primer nivel del topic corresponde a alguna ruta."""
+        return topic.split("/", 1)[0] in self.roots
+
+
+def log_unrouted(router, topic):
+    if router.is_known_root(topic):
+        logger.warning(f"[MQTT] Tópico inválido o sin ruta: {topic}")
+    else:
+        logger.debug(f"[MQTT] No hay handler para {topic}")
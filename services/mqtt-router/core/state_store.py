@@ -0,0 +1,243 @@
+import threading
+import time
+from datetime import datetime
+from config import logger
+from core.changelog import changelog, TABLES, table_for
+
+
+# Columnas (y valores por defecto de init.sql) de cada tabla de inventario
+COLUMNS = {
+    "devices": {"device_name": None, "last_seen": None},
+    "sensors": {
+        "id": None, "device_name": None, "name": None, "location": None,
+        "enabled": 1, "value": None, "unit": None, "last_seen": None,
+    },
+    "actuators": {
+        "id": None, "device_name": None, "name": None, "location": None,
+        "state": 0, "last_seen": None,
+    },
+}
+
+ORDER = {
+    "devices": lambda row: row["device_name"],
+    "sensors": lambda row: (row["device_name"], row["id"]),
+    "actuators": lambda row: (row["device_name"], row["id"]),
+}
+
+
+def now():
+    """Marca de tiempo con la precisión de las columnas TIMESTAMP."""
+    return datetime.now().replace(microsecond=0)
+
+
+class StateStore:
+    """
+    Vista materializada en memoria de devices, sensors y actuators.
+
+    El router realiza todas las escrituras de estas tablas, así que los
+    handlers (y los escritores en lote) aplican aquí cada cambio tras su
+    commit. system/select sirve el inventario desde memoria; solo se lee
+    MariaDB en frío (antes de la precarga o si esta falló).
+
+    Cada cambio aplicado se anota también en el changelog (since=<seq>).
+
+    Aparte, observe()/fresh() guardan la última lectura recibida de cada
+    componente en el momento de llegar (antes del volcado a BBDD), para
+    responder system/get con max_age sin consultar al ESP32.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # table -> {(device, id|None): fila}
+        self._rows = {table: {} for table in TABLES}
+        # (comp_type, device, id) -> (monotonic, {campos de la respuesta})
+        self._observed = {}
+        self.warmed = False
+
+    def warm(self, db):
+        """
+        Carga el estado completo desde BBDD. Devuelve False si la lectura falla.
+        Usado de nuevo en caliente (invalidación completa), anota en el
+        changelog las filas que cambian respecto a memoria.
+        """
+        # Las SELECT se hacen fuera del lock: los workers siguen leyendo
+        _, since = changelog.current()
+        loaded = {}
+        for table in TABLES:
+            rows = db.execute(f"SELECT * FROM {table}")
+            if rows is None:
+                logger.warning("[STATE] No se pudo precargar el estado desde BBDD")
+                return False
+            loaded[table] = {self._key(table, row): row for row in rows}
+
+        with self._lock:
+            self._merge(loaded, since, record=self.warmed)
+            self.warmed = True
+
+        logger.info(
+            "[STATE] Precargados "
+            + ", ".join(f"{len(loaded[t])} {t}" for t in TABLES)
+        )
+        return True
+
+    def reload_device(self, db, device):
+        """
+        Relee de BBDD las filas de un dispositivo (tras una invalidación
+        explícita). Las filas que ya no existen se anotan como 'delete'.
+        """
+        _, since = changelog.current()
+        loaded = {}
+        for table in TABLES:
+            rows = db.execute(f"SELECT * FROM {table} WHERE device_name=%s", (device,))
+            if rows is None:
+                logger.warning(f"[STATE] No se pudo releer el dispositivo {device}")
+                return False
+            loaded[table] = {self._key(table, row): row for row in rows}
+
+        with self._lock:
+            self._merge(loaded, since, device=device)
+        return True
+
+    def _merge(self, loaded, since, device=None, record=True):
+        """
+        Sustituye las filas (todas o las de 'device') por las leídas de BBDD
+        (se llama con el lock). Las filas cambiadas en memoria después de
+        'since' son más recientes que la lectura y se conservan. Con
+        'record', las diferencias se anotan en el changelog.
+        """
+        touched = {
+            (table, (dev, comp_id))
+            for _, table, dev, comp_id, _ in changelog.since(since)
+        }
+
+        for table in TABLES:
+            rows = self._rows[table]
+            fresh = loaded[table]
+            current = {k: v for k, v in rows.items() if device is None or k[0] == device}
+
+            for key, row in current.items():
+                if (table, key) in touched:
+                    fresh[key] = row
+
+            for key in current.keys() - fresh.keys():
+                del rows[key]
+                if record:
+                    changelog.record(table, key[0], key[1], op="delete")
+
+            for key, row in fresh.items():
+                if record and current.get(key) != row:
+                    changelog.record(table, key[0], key[1])
+                rows[key] = row
+
+    @staticmethod
+    def _key(table, row):
+        if table == "devices":
+            return (row["device_name"], None)
+        return (row["device_name"], int(row["id"]))
+
+    # ==========================================================
+    #  ESCRITURA (llamar tras el commit)
+    # ==========================================================
+    def upsert(self, table, device, comp_id=None, fill=None, **fields):
+        """
+        Crea o actualiza una fila:
+          - fields: columnas que se sobrescriben
+          - fill:   columnas que solo rellenan huecos (IFNULL de ensure_component)
+        last_seen nunca retrocede (como GREATEST en los volcados en lote).
+        """
+        key = (device, int(comp_id) if comp_id is not None else None)
+
+        with self._lock:
+            rows = self._rows[table]
+            row = rows.get(key)
+            if row is None:
+                row = dict(COLUMNS[table], device_name=device)
+                if comp_id is not None:
+                    row["id"] = key[1]
+                rows[key] = row
+
+            for column, value in (fill or {}).items():
+                if value is not None and row.get(column) is None:
+                    row[column] = value
+
+            for column, value in fields.items():
+                if column == "last_seen" and row.get("last_seen") and value and value < row["last_seen"]:
+                    continue
+                row[column] = value
+
+        changelog.record(table, device, comp_id)
+
+    def upsert_device(self, device, **fields):
+        self.upsert("devices", device, **fields)
+
+    def upsert_component(self, comp_type, device, comp_id, fill=None, **fields):
+        # FK: el componente implica su dispositivo
+        with self._lock:
+            known = (device, None) in self._rows["devices"]
+        if not known:
+            self.upsert_device(device, last_seen=fields.get("last_seen"))
+
+        self.upsert(table_for(comp_type), device, comp_id, fill=fill, **fields)
+
+    # ==========================================================
+    #  LECTURAS OBSERVADAS (system/get con max_age)
+    # ==========================================================
+    def observe(self, comp_type, device, comp_id, refresh=True, **fields):
+        """
+        Anota una lectura recibida del ESP32 (update/ o response/). Con
+        refresh=False (campos de estado sin lectura, p.ej. el ack de un
+        enable) se fusionan sin renovar la edad que usa fresh().
+        """
+        key = (comp_type, device, int(comp_id))
+        with self._lock:
+            seen, previous = self._observed.get(key, (None, {}))
+            self._observed[key] = (
+                time.monotonic() if refresh else seen, {**previous, **fields}
+            )
+
+    def observed(self, comp_type, device, comp_id):
+        """Última lectura confirmada por el ESP32 (sin límite de edad) o None."""
+        with self._lock:
+            observed = self._observed.get((comp_type, device, int(comp_id)))
+        return dict(observed[1]) if observed is not None else None
+
+    def fresh(self, comp_type, device, comp_id, max_age_s):
+        """
+        (campos, edad_s) de la última lectura si no es más antigua que
+        max_age_s; None si no hay lectura o está obsoleta.
+        """
+        with self._lock:
+            observed = self._observed.get((comp_type, device, int(comp_id)))
+        if observed is None or observed[0] is None:
+            return None
+
+        age = time.monotonic() - observed[0]
+        if age > max_age_s:
+            return None
+        return dict(observed[1]), age
+
+    # ==========================================================
+    #  LECTURA (copias: los llamantes pueden modificarlas)
+    # ==========================================================
+    def rows(self, table, device=None, comp_id=None):
+        with self._lock:
+            if device is not None and comp_id is not None:
+                row = self._rows[table].get((device, int(comp_id)))
+                return [dict(row)] if row is not None else []
+
+            found = [
+                dict(row) for (dev, _), row in self._rows[table].items()
+                if device is None or dev == device
+            ]
+        found.sort(key=ORDER[table])
+        return found
+
+    def get(self, table, device, comp_id=None):
+        key = (device, int(comp_id) if comp_id is not None else None)
+        with self._lock:
+            row = self._rows[table].get(key)
+            return dict(row) if row is not None else None
+
+
+# Instancia compartida (se precarga desde listener.py)
+state_store = StateStore()
@@ -0,0 +1,20 @@
+def percentile(sorted_samples, pct):
+    """Percentil por rango más cercano (las muestras ya vienen ordenadas)."""
+    if not sorted_samples:
+        return None
+    rank = max(1, -(-len(sorted_samples) * pct // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+def summarize(samples):
+    """{"count", "p50", "p90", "p99", "max"} de una colección de muestras (ms)."""
+    values = sorted(samples)
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 1),
+        "p90": round(percentile(values, 90), 1),
+        "p99": round(percentile(values, 99), 1),
+        "max": round(values[-1], 1),
+    }
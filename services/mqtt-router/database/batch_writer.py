@@ -0,0 +1,114 @@
+import threading
+from config import logger
+
+
+class BatchWriter:
+    """
+    Base para escritores en segundo plano (write-behind).
+
+    Las subclases acumulan datos en memoria con add() bajo self._lock y
+    definen:
+      - _drain():           extrae y vacía lo pendiente (se llama con el lock tomado)
+      - _write(db, batch):  persiste el lote; devuelve True si se guardó
+      - _restore(batch):    reincorpora un lote fallido (se llama con el lock tomado)
+
+    Un hilo llama a flush() cada 'interval_s'; stop() hace un último flush.
+    """
+
+    name = "BATCH"
+    # Filas máximas por sentencia en _insert_many()
+    max_rows = 500
+
+    def __init__(self, interval_s):
+        self.interval_s = interval_s
+        self.db = None
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self, db):
+        if self._thread is not None:
+            return
+
+        self.db = db
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop,
+            name=f"writer-{self.name.lower()}",
+            daemon=True
+        )
+        self._thread.start()
+        logger.info(f"[{self.name}] Escritor iniciado (cada {self.interval_s}s)")
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join(self.interval_s + 5)
+        self._thread = None
+
+        # Último volcado con lo que quede en memoria
+        self.flush()
+        logger.info(f"[{self.name}] Escritor detenido")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_s):
+            self.flush()
+
+    # ==========================================================
+    #  VOLCADO
+    # ==========================================================
+    def flush(self):
+        """Persiste lo pendiente. Devuelve el nº de elementos escritos."""
+        if self.db is None:
+            return 0
+
+        # Un único flush a la vez (hilo periódico vs. stop())
+        with self._flush_lock:
+            with self._lock:
+                batch = self._drain()
+
+            if not batch:
+                return 0
+
+            try:
+                ok = self._write(self.db, batch)
+            except Exception as e:
+                logger.error(f"[{self.name}] Error volcando lote: {e}")
+                ok = False
+
+            if not ok:
+                with self._lock:
+                    self._restore(batch)
+                logger.warning(f"[{self.name}] Lote de {len(batch)} no guardado; se reintentará")
+                return 0
+
+            return len(batch)
+
+    def _insert_many(self, db, query, row_tpl, rows):
+        """
+        INSERT multi-fila troceado en bloques de max_rows.
+        'query' lleva el marcador {rows} donde va la lista de VALUES.
+        """
+        for start in range(0, len(rows), self.max_rows):
+            chunk = rows[start:start + self.max_rows]
+            params = [p for row in chunk for p in row]
+            sql = query.format(rows=", ".join([row_tpl] * len(chunk)))
+            if db.execute(sql, params) is None:
+                return False
+        return True
+
+    def _drain(self):
+        raise NotImplementedError
+
+    def _write(self, db, batch):
+        raise NotImplementedError
+
+    def _restore(self, batch):
+        raise NotImplementedError
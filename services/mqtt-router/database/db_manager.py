@@ -1,73 +1,369 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 import mysql.connector
-from mysql.connector import Error
-from config import DB_CFG, logger
+from mysql.connector import Error, errors
+from config import DB_CFG, DB_POOL_CFG, logger
+from core.metrics import DB_COMMIT_SECONDS, DB_ERRORS, DB_QUERY_SECONDS, query_op
+
+
+# Errores que indican conexión rota (el resto no justifica reconectar)
+_CONNECTION_ERRORS = (errors.OperationalError, errors.InterfaceError)
+
+
+class PoolExhausted(Error):
+    """No hay conexiones libres en el pool dentro del timeout."""
+
+
+class ConnectionPool:
+    """
+    Pool acotado de conexiones MariaDB.
+
+    - acquire() reutiliza conexiones libres; si llevan más de
+      'health_check_s' sin validarse, se comprueban con ping antes de entregarlas.
+    - Las conexiones ociosas más de 'max_idle_s' se cierran (evict_idle()).
+    - Si todas están en uso y se alcanzó 'size', espera hasta 'timeout_s'.
+    """
+
+    def __init__(self, size, max_idle_s, health_check_s, timeout_s):
+        self.size = max(1, int(size))
+        self.max_idle_s = max_idle_s
+        self.health_check_s = health_check_s
+        self.timeout_s = timeout_s
+
+        self._idle = deque()     # (conn, last_used, last_checked)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def _create(self):
+        conn = mysql.connector.connect(
+            connection_timeout=5,
+            **DB_CFG
+        )
+        logger.info("[MQTT-DB] Nueva conexión del pool establecida.")
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout_s
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolExhausted("Pool cerrado")
+
+                # === Reutilizar conexión libre ===
+                while self._idle:
+                    conn, last_used, last_checked = self._idle.pop()
+                    now = time.monotonic()
+
+                    if now - last_used > self.max_idle_s:
+                        self._close_quietly(conn)
+                        continue
+
+                    if now - last_checked > self.health_check_s:
+                        try:
+                            alive = conn.is_connected()
+                        except Exception:
+                            alive = False
+                        if not alive:
+                            logger.warning("[MQTT-DB] Conexión del pool caída. Descartada.")
+                            self._close_quietly(conn)
+                            continue
+
+                    self._in_use += 1
+                    return conn
+
+                # === Crear nueva si hay hueco ===
+                if self._in_use < self.size:
+                    self._in_use += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhausted(
+                        f"Sin conexiones libres tras {self.timeout_s}s (pool={self.size})"
+                    )
+                self._cond.wait(remaining)
+
+        # Fuera del lock: conectar puede tardar
+        try:
+            return self._create()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        if not discard:
+            try:
+                # Cierra transacciones/snapshots de lectura abiertos
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed:
+                self._close_quietly(conn)
+            else:
+                now = time.monotonic()
+                self._idle.append((conn, now, now))
+            self._cond.notify()
+
+    def evict_idle(self):
+        """Cierra las conexiones libres que superan max_idle_s."""
+        now = time.monotonic()
+        with self._cond:
+            keep = deque()
+            evicted = 0
+            for conn, last_used, last_checked in self._idle:
+                if now - last_used > self.max_idle_s:
+                    self._close_quietly(conn)
+                    evicted += 1
+                else:
+                    keep.append((conn, last_used, last_checked))
+            self._idle = keep
+
+        if evicted:
+            logger.info(f"[MQTT-DB] {evicted} conexiones ociosas cerradas.")
+
+    def close_all(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _, _ = self._idle.pop()
+                self._close_quietly(conn)
+            self._cond.notify_all()
 
 
 class DBManager:
+    """
+    Acceso a MariaDB compartido por todos los workers.
+
+    Cada hilo obtiene su propia conexión del pool (y su propio cursor por query),
+    de modo que los handlers pueden ejecutarse en paralelo.
+    """
+
     def __init__(self):
-        self.conn = None
-        self.cursor = None
-        self.connect()
+        self.pool = ConnectionPool(
+            size=DB_POOL_CFG["size"],
+            max_idle_s=DB_POOL_CFG["max_idle_s"],
+            health_check_s=DB_POOL_CFG["health_check_s"],
+            timeout_s=DB_POOL_CFG["timeout_s"],
+        )
+        self._local = threading.local()
+        self._evictor_stop = threading.Event()
+        self._evictor = None
+
+    # ==========================================================
+    #  CONEXIÓN POR HILO
+    # ==========================================================
+    @contextmanager
+    def connection(self):
+        """
+        Reserva una conexión para el hilo actual durante el bloque.
+        Las llamadas a execute() dentro del bloque la reutilizan.
+        Si el hilo ya tiene una reservada, se reutiliza (anidable).
+        """
+        if getattr(self._local, "conn", None) is not None:
+            yield self._local.conn
+            return
 
-    def connect(self):
+        conn = self.pool.acquire()
+        self._local.conn = conn
+        self._local.broken = False
         try:
-            if self.conn:
-                try:
-                    self.conn.close()
-                except:
-                    pass
-
-            self.conn = mysql.connector.connect(
-                connection_timeout=5,
-                **DB_CFG
-            )
-            self.cursor = self.conn.cursor(dictionary=True)
-            logger.info("[MQTT-DB] Conexión establecida correctamente.")
+            yield conn
+        finally:
+            # Puede haber sido sustituida por _replace_bound()
+            current = self._local.conn
+            self._local.conn = None
+            if current is not None:
+                self.pool.release(current, discard=self._local.broken)
 
-        except Error as e:
-            logger.error(f"[MQTT-DB] Error estableciendo conexión: {e}")
-            self.conn = None
-            self.cursor = None
+    @contextmanager
+    def transaction(self):
+        """
+        Unidad de trabajo: todas las execute() del bloque comparten conexión
+        y un único commit al salir. Dentro del bloque 'commit=True' se ignora.
+
+        - Si alguna sentencia falla, las siguientes no se ejecutan (devuelven
+          None) y al salir se hace rollback de todo el bloque.
+        - Una excepción dentro del bloque también provoca rollback.
+        - Bloques anidados se integran en la transacción exterior.
+        """
+        if getattr(self._local, "tx", False):
+            yield
+            return
+
+        with self.connection():
+            self._local.tx = True
+            self._local.tx_failed = False
+            self._local.on_commit = []
+            try:
+                yield
+            except Exception:
+                self._end_transaction(commit=False)
+                raise
+            else:
+                self._end_transaction(commit=not self._local.tx_failed)
+            finally:
+                self._local.tx = False
+                self._local.on_commit = []
 
-    def ensure_connection(self):
-        """Verifica si la conexión sigue viva, y la restaura si no."""
+    def _end_transaction(self, commit):
+        conn = self._local.conn
         try:
-            if self.conn is None or not self.conn.is_connected():
-                logger.warning("[MQTT-DB] Conexión perdida. Reintentando...")
-                self.connect()
-        except:
-            logger.warning("[MQTT-DB] Estado de conexión inválido. Reintentando...")
-            self.connect()
+            if commit:
+                with DB_COMMIT_SECONDS.time():
+                    conn.commit()
+            else:
+                DB_ERRORS.inc(kind="rollback")
+                logger.warning("[MQTT-DB] Transacción fallida. Rollback.")
+                conn.rollback()
+                return
+        except Error as e:
+            logger.error(f"[MQTT-DB] Error cerrando transacción: {e}")
+            self._local.broken = True
+            return
 
-    def execute(self, query, params=None, commit=False):
-        """Ejecuta consultas con auto-reconnect y doble intento."""
+        for fn in self._local.on_commit:
+            try:
+                fn()
+            except Exception as e:
+                logger.error(f"[MQTT-DB] Error en callback post-commit: {e}")
 
-        self.ensure_connection()
+    def on_commit(self, fn):
+        """
+        Ejecuta fn() cuando la transacción en curso se confirme
+        (inmediatamente si no hay transacción abierta). Tras un rollback no se llama.
+        """
+        if getattr(self._local, "tx", False):
+            self._local.on_commit.append(fn)
+        else:
+            fn()
 
+    def _execute_in_transaction(self, query, params):
+        if self._local.tx_failed:
+            return None
+
+        try:
+            return self._run(self._local.conn, query, params, commit=False)
+        except _CONNECTION_ERRORS as e:
+            # Con la conexión se pierde la transacción: no se reintenta
+            DB_ERRORS.inc(kind="connection")
+            logger.error(f"[MQTT-DB] Conexión perdida dentro de transacción: {e}")
+            self._local.broken = True
+            self._local.tx_failed = True
+        except Error as e:
+            DB_ERRORS.inc(kind="sql")
+            logger.error(f"[MQTT-DB] Error en query (transacción): {e}")
+            self._local.tx_failed = True
+        return None
+
+    def _run(self, conn, query, params, commit):
+        cursor = conn.cursor(dictionary=True)
         try:
-            self.cursor.execute(query, params)
+            with DB_QUERY_SECONDS.time(op=query_op(query)):
+                cursor.execute(query, params)
+                rows = cursor.fetchall() if cursor.with_rows else []
             if commit:
-                self.conn.commit()
-            return self.cursor.fetchall() if self.cursor.with_rows else []
+                with DB_COMMIT_SECONDS.time():
+                    conn.commit()
+            return rows
+        finally:
+            cursor.close()
 
-        except Error as e:
-            logger.error(f"[MQTT-DB] Error en query: {e}. Reintentando...")
+    def execute(self, query, params=None, commit=False):
+        """
+        Ejecuta una consulta con una conexión del pool.
+        - Error de conexión: se descarta la conexión y se reintenta una vez.
+        - Error de SQL (sintaxis, FK, datos...): no se reconecta.
+        Devuelve None si la consulta falla.
+        """
+        if getattr(self._local, "tx", False):
+            return self._execute_in_transaction(query, params)
+
+        for attempt in (1, 2):
+            bound = getattr(self._local, "conn", None)
 
-            # === Reintento ===
-            self.connect()
             try:
-                self.cursor.execute(query, params)
-                if commit:
-                    self.conn.commit()
-                return self.cursor.fetchall() if self.cursor.with_rows else []
-            except Error as e2:
-                logger.error(f"[MQTT-DB] Falla persistente ejecutando query: {e2}")
+                if bound is not None:
+                    return self._run(bound, query, params, commit)
+
+                with self.connection() as conn:
+                    try:
+                        return self._run(conn, query, params, commit)
+                    except _CONNECTION_ERRORS:
+                        self._local.broken = True
+                        raise
+
+            except _CONNECTION_ERRORS as e:
+                DB_ERRORS.inc(kind="connection")
+                if bound is not None:
+                    # Conexión reservada rota: se sustituye por otra del pool
+                    self._replace_bound()
+
+                if attempt == 1:
+                    logger.error(f"[MQTT-DB] Conexión perdida en query: {e}. Reintentando...")
+                    continue
+
+                logger.error(f"[MQTT-DB] Falla persistente ejecutando query: {e}")
                 return None  # Señal clara al handler
 
+            except Error as e:
+                DB_ERRORS.inc(kind="sql")
+                logger.error(f"[MQTT-DB] Error en query: {e}")
+                return None
+
+    def _replace_bound(self):
+        old = self._local.conn
+        self.pool.release(old, discard=True)
+        self._local.conn = None
+        self._local.broken = False
+        try:
+            self._local.conn = self.pool.acquire()
+        except Error as e:
+            logger.error(f"[MQTT-DB] No se pudo reponer la conexión: {e}")
+            # El hilo seguirá sin conexión reservada; connection() no liberará nada
+            self._local.conn = None
+
+    # ==========================================================
+    #  MANTENIMIENTO
+    # ==========================================================
+    def start_maintenance(self):
+        """Hilo de fondo que cierra periódicamente conexiones ociosas."""
+        if self._evictor is not None:
+            return
+
+        def _loop():
+            while not self._evictor_stop.wait(DB_POOL_CFG["health_check_s"]):
+                self.pool.evict_idle()
+
+        self._evictor = threading.Thread(target=_loop, name="db-evictor", daemon=True)
+        self._evictor.start()
+
+    def ping(self):
+        """True si se puede obtener una conexión viva del pool."""
+        try:
+            with self.connection() as conn:
+                return conn.is_connected()
+        except Error as e:
+            logger.error(f"[MQTT-DB] Ping fallido: {e}")
+            return False
+
     def close(self):
-        if self.conn:
-            try:
-                self.conn.close()
-                logger.info("[MQTT-DB] Conexión cerrada.")
-            except:
-                pass
+        self._evictor_stop.set()
+        self.pool.close_all()
+        logger.info("[MQTT-DB] Pool de conexiones cerrado.")
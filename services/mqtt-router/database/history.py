@@ -0,0 +1,174 @@
+import threading
+from datetime import datetime, timedelta
+from config import HISTORY_CFG, logger
+from database.retention import purge_batched
+
+
+# Niveles del histórico: tabla y columna temporal
+TIERS = {
+    "raw": ("sensor_readings", "ts"),
+    "1m": ("sensor_readings_1m", "bucket"),
+    "1h": ("sensor_readings_1h", "bucket"),
+}
+
+
+def resolution_for(start, end):
+    """Nivel adecuado para un rango ('auto'): bruto <= 2 h, 1m <= 3 días, 1h el resto."""
+    span = end - start
+    if span <= timedelta(hours=2):
+        return "raw"
+    if span <= timedelta(days=3):
+        return "1m"
+    return "1h"
+
+
+def fetch_history(db, device, sensor_id, start, end, resolution, limit):
+    """
+    Serie de un sensor en [start, end) leída por rango sobre la PK
+    (device_name, sensor_id, ts|bucket). Devuelve hasta 'limit' filas
+    ordenadas por tiempo, o None si la lectura falla.
+    """
+    table, column = TIERS[resolution]
+    if resolution == "raw":
+        select = f"{column} AS ts, value"
+    else:
+        select = f"{column} AS ts, min_value, max_value, avg_value, samples"
+
+    return db.execute(
+        f"""
+        SELECT {select}
+        FROM {table}
+        WHERE device_name=%s AND sensor_id=%s AND {column} >= %s AND {column} < %s
+        ORDER BY {column}
+        LIMIT %s
+        """,
+        (device, sensor_id, start, end, limit)
+    )
+
+
+class HistoryRollup:
+    """
+    Mantenimiento periódico del histórico de sensores:
+
+      - Agrega las lecturas brutas recientes en buckets de 1 minuto
+        (min/max/avg/samples) y estos en buckets de 1 hora. Cada pasada
+        recalcula por completo los buckets de la ventana reciente, así que
+        es idempotente y absorbe las lecturas que llegan con retraso.
+      - Aplica la retención de cada nivel con DELETE ... LIMIT por tandas
+        para no bloquear la tabla con un borrado enorme.
+    """
+
+    name = "HISTORY"
+
+    def __init__(self, interval_s=None):
+        self.interval_s = interval_s or HISTORY_CFG["rollup_interval_s"]
+        self.retention = {
+            "raw": timedelta(hours=HISTORY_CFG["raw_retention_h"]),
+            "1m": timedelta(days=HISTORY_CFG["m1_retention_d"]),
+            "1h": timedelta(days=HISTORY_CFG["h1_retention_d"]),
+        }
+        self.delete_batch = HISTORY_CFG["delete_batch"]
+        self.db = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self, db):
+        if self._thread is not None:
+            return
+
+        self.db = db
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="history-rollup", daemon=True)
+        self._thread.start()
+        logger.info(f"[{self.name}] Agregados y retención cada {self.interval_s}s")
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join(5)
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_s):
+            try:
+                self.run()
+            except Exception as e:
+                logger.error(f"[{self.name}] Error en mantenimiento del histórico: {e}")
+
+    # ==========================================================
+    #  PASADA
+    # ==========================================================
+    def run(self, now=None):
+        now = now or datetime.now()
+
+        # Ventana recalculada: dos intervalos (mínimo 5 min) hacia atrás,
+        # alineada al minuto / a la hora para rehacer buckets completos
+        window = max(timedelta(seconds=2 * self.interval_s), timedelta(minutes=5))
+        since_1m = (now - window).replace(second=0, microsecond=0)
+        since_1h = since_1m.replace(minute=0)
+
+        self.rollup_minutes(since_1m)
+        self.rollup_hours(since_1h)
+
+        for tier, keep in self.retention.items():
+            removed = self.purge(tier, now - keep)
+            if removed:
+                logger.info(f"[{self.name}] Retención {tier}: {removed} filas eliminadas")
+
+    def rollup_minutes(self, since):
+        return self.db.execute(
+            """
+            INSERT INTO sensor_readings_1m
+                (device_name, sensor_id, bucket, min_value, max_value, avg_value, samples)
+            SELECT device_name, sensor_id,
+                   FROM_UNIXTIME(UNIX_TIMESTAMP(ts) DIV 60 * 60) AS b,
+                   MIN(value), MAX(value), AVG(value), COUNT(*)
+            FROM sensor_readings
+            WHERE ts >= %s
+            GROUP BY device_name, sensor_id, b
+            ON DUPLICATE KEY UPDATE
+                min_value=VALUES(min_value), max_value=VALUES(max_value),
+                avg_value=VALUES(avg_value), samples=VALUES(samples)
+            """,
+            (since,),
+            commit=True
+        ) is not None
+
+    def rollup_hours(self, since):
+        # Media ponderada por nº de muestras de cada minuto
+        return self.db.execute(
+            """
+            INSERT INTO sensor_readings_1h
+                (device_name, sensor_id, bucket, min_value, max_value, avg_value, samples)
+            SELECT device_name, sensor_id,
+                   FROM_UNIXTIME(UNIX_TIMESTAMP(bucket) DIV 3600 * 3600) AS b,
+                   MIN(min_value), MAX(max_value),
+                   SUM(avg_value * samples) / SUM(samples), SUM(samples)
+            FROM sensor_readings_1m
+            WHERE bucket >= %s
+            GROUP BY device_name, sensor_id, b
+            ON DUPLICATE KEY UPDATE
+                min_value=VALUES(min_value), max_value=VALUES(max_value),
+                avg_value=VALUES(avg_value), samples=VALUES(samples)
+            """,
+            (since,),
+            commit=True
+        ) is not None
+
+    def purge(self, tier, cutoff):
+        """Borra por tandas las filas de 'tier' anteriores a 'cutoff'. Devuelve cuántas."""
+        table, column = TIERS[tier]
+        return purge_batched(
+            self.db, table, f"{column} < %s", (cutoff,),
+            batch=self.delete_batch, stop=self._stop
+        )
+
+
+# Instancia compartida (se arranca desde listener.py)
+history_rollup = HistoryRollup()
@@ -0,0 +1,92 @@
+import time
+from datetime import datetime
+from config import HEARTBEAT_CFG, logger
+from core.registry import registry
+from core.state_store import state_store
+from database.batch_writer import BatchWriter
+
+
+class LastSeenTracker(BatchWriter):
+    """
+    Heartbeats de dispositivos (devices.last_seen) en memoria.
+
+    Los handlers llaman a touch() en lugar de ejecutar
+    'UPDATE devices SET last_seen=NOW()'. Cada intervalo se persisten todos
+    los dispositivos vistos con un único INSERT ... ON DUPLICATE KEY UPDATE.
+    La frescura en memoria está disponible al instante con age()/is_fresh().
+    """
+
+    name = "LAST_SEEN"
+
+    def __init__(self, interval_s=None):
+        super().__init__(interval_s or HEARTBEAT_CFG["interval_s"])
+        # device -> (datetime, monotonic)
+        self._seen = {}
+        # device -> datetime pendiente de persistir
+        self._dirty = {}
+
+    def touch(self, device):
+        if not device:
+            return
+        now = datetime.now()
+        with self._lock:
+            self._seen[device] = (now, time.monotonic())
+            self._dirty[device] = now
+
+    # ==========================================================
+    #  FRESCURA EN MEMORIA
+    # ==========================================================
+    def last_seen(self, device):
+        """datetime del último heartbeat visto por el router (o None)."""
+        with self._lock:
+            entry = self._seen.get(device)
+        return entry[0] if entry else None
+
+    def age(self, device):
+        """Segundos desde el último heartbeat (None si nunca se vio)."""
+        with self._lock:
+            entry = self._seen.get(device)
+        return time.monotonic() - entry[1] if entry else None
+
+    def is_fresh(self, device, max_age_s):
+        age = self.age(device)
+        return age is not None and age <= max_age_s
+
+    # ==========================================================
+    #  BATCH WRITER
+    # ==========================================================
+    def _drain(self):
+        batch, self._dirty = self._dirty, {}
+        return batch
+
+    def _restore(self, batch):
+        for device, ts in batch.items():
+            self._dirty.setdefault(device, ts)
+
+    def _write(self, db, batch):
+        rows = ", ".join(["(%s, %s)"] * len(batch))
+        params = [p for item in batch.items() for p in item]
+
+        result = db.execute(
+            f"""
+            INSERT INTO devices (device_name, last_seen)
+            VALUES {rows}
+            ON DUPLICATE KEY UPDATE
+                last_seen=GREATEST(COALESCE(last_seen, VALUES(last_seen)), VALUES(last_seen))
+            """,
+            params,
+            commit=True
+        )
+        if result is None:
+            return False
+
+        for device, ts in batch.items():
+            registry.add_device(device)
+            state_store.upsert_device(device, last_seen=ts.replace(microsecond=0))
+
+        logger.debug(f"[{self.name}] Persistidos {len(batch)} heartbeats")
+        return True
+
+
+# Instancia compartida por los handlers (se arranca desde listener.py)
+last_seen_tracker = LastSeenTracker()
@@ -0,0 +1,83 @@
+import json
+from collections import deque
+from datetime import datetime
+from config import LOG_CFG, logger
+from database.batch_writer import BatchWriter
+
+
+class LogWriter(BatchWriter):
+    """
+    Auditoría de eventos de system/notify (tabla system_logs) en segundo plano.
+
+    system_notify solo encola el evento; cada intervalo se vuelca todo con
+    un INSERT multi-fila, fuera del hilo de mensajes. La cola está acotada
+    ('max_pending'): si la BBDD no responde se descartan los eventos más
+    antiguos y se cuentan en 'dropped'.
+    """
+
+    name = "SYSTEM_LOGS"
+
+    def __init__(self, interval_s=None, max_pending=None):
+        super().__init__(interval_s or LOG_CFG["flush_ms"] / 1000.0)
+        self.max_pending = max_pending or LOG_CFG["max_pending"]
+        # (timestamp, topic, event_type, payload_json) en orden de llegada
+        self._pending = deque(maxlen=self.max_pending)
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, topic, event_type, payload, ts=None):
+        # Se serializa ya: el dict puede seguir modificándose en el handler
+        row = (
+            (ts or datetime.now()).replace(microsecond=0),
+            topic,
+            event_type,
+            json.dumps(payload, default=str),
+        )
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+            self._pending.append(row)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    # ==========================================================
+    #  BATCH WRITER
+    # ==========================================================
+    def _drain(self):
+        batch = list(self._pending)
+        self._pending.clear()
+        return batch
+
+    def _restore(self, batch):
+        merged = batch + list(self._pending)
+        self.dropped += max(0, len(merged) - self.max_pending)
+        self._pending = deque(merged, maxlen=self.max_pending)
+
+    def _write(self, db, batch):
+        with db.transaction():
+            if not self._insert_many(
+                db,
+                "INSERT INTO system_logs (timestamp, topic, event_type, payload) VALUES {rows}",
+                "(%s, %s, %s, %s)",
+                batch
+            ):
+                return False
+
+        with self._lock:
+            self.written += len(batch)
+        logger.debug(f"[{self.name}] Volcados {len(batch)} eventos")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "written": self.written,
+                "dropped": self.dropped,
+            }
+
+
+# Instancia compartida por system_notify (se arranca desde listener.py)
+log_writer = LogWriter()
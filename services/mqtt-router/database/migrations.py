@@ -0,0 +1,162 @@
+from config import logger
+
+
+# severity -> severity_rank (mismo orden que core.messages.SEVERITY_RANK)
+_RANK_CASE = (
+    "CASE LOWER(severity) WHEN 'low' THEN 1 WHEN 'high' THEN 3 "
+    "WHEN 'critical' THEN 4 ELSE 2 END"
+)
+
+
+def _columns(db, table):
+    rows = db.execute(
+        """
+        SELECT COLUMN_NAME AS name
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """,
+        (table,)
+    )
+    return None if rows is None else {row["name"] for row in rows}
+
+
+def _indexes(db, table):
+    """{índice: [columnas en orden]} de la tabla (None si la lectura falla)."""
+    rows = db.execute(
+        """
+        SELECT INDEX_NAME AS name, COLUMN_NAME AS col
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX
+        """,
+        (table,)
+    )
+    if rows is None:
+        return None
+    indexes = {}
+    for row in rows:
+        indexes.setdefault(row["name"], []).append(row["col"])
+    return indexes
+
+
+def migrate_alerts(db):
+    """
+    Lleva una tabla alerts anterior (una fila por componente) al histórico
+    de solo inserción de init.sql. Idempotente: sin cambios pendientes
+    solo lee information_schema.
+    """
+    columns = _columns(db, "alerts")
+    indexes = _indexes(db, "alerts")
+    if not columns or indexes is None:
+        return False
+
+    wanted = {
+        "idx_alerts_severity": ["severity_rank", "timestamp"],
+        "idx_alerts_device": ["device_name", "timestamp"],
+        "idx_alerts_timestamp": ["timestamp"],
+    }
+    if (
+        "severity_rank" in columns
+        and "uniq_alert_component" not in indexes
+        and all(indexes.get(name) == cols for name, cols in wanted.items())
+    ):
+        return True
+
+    steps = []
+    if "severity_rank" not in columns:
+        steps.append(
+            "ALTER TABLE alerts ADD COLUMN IF NOT EXISTS "
+            "severity_rank TINYINT NOT NULL DEFAULT 2 AFTER severity"
+        )
+        steps.append(f"UPDATE alerts SET severity_rank = {_RANK_CASE}")
+
+    # Los índices antiguos con el mismo nombre tienen otras columnas
+    # (severity por texto, device sin timestamp): se sustituyen en un solo
+    # ALTER para que la FK de device_name no se quede nunca sin índice.
+    # Van antes de quitar la UNIQUE por el mismo motivo.
+    for name, cols in wanted.items():
+        current = indexes.get(name)
+        if current == cols:
+            continue
+        if current is None:
+            steps.append(f"CREATE INDEX IF NOT EXISTS {name} ON alerts({', '.join(cols)})")
+        else:
+            steps.append(
+                f"ALTER TABLE alerts DROP INDEX {name}, ADD INDEX {name} ({', '.join(cols)})"
+            )
+    if "uniq_alert_component" in indexes:
+        steps.append("DROP INDEX IF EXISTS uniq_alert_component ON alerts")
+
+    for query in steps:
+        if db.execute(query, commit=True) is None:
+            logger.error(f"[MIGRATE] alerts: no se pudo aplicar: {query}")
+            return False
+
+    logger.info("[MIGRATE] alerts actualizada a histórico con severity_rank")
+    return True
+
+
+# Tablas del histórico de lecturas (copia de init.sql: init.sql solo corre
+# al crear el volumen de MariaDB)
+_READINGS_TABLES = {
+    "sensor_readings": """
+        CREATE TABLE IF NOT EXISTS sensor_readings (
+          device_name VARCHAR(64) NOT NULL,
+          sensor_id INT NOT NULL,
+          ts DATETIME(3) NOT NULL,
+          value FLOAT NOT NULL,
+
+          PRIMARY KEY (device_name, sensor_id, ts),
+          KEY idx_readings_ts (ts)
+        )
+    """,
+    "sensor_readings_1m": """
+        CREATE TABLE IF NOT EXISTS sensor_readings_1m (
+          device_name VARCHAR(64) NOT NULL,
+          sensor_id INT NOT NULL,
+          bucket DATETIME NOT NULL,
+
+          min_value FLOAT NOT NULL,
+          max_value FLOAT NOT NULL,
+          avg_value FLOAT NOT NULL,
+          samples INT NOT NULL,
+
+          PRIMARY KEY (device_name, sensor_id, bucket),
+          KEY idx_readings_1m_bucket (bucket)
+        )
+    """,
+    "sensor_readings_1h": """
+        CREATE TABLE IF NOT EXISTS sensor_readings_1h (
+          device_name VARCHAR(64) NOT NULL,
+          sensor_id INT NOT NULL,
+          bucket DATETIME NOT NULL,
+
+          min_value FLOAT NOT NULL,
+          max_value FLOAT NOT NULL,
+          avg_value FLOAT NOT NULL,
+          samples INT NOT NULL,
+
+          PRIMARY KEY (device_name, sensor_id, bucket),
+          KEY idx_readings_1h_bucket (bucket)
+        )
+    """,
+}
+
+
+def migrate_readings(db):
+    """Crea las tablas de lecturas que falten (idempotente)."""
+    ok = True
+    for table, query in _READINGS_TABLES.items():
+        if db.execute(query, commit=True) is None:
+            logger.error(f"[MIGRATE] No se pudo crear la tabla {table}")
+            ok = False
+    return ok
+
+
+def run_migrations(db):
+    """Migraciones de esquema para instalaciones creadas con un init.sql anterior."""
+    for migrate in (migrate_readings, migrate_alerts):
+        try:
+            migrate(db)
+        except Exception as e:
+            logger.error(f"[MIGRATE] Error aplicando {migrate.__name__}: {e}")
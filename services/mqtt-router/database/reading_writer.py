@@ -0,0 +1,87 @@
+from collections import deque
+from datetime import datetime
+from config import HISTORY_CFG, logger
+from database.batch_writer import BatchWriter
+
+
+class ReadingWriter(BatchWriter):
+    """
+    Histórico bruto de lecturas de sensores (tabla sensor_readings).
+
+    A diferencia de TelemetryBuffer, aquí se conservan todas las lecturas,
+    no solo la última. Se acumulan en memoria y cada intervalo se vuelcan con
+    INSERT IGNORE multi-fila (una lectura repetida en el mismo milisegundo
+    se ignora por la PK).
+
+    La cola está acotada ('max_pending'): si la BBDD no responde se
+    descartan las lecturas más antiguas y se cuentan en 'dropped'.
+    """
+
+    name = "READINGS"
+
+    def __init__(self, interval_s=None, max_pending=None):
+        super().__init__(interval_s or HISTORY_CFG["flush_ms"] / 1000.0)
+        self.max_pending = max_pending or HISTORY_CFG["max_pending"]
+        # (device, id, ts, value) en orden de llegada
+        self._pending = deque(maxlen=self.max_pending)
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, device, comp_id, value, ts=None):
+        """Anota una lectura. Devuelve False si el valor no es numérico."""
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+            self._pending.append((device, int(comp_id), ts or datetime.now(), value))
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    # ==========================================================
+    #  BATCH WRITER
+    # ==========================================================
+    def _drain(self):
+        batch = list(self._pending)
+        self._pending.clear()
+        return batch
+
+    def _restore(self, batch):
+        # El lote fallido va delante de lo recibido durante el flush;
+        # si no cabe todo, se pierden las lecturas más antiguas.
+        merged = batch + list(self._pending)
+        self.dropped += max(0, len(merged) - self.max_pending)
+        self._pending = deque(merged, maxlen=self.max_pending)
+
+    def _write(self, db, batch):
+        with db.transaction():
+            if not self._insert_many(
+                db,
+                "INSERT IGNORE INTO sensor_readings (device_name, sensor_id, ts, value) VALUES {rows}",
+                "(%s, %s, %s, %s)",
+                batch
+            ):
+                return False
+
+        with self._lock:
+            self.written += len(batch)
+        logger.debug(f"[{self.name}] Volcadas {len(batch)} lecturas al histórico")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "written": self.written,
+                "dropped": self.dropped,
+            }
+
+
+# Instancia compartida por update/response (se arranca desde listener.py)
+reading_writer = ReadingWriter()
@@ -0,0 +1,170 @@
+import re
+import threading
+from datetime import datetime, timedelta
+from config import ALERT_CFG, LOG_CFG, RETENTION_CFG, logger
+
+
+# Particiones diarias de system_logs: pYYYYMMDD (+ p_future con MAXVALUE)
+LOG_PARTITION = re.compile(r"^p(\d{8})$")
+
+
+def purge_batched(db, table, where, params=(), batch=None, stop=None):
+    """
+    DELETE ... WHERE <where> LIMIT <batch> repetido hasta que no quede nada
+    (cada tanda en su propia transacción, sin bloqueos largos).
+    'stop' (threading.Event) interrumpe el borrado. Devuelve las filas borradas.
+    """
+    batch = batch or RETENTION_CFG["delete_batch"]
+    removed = 0
+
+    while stop is None or not stop.is_set():
+        with db.transaction():
+            db.execute(f"DELETE FROM {table} WHERE {where} LIMIT %s", (*params, batch))
+            result = db.execute("SELECT ROW_COUNT() AS n")
+
+        if not result:
+            break
+        count = int(result[0]["n"])
+        removed += count
+        if count < batch:
+            break
+
+    return removed
+
+
+class RetentionJob:
+    """
+    Retención periódica de tablas que solo crecen:
+      - alerts: más antiguas que 'ALERT_RETENTION_D' días y como máximo
+        'ALERT_MAX_ROWS' filas (se borran las más antiguas)
+      - system_logs: particiones diarias. Se crean por adelantado y las
+        caducadas se eliminan con DROP PARTITION (sin recorrer la tabla)
+    """
+
+    name = "RETENTION"
+
+    def __init__(self, interval_s=None):
+        self.interval_s = interval_s or RETENTION_CFG["interval_s"]
+        self.db = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ==========================================================
+    #  CICLO DE VIDA
+    # ==========================================================
+    def start(self, db):
+        if self._thread is not None:
+            return
+
+        self.db = db
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+        self._thread.start()
+        logger.info(f"[{self.name}] Retención cada {self.interval_s}s")
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join(5)
+        self._thread = None
+
+    def _loop(self):
+        # Primera pasada al arrancar: el router puede llevar tiempo parado
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                logger.error(f"[{self.name}] Error aplicando retención: {e}")
+            if self._stop.wait(self.interval_s):
+                return
+
+    # ==========================================================
+    #  PASADA
+    # ==========================================================
+    def run(self, now=None):
+        now = now or datetime.now()
+        removed = self.purge_alerts(now)
+        if removed:
+            logger.info(f"[{self.name}] alerts: {removed} filas eliminadas")
+
+        self.rotate_logs(now)
+
+    def purge_alerts(self, now):
+        cutoff = now - timedelta(days=ALERT_CFG["retention_d"])
+        removed = purge_batched(self.db, "alerts", "timestamp < %s", (cutoff,), stop=self._stop)
+
+        # Tope de filas: id de la alerta nº max_rows empezando por la más reciente
+        rows = self.db.execute(
+            "SELECT id FROM alerts ORDER BY id DESC LIMIT 1 OFFSET %s",
+            (ALERT_CFG["max_rows"],)
+        )
+        if rows:
+            removed += purge_batched(
+                self.db, "alerts", "id <= %s", (rows[0]["id"],), stop=self._stop
+            )
+        return removed
+
+    def rotate_logs(self, now):
+        """Crea las particiones de los próximos días y elimina las caducadas."""
+        rows = self.db.execute(
+            """
+            SELECT PARTITION_NAME AS name
+            FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'system_logs'
+            """
+        )
+        if rows is None:
+            return
+
+        names = [row["name"] for row in rows if row["name"]]
+        today = now.date()
+        cutoff = today - timedelta(days=LOG_CFG["retention_d"])
+
+        if "p_future" not in names:
+            # Tabla sin particionar (instalación previa): DELETE por tandas
+            removed = purge_batched(
+                self.db, "system_logs", "timestamp < %s", (cutoff,), stop=self._stop
+            )
+            if removed:
+                logger.info(f"[{self.name}] system_logs: {removed} filas eliminadas")
+            return
+
+        days = sorted(
+            datetime.strptime(match.group(1), "%Y%m%d").date()
+            for match in map(LOG_PARTITION.match, names) if match
+        )
+
+        # === Crear: siempre a continuación de la última (RANGE es ascendente) ===
+        missing = [
+            day for day in (today + timedelta(days=i) for i in range(LOG_CFG["ahead_d"] + 1))
+            if not days or day > days[-1]
+        ]
+        if missing:
+            partitions = ", ".join(
+                f"PARTITION p{day:%Y%m%d} VALUES LESS THAN (TO_DAYS('{day + timedelta(days=1)}'))"
+                for day in missing
+            )
+            if self.db.execute(
+                f"ALTER TABLE system_logs REORGANIZE PARTITION p_future INTO "
+                f"({partitions}, PARTITION p_future VALUES LESS THAN MAXVALUE)",
+                commit=True
+            ) is not None:
+                logger.info(f"[{self.name}] system_logs: {len(missing)} particiones creadas")
+
+        # === Eliminar las caducadas ===
+        expired = [f"p{day:%Y%m%d}" for day in days if day < cutoff]
+        if expired:
+            if self.db.execute(
+                f"ALTER TABLE system_logs DROP PARTITION {', '.join(expired)}",
+                commit=True
+            ) is not None:
+                logger.info(
+                    f"[{self.name}] system_logs: particiones eliminadas {', '.join(expired)}"
+                )
+
+
+# Instancia compartida (se arranca desde listener.py)
+retention_job = RetentionJob()
@@ -0,0 +1,109 @@
+from datetime import datetime
+from config import TELEMETRY_CFG, logger
+from core.registry import registry
+from core.state_store import state_store
+from database.batch_writer import BatchWriter
+
+
+class TelemetryBuffer(BatchWriter):
+    """
+    Buffer write-behind de lecturas de sensores (update/<device>/sensor/<id>).
+
+    Solo conserva el último valor por (device, id). Cada intervalo vuelca todo
+    con dos INSERT ... ON DUPLICATE KEY UPDATE multi-fila (devices + sensors)
+    en una sola transacción, en lugar de cuatro transacciones por lectura.
+    """
+
+    name = "TELEMETRY"
+
+    def __init__(self, interval_s=None, max_rows=None):
+        super().__init__(interval_s or TELEMETRY_CFG["flush_ms"] / 1000.0)
+        self.max_rows = max_rows or TELEMETRY_CFG["max_rows"]
+        # (device, id) -> (value, unit, ts)
+        self._pending = {}
+
+    def add(self, device, comp_id, value, unit=None):
+        """
+        Registra una lectura. Sustituye a la pendiente del mismo sensor.
+        Devuelve False si el valor no es numérico (la columna es FLOAT).
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+
+        with self._lock:
+            self._pending[(device, comp_id)] = (value, unit, datetime.now())
+        return True
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    # ==========================================================
+    #  BATCH WRITER
+    # ==========================================================
+    def _drain(self):
+        batch, self._pending = self._pending, {}
+        return batch
+
+    def _restore(self, batch):
+        # Lo recibido durante el flush fallido es más reciente: no se pisa
+        for key, reading in batch.items():
+            self._pending.setdefault(key, reading)
+
+    def _write(self, db, batch):
+        # === Dispositivos (FK) con su último last_seen ===
+        devices = {}
+        for (device, _), (_, _, ts) in batch.items():
+            if device not in devices or ts > devices[device]:
+                devices[device] = ts
+
+        sensors = [
+            (comp_id, device, value, unit, ts)
+            for (device, comp_id), (value, unit, ts) in batch.items()
+        ]
+
+        with db.transaction():
+            if not self._insert_many(
+                db,
+                "INSERT INTO devices (device_name, last_seen) VALUES {rows} "
+                "ON DUPLICATE KEY UPDATE "
+                "last_seen=GREATEST(COALESCE(last_seen, VALUES(last_seen)), VALUES(last_seen))",
+                "(%s, %s)",
+                list(devices.items())
+            ):
+                return False
+
+            # === Sensores: alta si no existen + último valor ===
+            if not self._insert_many(
+                db,
+                "INSERT INTO sensors (id, device_name, value, unit, last_seen) VALUES {rows} "
+                "ON DUPLICATE KEY UPDATE "
+                "value=VALUES(value), unit=VALUES(unit), last_seen=VALUES(last_seen)",
+                "(%s, %s, %s, %s, %s)",
+                sensors
+            ):
+                return False
+
+            db.on_commit(lambda: self._apply_to_state(devices, batch))
+
+        logger.debug(f"[{self.name}] Volcadas {len(sensors)} lecturas de sensores")
+        return True
+
+    @staticmethod
+    def _apply_to_state(devices, batch):
+        # Las filas creadas por el volcado quedan visibles para system/get/set
+        for device, ts in devices.items():
+            registry.add_device(device)
+            state_store.upsert_device(device, last_seen=ts.replace(microsecond=0))
+        for (device, comp_id), (value, unit, ts) in batch.items():
+            registry.add_component("sensor", device, comp_id)
+            state_store.upsert_component(
+                "sensor", device, comp_id,
+                value=value, unit=unit, last_seen=ts.replace(microsecond=0)
+            )
+
+
+# Instancia compartida por los handlers (se arranca desde listener.py)
+telemetry_buffer = TelemetryBuffer()
@@ -8,3 +8,4 @@ from .esp_get import handle as esp_get
 from .system_select import handle as system_select
 
 from .system_notify import handle as system_notify
+from .system_diag import handle as system_diag
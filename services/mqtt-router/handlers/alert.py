@@ -1,63 +1,31 @@
 from config import logger
-from handlers.utils import safe_json_dumps
+from core.alert_suppressor import alert_suppressor
+from core.codec import encode
+from core.messages import SEVERITY_RANK
+from core.registry import registry
+from handlers.utils import ensure_device
 from datetime import datetime
 
 
-def handle(db, client, topic, payload):
+def _record(db, client, device, comp_type, comp_id, name, location,
+            status, message, severity, rank, code, extra=None):
     """
-    Gestiona 'alert/#' desde los ESP32.
-    Mantiene únicamente la alerta más reciente por componente.
+    Guarda la alerta en el histórico y publica system/notify/alert.
+    'extra' añade campos a la notificación (supresión, escalado...).
     """
+    # === Resolver name/location si no vienen en payload (registro en memoria) ===
+    if not name or not location:
+        info = registry.lookup(db, comp_type, device, comp_id)
+        if info:
+            name     = name     or info["name"]
+            location = location or info["location"]
 
-    try:
-        # === Parsear tópico ===
-        parts = topic.split("/")
-        if len(parts) < 4:
-            logger.warning(f"[ALERT] Tópico inválido: {topic}")
-            return
-
-        _, device, comp_type, comp_id = parts[:4]
-
-        try:
-            comp_id = int(comp_id)
-        except ValueError:
-            logger.warning(f"[ALERT] ID inválido: {comp_id}")
-            return
-
-        if comp_type not in ("sensor", "actuator"):
-            logger.warning(f"[ALERT] Tipo no válido: {comp_type}")
-            return
-
+    # === Escrituras de la alerta en una sola transacción ===
+    with db.transaction():
         # === Garantizar existencia del dispositivo (FK) ===
-        db.execute(
-            """
-            INSERT INTO devices (device_name, last_seen)
-            VALUES (%s, NOW())
-            ON DUPLICATE KEY UPDATE last_seen=NOW()
-            """,
-            (device,),
-            commit=True
-        )
+        ensure_device(db, device)
 
-        # === Extraer datos del payload ===
-        status   = payload.get("status", "ALERT")
-        message  = payload.get("message", "Sin mensaje")
-        severity = payload.get("severity", "medium")
-        code     = payload.get("code")
-        name     = payload.get("name")
-        location = payload.get("location")
-
-        # === Resolver name/location si no vienen en payload ===
-        if not name or not location:
-            row = db.execute(
-                f"SELECT name, location FROM {comp_type}s WHERE device_name=%s AND id=%s",
-                (device, comp_id)
-            )
-            if row:
-                name     = name     or row[0]["name"]
-                location = location or row[0]["location"]
-
-        # === Upsert de alerta (solo la más reciente) ===
+        # === Alta en el histórico (la retención la aplica RetentionJob) ===
         db.execute(
             """
             INSERT INTO alerts (
@@ -69,18 +37,11 @@ def handle(db, client, topic, payload):
                 status,
                 message,
                 severity,
+                severity_rank,
                 code,
                 timestamp
             )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
-            ON DUPLICATE KEY UPDATE
-                component_name = VALUES(component_name),
-                location       = VALUES(location),
-                status         = VALUES(status),
-                message        = VALUES(message),
-                severity       = VALUES(severity),
-                code           = VALUES(code),
-                timestamp      = NOW()
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
             """,
             (
                 device,
@@ -91,37 +52,115 @@ def handle(db, client, topic, payload):
                 status,
                 message,
                 severity,
+                rank,
                 code
-            ),
-            commit=True
+            )
         )
 
-        logger.info(
-            f"[DB][ALERT] Estado actualizado: {device}/{comp_type}/{comp_id} "
-            f"[{severity.upper()}] {message}"
+    logger.info(
+        f"[DB][ALERT] Alerta registrada: {device}/{comp_type}/{comp_id} "
+        f"[{severity.upper()}] {message}"
+    )
+
+    # === Publicar notificación ===
+    alert_msg = {
+        "device": device,
+        "type": comp_type,
+        "id": comp_id,
+        "name": name,
+        "location": location,
+        "status": status,
+        "severity": severity,
+        "message": message,
+        "code": code,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        **(extra or {}),
+    }
+
+    client.publish(
+        "system/notify/alert",
+        encode(alert_msg),
+        qos=1
+    )
+
+    logger.info("[ALERT] Notificación publicada -> system/notify/alert")
+
+
+def publish_summary(db, client, summary):
+    """
+    Resumen periódico de repeticiones suprimidas de un componente
+    (lo invoca el hilo de AlertSuppressor). Queda en el histórico como
+    una única fila con status 'SUPPRESSED', o 'FLAPPING' si el status
+    osciló dentro de la ventana ('alert_status' lleva el último recibido).
+    """
+    extra = {
+        "summary": True,
+        "suppressed": summary.count,
+        "alert_status": summary.status,
+        "first_ts": summary.first_ts.strftime("%Y-%m-%d %H:%M:%S"),
+        "last_ts": summary.last_ts.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if summary.flips:
+        status = "FLAPPING"
+        message = (
+            f"{summary.flips} cambios de estado suprimidos (último: {summary.status}), "
+            f"{summary.count} repeticiones: {summary.message}"
         )
+        extra.update(flapping=True, flips=summary.flips)
+    else:
+        status = "SUPPRESSED"
+        message = f"{summary.count} repeticiones suprimidas: {summary.message}"
+
+    _record(
+        db, client,
+        summary.device, summary.type, summary.id,
+        None, None,
+        status, message,
+        summary.severity or "medium",
+        summary.severity_rank or SEVERITY_RANK["medium"],
+        None,
+        extra=extra
+    )
+
+
+def handle(db, client, route, msg):
+    """
+    Gestiona 'alert/#' desde los ESP32.
+    Cada alerta se añade al histórico (tabla alerts, solo inserción), salvo
+    las repeticiones que AlertSuppressor descarta dentro de su ventana.
+    """
 
-        # === Publicar notificación ===
-        alert_msg = {
-            "device": device,
-            "type": comp_type,
-            "id": comp_id,
-            "name": name,
-            "location": location,
-            "status": status,
-            "severity": severity,
-            "message": message,
-            "code": code,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-
-        client.publish(
-            "system/notify/alert",
-            safe_json_dumps(alert_msg),
-            qos=1
+    try:
+        # === Parámetros del tópico (ya validados por el router) ===
+        device, comp_type, comp_id = route.device, route.comp_type, route.comp_id
+
+        # === Supresión de repeticiones (antes de cualquier acceso a BBDD) ===
+        decision, absorbed = alert_suppressor.check(
+            (device, comp_type, comp_id),
+            msg.status, msg.severity, msg.severity_rank, msg.message
         )
+        if decision == "suppressed":
+            logger.debug(f"[ALERT] Repetición suprimida: {device}/{comp_type}/{comp_id}")
+            return
+        if decision == "flapping":
+            logger.debug(
+                f"[ALERT] Cambio de estado suprimido ({msg.status}): {device}/{comp_type}/{comp_id}"
+            )
+            return
 
-        logger.info("[ALERT] Notificación publicada -> system/notify/alert")
+        extra = {}
+        if decision == "escalated":
+            extra["escalated"] = True
+        if absorbed:
+            extra["suppressed"] = absorbed
+
+        _record(
+            db, client,
+            device, comp_type, comp_id,
+            msg.name, msg.location,
+            msg.status, msg.message, msg.severity, msg.severity_rank, msg.code,
+            extra=extra
+        )
 
     except Exception as e:
         logger.error(f"[ALERT] Error procesando alerta: {e}")
@@ -1,80 +1,75 @@
 from config import logger
-from handlers.utils import safe_json_dumps
+from core.codec import encode
+from core.registry import registry
+from core.state_store import state_store, now
+from database.last_seen import last_seen_tracker
 from datetime import datetime
 
 
-def handle(db, client, topic, payload):
+def handle(db, client, route, msg):
     """
     Gestiona 'announce/#' desde los ESP32.
     Registra dinámicamente dispositivos, sensores y actuadores.
+    'msg' es el AnnounceMsg ya validado por el listener.
     """
 
     try:
-        # === Parsear tópico ===
-        parts = topic.split("/")
-        if len(parts) < 4:
-            logger.warning(f"[ANNOUNCE] Tópico inválido: {topic}")
-            return
+        # === Parámetros del tópico (ya validados por el router) ===
+        device, comp_type, comp_id = route.device, route.comp_type, route.comp_id
 
-        _, device, comp_type, comp_id = parts[:4]
+        name, location = msg.name, msg.location
 
-        try:
-            comp_id = int(comp_id)
-        except ValueError:
-            logger.warning(f"[ANNOUNCE] ID inválido: {comp_id}")
-            return
+        last_seen_tracker.touch(device)
 
-        if comp_type not in ["sensor", "actuator"]:
-            logger.warning(f"[ANNOUNCE] Tipo no válido: {comp_type}")
-            return
-
-        # === Extraer datos del payload ===
-        name = payload.get("name")
-        location = payload.get("location")
-
-        if not name or not location:
-            logger.warning(f"[ANNOUNCE] Payload incompleto en {topic}: {payload}")
-            return
-
-        # === Registrar / actualizar dispositivo ===
-        db.execute(
-            """
-            INSERT INTO devices (device_name, last_seen)
-            VALUES (%s, NOW())
-            ON DUPLICATE KEY UPDATE last_seen=NOW()
-            """,
-            (device,),
-            commit=True
-        )
-
-        # === Registrar componente ===
-        if comp_type == "sensor":
+        # === Registrar dispositivo + componente (una sola transacción) ===
+        with db.transaction():
             db.execute(
                 """
-                INSERT INTO sensors (id, device_name, name, location, last_seen)
-                VALUES (%s, %s, %s, %s, NOW())
-                ON DUPLICATE KEY UPDATE
-                    name=VALUES(name),
-                    location=VALUES(location),
-                    last_seen=NOW()
+                INSERT INTO devices (device_name, last_seen)
+                VALUES (%s, NOW())
+                ON DUPLICATE KEY UPDATE last_seen=NOW()
                 """,
-                (comp_id, device, name, location),
-                commit=True
+                (device,)
             )
 
-        else:  # actuator
-            db.execute(
-                """
-                INSERT INTO actuators (id, device_name, name, location, last_seen)
-                VALUES (%s, %s, %s, %s, NOW())
-                ON DUPLICATE KEY UPDATE
-                    name=VALUES(name),
-                    location=VALUES(location),
-                    last_seen=NOW()
-                """,
-                (comp_id, device, name, location),
-                commit=True
+            if comp_type == "sensor":
+                db.execute(
+                    """
+                    INSERT INTO sensors (id, device_name, name, location, last_seen)
+                    VALUES (%s, %s, %s, %s, NOW())
+                    ON DUPLICATE KEY UPDATE
+                        name=VALUES(name),
+                        location=VALUES(location),
+                        last_seen=NOW()
+                    """,
+                    (comp_id, device, name, location)
+                )
+
+            else:  # actuator
+                db.execute(
+                    """
+                    INSERT INTO actuators (id, device_name, name, location, last_seen)
+                    VALUES (%s, %s, %s, %s, NOW())
+                    ON DUPLICATE KEY UPDATE
+                        name=VALUES(name),
+                        location=VALUES(location),
+                        last_seen=NOW()
+                    """,
+                    (comp_id, device, name, location)
+                )
+
+            # El announce es la fuente de verdad de name/location
+            db.on_commit(
+                lambda: registry.add_component(
+                    comp_type, device, comp_id, name, location, overwrite=True
+                )
+            )
+            db.on_commit(
+                lambda: state_store.upsert_component(
+                    comp_type, device, comp_id, name=name, location=location, last_seen=now()
+                )
             )
+            db.on_commit(lambda: state_store.upsert_device(device, last_seen=now()))
 
         logger.info(f"[DB][ANNOUNCE] {comp_type} registrado: {device}/{comp_id}")
 
@@ -91,7 +86,7 @@ def handle(db, client, topic, payload):
 
         client.publish(
             f"system/notify/{device}/announce",
-            safe_json_dumps(confirm_msg),
+            encode(confirm_msg),
             qos=1
         )
 
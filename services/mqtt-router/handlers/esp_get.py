@@ -1,60 +1,30 @@
 from config import logger
-import json
+from core.codec import encode
+from core.inflight import inflight
+from core.outbound import outbound
+from core.registry import registry
+from core.state_store import state_store
 
 
-def handle(db, client, topic, payload):
+def handle(db, client, route, msg):
     """
     Handler de system/get/# en mqtt-router.
-    Valida componente en BD y reenvía GET al ESP32 correspondiente.
+    Valida el componente (registro en memoria) y reenvía GET al ESP32 correspondiente.
     """
 
     try:
-        # === Parseo del tópico ===
-        parts = topic.split("/")
-        if len(parts) < 3:
-            logger.warning(f"[SYSTEM/GET] Tópico inválido: {topic}")
-            return
-
-        _, action, requester = parts[:3]
-
-        if action != "get":
-            logger.warning(f"[SYSTEM/GET] Acción no válida: {action}")
-            return
+        # === Servicio solicitante (del tópico) ===
+        requester = route.requester
 
-        # === Extraer parámetros ===
-        device = payload.get("device")
-        comp_type = payload.get("type")
-        comp_id = payload.get("id")
-
-        comp_type = str(comp_type).strip().lower() if comp_type else None
-
-        try:
-            comp_id = int(comp_id) if comp_id is not None else None
-        except ValueError:
-            logger.warning(f"[SYSTEM/GET] ID inválido: {comp_id}")
-            return
-
-        if not (device and comp_type and comp_id is not None):
-            logger.warning(f"[SYSTEM/GET] Payload incompleto: {payload}")
-            return
-
-        if comp_type not in ["sensor", "actuator"]:
-            logger.warning(f"[SYSTEM/GET] Tipo inválido: {comp_type}")
-            return
+        device, comp_type, comp_id = msg.device, msg.type, msg.id
 
         # === Validar existencia del dispositivo ===
-        if not db.execute(
-            "SELECT device_name FROM devices WHERE device_name=%s",
-            (device,)
-        ):
+        if not registry.lookup_device(db, device):
             logger.warning(f"[SYSTEM/GET] Dispositivo '{device}' no registrado.")
             return
 
         # === Validar componente ===
-        query = f"SELECT name, location FROM {comp_type}s WHERE device_name=%s AND id=%s"
-        result = db.execute(query, (device, comp_id))
-
-        if not result:
+        if registry.lookup(db, comp_type, device, comp_id) is None:
             error_payload = {
                 "error": "component_not_found",
                 "device": device,
@@ -63,24 +33,57 @@ def handle(db, client, topic, payload):
             }
             client.publish(
                 f"system/response/{requester}/{comp_type}/{device}/{comp_id}",
-                json.dumps(error_payload),
+                encode(error_payload),
                 qos=1
             )
             return
 
-        # === Reenvío al ESP32 ===
+        # === Lectura reciente en el router (max_age): no se molesta al ESP32 ===
+        if msg.max_age is not None:
+            cached = state_store.fresh(comp_type, device, comp_id, msg.max_age)
+            if cached is not None:
+                fields, age = cached
+                client.publish(
+                    f"system/response/{requester}/{comp_type}/{device}/{comp_id}",
+                    encode({
+                        "device": device,
+                        "type": comp_type,
+                        "id": comp_id,
+                        **fields,
+                        "cached": True,
+                        "age_ms": int(age * 1000),
+                    }),
+                    qos=1
+                )
+                logger.info(
+                    f"[SYSTEM/GET] {device}/{comp_type}/{comp_id} respondido desde caché "
+                    f"({age:.1f}s <= max_age {msg.max_age}s)"
+                )
+                return
+
+        # === GET ya en vuelo para el componente: se espera esa respuesta ===
+        entry, coalesced = inflight.begin_get(device, comp_type, comp_id, requester)
+        if coalesced:
+            logger.info(
+                f"[SYSTEM/GET] {device}/{comp_type}/{comp_id} agrupado con cid={entry.cid} "
+                f"(requester={requester})"
+            )
+            return
+
+        # === Reenvío al ESP32 (con correlation id) ===
         esp_topic = f"get/{device}/{comp_type}/{comp_id}"
         forward_payload = {
-            "requester": requester
+            "requester": requester,
+            "cid": entry.cid
         }
 
-        client.publish(
-            esp_topic,
-            json.dumps(forward_payload),
-            qos=1
+        # Salida limitada por dispositivo (token bucket)
+        outbound.publish(
+            client, device, esp_topic, encode(forward_payload), qos=1,
+            on_sent=lambda: inflight.mark_sent(entry.cid)
         )
 
-        logger.info(f"[SYSTEM/GET] Reenviado a ESP32: {esp_topic}")
+        logger.info(f"[SYSTEM/GET] Reenviado a ESP32: {esp_topic} (cid={entry.cid})")
 
     except Exception as e:
         logger.error(f"[SYSTEM/GET] Error procesando petición: {e}")
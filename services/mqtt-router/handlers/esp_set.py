@@ -1,7 +1,13 @@
 from config import logger
-import json
 from datetime import datetime
-from handlers.utils import safe_json_dumps
+from core.codec import encode
+from core.changelog import table_for
+from core.command_queue import command_queue
+from core.inflight import inflight
+from core.outbound import outbound
+from core.registry import registry
+from core.state_store import state_store
+from database.last_seen import last_seen_tracker
 
 
 def _normalize_bool(raw_cmd):
@@ -11,17 +17,70 @@ def _normalize_bool(raw_cmd):
     return bool(raw_cmd)
 
 
-def _motion_bool_from_command(cmd: str) -> bool:
+def _matches_confirmed(comp_type, forward_payload, confirmed):
     """
-    Para mantener compatibilidad con actuators.state (0/1).
-    OPEN/CLOSE => True (en movimiento/activo)
-    STOP/CLOSED/OFF => False
+    True si la orden no cambiaría nada respecto al último estado
+    confirmado por el ESP32 (response/ o update/).
     """
-    v = (cmd or "").strip().lower()
-    return v in ["open", "close", "forward", "backward", "opening", "closing", "up", "down"]
+    if not confirmed:
+        return False
 
+    if comp_type == "sensor":
+        enabled = confirmed.get("enabled")
+        return enabled is not None and bool(enabled) == forward_payload["enable"]
 
-def handle(db, client, topic, payload):
+    state = confirmed.get("state")
+    if state is None:
+        return False
+
+    if "command" in forward_payload:
+        # Estados estables: OPEN -> 1, CLOSE -> 0 (STOP y demás siempre se envían)
+        target = {"OPEN": 1, "CLOSE": 0}.get(forward_payload["command"])
+        return target is not None and int(state) == target
+
+    return bool(state) == forward_payload["state"]
+
+
+def _state_payload(device, comp_type, comp_id):
+    """
+    Estado completo del componente con la forma de las response/# que
+    reenvía handlers/response.py (los consumidores de system/response/...
+    lo interpretan como estado): lo confirmado por el ESP32 y, para los
+    campos que falten, la vista en memoria de la BBDD.
+    """
+    confirmed = state_store.observed(comp_type, device, comp_id) or {}
+    rows = state_store.rows(table_for(comp_type), device, comp_id)
+    row = rows[0] if rows else {}
+
+    def pick(field, column):
+        value = confirmed.get(field)
+        return value if value is not None else row.get(column)
+
+    body = {"device": device, "type": comp_type, "id": comp_id}
+    if comp_type == "sensor":
+        body["value"] = pick("value", "value")
+        body["units"] = pick("units", "unit")
+        body["enabled"] = pick("enabled", "enabled")
+    else:
+        body["state"] = pick("state", "state")
+        if confirmed.get("state_text") is not None:
+            body["state_text"] = confirmed["state_text"]
+    return body
+
+
+def _expected_state(comp_type, forward_payload):
+    """Campos que confirmará la response/# de la orden (None si no es un estado estable)."""
+    if comp_type == "sensor":
+        return {"enabled": 1 if forward_payload["enable"] else 0}
+
+    if "command" in forward_payload:
+        target = {"OPEN": 1, "CLOSE": 0}.get(forward_payload["command"])
+        return {"state": target} if target is not None else None
+
+    return {"state": 1 if forward_payload["state"] else 0}
+
+
+def handle(db, client, route, msg):
     """
     Gestiona 'system/set/#' desde los microservicios internos.
     Soporta:
@@ -32,46 +91,20 @@ def handle(db, client, topic, payload):
     """
     try:
         # === Identificar requester ===
-        parts = topic.split("/")
-        requester = parts[2] if len(parts) > 2 else "unknown"
+        requester = route.requester
 
-        # === Extraer valores ===
-        device = payload.get("device")
-        comp_type = str(payload.get("type", "")).strip().lower()
-
-        comp_id = payload.get("id")
-        comp_id = int(comp_id) if comp_id is not None else None
+        device, comp_type, comp_id = msg.device, msg.type, msg.id
 
         # Comandos soportados
-        raw_state = payload.get("state", None)
-        raw_enable = payload.get("enable", None)
-        raw_command = payload.get("command", None)
-        raw_speed = payload.get("speed", None)
-
-        if not (device and comp_type and comp_id is not None):
-            logger.warning(f"[SYSTEM/SET] Petición incompleta -> {payload}")
-            return
-
-        if comp_type not in ["sensor", "actuator"]:
-            logger.warning(f"[SYSTEM/SET] Tipo inválido: {comp_type}")
-            return
+        raw_state = msg.state
+        raw_enable = msg.enable
+        raw_command = msg.command
+        raw_speed = msg.speed
 
-        # Validación mínima del comando según tipo
-        if comp_type == "sensor":
-            if raw_enable is None:
-                logger.warning(f"[SYSTEM/SET] Petición incompleta (sensor sin enable) -> {payload}")
-                return
-        else:
-            # actuator
-            if raw_state is None and raw_command is None:
-                logger.warning(f"[SYSTEM/SET] Petición incompleta (actuator sin state/command) -> {payload}")
-                return
+        # === Comprobación de existencia (registro en memoria) ===
+        info = registry.lookup(db, comp_type, device, comp_id)
 
-        # === Comprobación de existencia en base de datos ===
-        query = f"SELECT name, location FROM {comp_type}s WHERE device_name=%s AND id=%s"
-        result = db.execute(query, (device, comp_id))
-
-        if not result:
+        if info is None:
             error = {
                 "error": "component_not_found",
                 "device": device,
@@ -80,19 +113,18 @@ def handle(db, client, topic, payload):
             }
             client.publish(
                 f"system/response/{requester}/{comp_type}/{device}/{comp_id}",
-                json.dumps(error),
+                encode(error),
                 qos=1
             )
             return
 
-        name = result[0].get("name")
-        location = result[0].get("location")
+        name = info.get("name")
+        location = info.get("location")
 
         # === Preparar payload para ESP32 ===
         esp_topic = f"set/{device}/{comp_type}/{comp_id}"
         forward_payload = {"requester": requester}
 
-        command_for_db = None     # lo que persistimos en actuators.state (0/1)
         notify_value = None       # lo que ponemos en system/notify/set
 
         # ==========================
@@ -101,7 +133,6 @@ def handle(db, client, topic, payload):
         if comp_type == "sensor":
             value = _normalize_bool(raw_enable)
             forward_payload["enable"] = value
-            command_for_db = None
             notify_value = value
 
         # ==========================
@@ -111,7 +142,7 @@ def handle(db, client, topic, payload):
             if raw_command is not None:
                 # Movimiento: reenviamos command + speed (si existe)
                 if not isinstance(raw_command, str) or not raw_command.strip():
-                    logger.warning(f"[SYSTEM/SET] command inválido -> {payload}")
+                    logger.warning(f"[SYSTEM/SET] command inválido -> {msg}")
                     return
 
                 cmd = raw_command.strip().upper()
@@ -126,62 +157,86 @@ def handle(db, client, topic, payload):
                     except Exception:
                         logger.warning(f"[SYSTEM/SET] speed inválido (se ignora) -> {raw_speed}")
 
-                # Para mantener compatibilidad en BBDD (0/1)
-                command_for_db = 1 if _motion_bool_from_command(cmd) else 0
                 notify_value = {"command": cmd, "speed": forward_payload.get("speed")}
 
             else:
                 # Actuador simple ON/OFF
                 value = _normalize_bool(raw_state)
                 forward_payload["state"] = value
-                command_for_db = 1 if value else 0
                 notify_value = value
 
-        # === Publicar al ESP32 (QoS 1) ===
-        client.publish(
-            esp_topic,
-            json.dumps(forward_payload),
-            qos=1
-        )
-        logger.info(f"[SET] Enviado -> {esp_topic} ({notify_value})")
-
-        # === Actualizar BD (solo actuadores) ===
-        if comp_type == "actuator" and command_for_db is not None:
-            db.execute(
-                """
-                UPDATE actuators
-                SET state=%s, last_seen=NOW()
-                WHERE device_name=%s AND id=%s
-                """,
-                (command_for_db, device, comp_id),
-                commit=True
+        # === Actualizar estado del dispositivo (heartbeat en lote) ===
+        last_seen_tracker.touch(device)
+
+        key = (device, comp_type, comp_id)
+        response_topic = f"system/response/{requester}/{comp_type}/{device}/{comp_id}"
+
+        # === Orden que no cambia nada: ni ESP32 ni BBDD ===
+        # Solo si no hay otra orden en curso que pueda cambiar el estado
+        confirmed = state_store.observed(comp_type, device, comp_id)
+        if (
+            _matches_confirmed(comp_type, forward_payload, confirmed)
+            and command_queue.is_idle(key)
+            and not inflight.has_pending(device, comp_type, comp_id, kind="set")
+        ):
+            command_queue.record_skip()
+            client.publish(
+                response_topic,
+                encode({**_state_payload(device, comp_type, comp_id), "unchanged": True}),
+                qos=1
+            )
+            logger.info(f"[SET] {esp_topic} ya está en el estado pedido ({notify_value}); no se envía")
+            return
+
+        def send():
+            # === Publicar al ESP32 (QoS 1, con correlation id) ===
+            # Se reenvía con backoff hasta que llegue su response/#; la BBDD
+            # solo se actualiza con el estado confirmado (handlers/response.py)
+            entry = inflight.begin(
+                "set", device, comp_type, comp_id, requester,
+                expect=_expected_state(comp_type, forward_payload)
+            )
+            esp_payload = encode({**forward_payload, "cid": entry.cid})
+            inflight.track_delivery(entry, esp_topic, esp_payload)
+
+            status = outbound.publish(
+                client, device, esp_topic, esp_payload, qos=1,
+                on_sent=lambda: inflight.mark_sent(entry.cid)
+            )
+            logger.info(f"[SET] {esp_topic} ({notify_value}): {status}")
+
+            # === Publicar notificación global (QoS 1) ===
+            notify_msg = {
+                "device": device,
+                "type": comp_type,
+                "id": comp_id,
+                "name": name,
+                "location": location,
+                "value": notify_value,
+                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "source": requester
+            }
+
+            client.publish(
+                "system/notify/set",
+                encode(notify_msg),
+                qos=1
+            )
+            logger.info("[NOTIFY] Publicado -> system/notify/set")
+
+        def dropped(reason):
+            # Estado actual (no el pedido) + motivo, como cualquier respuesta
+            client.publish(
+                response_topic,
+                encode({**_state_payload(device, comp_type, comp_id), "status": reason}),
+                qos=1
             )
+            logger.info(f"[SET] Orden a {esp_topic} descartada ({reason}): {notify_value}")
 
-        # === Actualizar estado del dispositivo ===
-        db.execute(
-            "UPDATE devices SET last_seen=NOW() WHERE device_name=%s",
-            (device,),
-            commit=True
-        )
-
-        # === Publicar notificación global (QoS 1) ===
-        notify_msg = {
-            "device": device,
-            "type": comp_type,
-            "id": comp_id,
-            "name": name,
-            "location": location,
-            "value": notify_value,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "source": requester
-        }
-
-        client.publish(
-            "system/notify/set",
-            safe_json_dumps(notify_msg),
-            qos=1
-        )
-        logger.info("[NOTIFY] Publicado -> system/notify/set")
+        # === Cola por actuador: dentro de la ventana solo se envía la última orden ===
+        signature = tuple(sorted((k, v) for k, v in forward_payload.items() if k != "requester"))
+        if command_queue.submit(key, signature, send, dropped) == "queued":
+            logger.info(f"[SET] Orden a {esp_topic} en cola ({notify_value})")
 
     except Exception as e:
         logger.error(f"[SYSTEM/SET] Error procesando petición: {e}")
@@ -1,6 +1,9 @@
 from config import logger
-import json
-from handlers.utils import ensure_device, ensure_component
+from core.codec import decode, encode
+from core.inflight import inflight
+from core.state_store import state_store, now
+from database.reading_writer import reading_writer
+from handlers.utils import ensure_device, ensure_component, sensor_value
 
 
 def _normalize_state_bool(raw_state):
@@ -79,7 +82,7 @@ def _extract_enabled(payload):
     return _normalize_state_bool(enabled_raw)
 
 
-def handle(db, client, topic, payload):
+def handle(db, client, route, payload):
     """
     Procesa 'response/#' de ESP32:
     - actualiza BD con estado real
@@ -92,29 +95,13 @@ def handle(db, client, topic, payload):
     - Para actuadores, persiste estado estable (OPEN/CLOSED) como 1/0.
     """
     try:
-        parts = topic.split("/")
-        if len(parts) < 4:
-            logger.warning(f"[RESPONSE] Tópico inválido: {topic}")
-            return
-
-        _, device, comp_type, comp_id = parts[:4]
-
-        try:
-            comp_id = int(comp_id)
-        except ValueError:
-            logger.warning(f"[RESPONSE] ID inválido: {comp_id}")
-            return
-
-        if comp_type not in ["sensor", "actuator"]:
-            logger.warning(f"[RESPONSE] Tipo inválido: {comp_type}")
-            return
-
-        ensure_device(db, device)
-        ensure_component(db, comp_type, device, comp_id)
+        # === Parámetros del tópico (ya validados por el router) ===
+        device, comp_type, comp_id = route.device, route.comp_type, route.comp_id
+        topic = route.topic
 
         if not isinstance(payload, dict):
             try:
-                payload = json.loads(payload)
+                payload = decode(payload)
             except Exception:
                 logger.warning(f"[RESPONSE] Payload no JSON: {topic}")
                 return
@@ -140,51 +127,92 @@ def handle(db, client, topic, payload):
         if comp_type == "sensor":
             enabled = _extract_enabled(payload)
 
+        # === Emparejar con la petición GET/SET en vuelo ===
+        # Sin cid, el estado informado decide qué SET confirma
+        reported = {}
+        if state_db is not None:
+            reported["state"] = state_db
+        if enabled is not None:
+            reported["enabled"] = 1 if enabled else 0
+        match = inflight.complete(
+            device, comp_type, comp_id, payload.pop("cid", None), reported
+        )
+        cid = None
+        requesters = [requester] if requester else []
+        if match is not None:
+            entry, latency_ms = match
+            cid = entry.cid
+            # GET agrupados: la misma respuesta va a todos los que esperaban
+            requesters = list(dict.fromkeys(requesters + entry.requesters))
+            logger.info(
+                f"[RESPONSE] {entry.kind.upper()} {device}/{comp_type}/{comp_id} "
+                f"respondido en {latency_ms:.0f} ms (cid={cid})"
+            )
+
         # === Actualizar BD ===
         try:
-            if comp_type == "sensor":
-                # Actualiza lectura si viene
-                if value is not None:
-                    db.execute(
-                        """
-                        UPDATE sensors
-                        SET value=%s, unit=%s, last_seen=NOW()
-                        WHERE device_name=%s AND id=%s
-                        """,
-                        (value, units, device, comp_id),
-                        commit=True
-                    )
-                    logger.info(f"[DB][RESPONSE] Sensor {device}/{comp_id} -> {value} {units or ''}")
-
-                # Actualiza enabled si viene (ack de SET)
-                if enabled is not None:
-                    db.execute(
-                        """
-                        UPDATE sensors
-                        SET enabled=%s, last_seen=NOW()
-                        WHERE device_name=%s AND id=%s
-                        """,
-                        (1 if enabled else 0, device, comp_id),
-                        commit=True
-                    )
-                    logger.info(f"[DB][RESPONSE] Sensor {device}/{comp_id} -> enabled={enabled}")
-
-            elif comp_type == "actuator":
-                # Persistimos solo si es estado estable (0/1) según política
-                if state_db is not None:
-                    db.execute(
-                        """
-                        UPDATE actuators
-                        SET state=%s, last_seen=NOW()
-                        WHERE device_name=%s AND id=%s
-                        """,
-                        (state_db, device, comp_id),
-                        commit=True
-                    )
-                    logger.info(f"[DB][RESPONSE] Actuador {device}/{comp_id} -> state={state_db}")
-                else:
-                    logger.info(
-                        f"[DB][RESPONSE] Actuador {device}/{comp_id} -> state no estable (no persistido): {raw_state}"
+            # Todas las escrituras del mensaje comparten un commit
+            with db.transaction():
+                ensure_device(db, device)
+                ensure_component(db, comp_type, device, comp_id)
+
+                # Columnas actualizadas (para la vista en memoria)
+                fields = {}
+
+                if comp_type == "sensor":
+                    # Actualiza lectura si viene (la columna es FLOAT)
+                    reading = sensor_value(value)
+                    if value is not None and reading is None:
+                        logger.warning(f"[DB][RESPONSE] Valor no numérico ({device}/{comp_id}): {value}")
+                    elif reading is not None:
+                        db.execute(
+                            """
+                            UPDATE sensors
+                            SET value=%s, unit=%s, last_seen=NOW()
+                            WHERE device_name=%s AND id=%s
+                            """,
+                            (reading, units, device, comp_id)
+                        )
+                        fields.update(value=reading, unit=units)
+                        db.on_commit(lambda: reading_writer.add(device, comp_id, reading))
+                        logger.info(f"[DB][RESPONSE] Sensor {device}/{comp_id} -> {reading} {units or ''}")
+
+                    # Actualiza enabled si viene (ack de SET)
+                    if enabled is not None:
+                        db.execute(
+                            """
+                            UPDATE sensors
+                            SET enabled=%s, last_seen=NOW()
+                            WHERE device_name=%s AND id=%s
+                            """,
+                            (1 if enabled else 0, device, comp_id)
+                        )
+                        fields["enabled"] = 1 if enabled else 0
+                        logger.info(f"[DB][RESPONSE] Sensor {device}/{comp_id} -> enabled={enabled}")
+
+                elif comp_type == "actuator":
+                    # Persistimos solo si es estado estable (0/1) según política
+                    if state_db is not None:
+                        db.execute(
+                            """
+                            UPDATE actuators
+                            SET state=%s, last_seen=NOW()
+                            WHERE device_name=%s AND id=%s
+                            """,
+                            (state_db, device, comp_id)
+                        )
+                        fields["state"] = state_db
+                        logger.info(f"[DB][RESPONSE] Actuador {device}/{comp_id} -> state={state_db}")
+                    else:
+                        logger.info(
+                            f"[DB][RESPONSE] Actuador {device}/{comp_id} -> state no estable (no persistido): {raw_state}"
+                        )
+
+                if fields:
+                    db.on_commit(
+                        lambda: state_store.upsert_component(
+                            comp_type, device, comp_id, last_seen=now(), **fields
+                        )
                     )
 
         except Exception as e:
@@ -192,6 +220,8 @@ def handle(db, client, topic, payload):
 
         # === Construir payload de respuesta ===
         payload_resp = {"device": device, "type": comp_type, "id": comp_id}
+        if cid is not None:
+            payload_resp["cid"] = cid
 
         if comp_type == "sensor":
             payload_resp.update({"value": value, "units": units})
@@ -208,17 +238,31 @@ def handle(db, client, topic, payload):
             if state_text is not None:
                 payload_resp["state_text"] = state_text
 
-        payload_json = json.dumps(payload_resp)
-
-        # === 1) Responder al requester original (si existe) ===
-        if requester:
+        # === Último estado confirmado (system/get con max_age y SET sin cambios) ===
+        # Todo campo confirmado se anota; solo una lectura (valor del sensor
+        # o estado estable del actuador) renueva la edad de la observación
+        reading = value if comp_type == "sensor" else state_db
+        observed = {
+            k: v for k, v in payload_resp.items()
+            if k not in ("device", "type", "id", "cid")
+            and (reading is not None or k == "enabled")
+        }
+        if observed:
+            state_store.observe(
+                comp_type, device, comp_id, refresh=reading is not None, **observed
+            )
+
+        payload_json = encode(payload_resp)
+
+        # === 1) Responder a los requesters (original + GET agrupados) ===
+        for requester in requesters:
             topic_resp = f"system/response/{requester}/{comp_type}/{device}/{comp_id}"
             client.publish(topic_resp, payload_json, qos=1)
             logger.info(f"[SYSTEM/RESPONSE] Enviado a requester={requester}: {topic_resp}")
 
-        # === 2) Tap hacia telegram-service SIEMPRE que requester no sea telegram-service ===
+        # === 2) Tap hacia telegram-service SIEMPRE que no sea ya uno de los requesters ===
         telegram_requester = "telegram-service"
-        if requester != telegram_requester:
+        if telegram_requester not in requesters:
             topic_tg = f"system/response/{telegram_requester}/{comp_type}/{device}/{comp_id}"
             client.publish(topic_tg, payload_json, qos=1)
             logger.info(f"[SYSTEM/RESPONSE] Tap a {telegram_requester}: {topic_tg}")
@@ -0,0 +1,59 @@
+from config import logger
+from core.codec import encode
+from core.messages import DiagRequest, MessageError
+from core.profiler import profiler
+
+
+STATUS_TOPIC = "system/diag/mqtt-router/status"
+RESULT_TOPIC = "system/diag/mqtt-router/result"
+
+
+def _publish(client, topic, body):
+    client.publish(topic, encode(body), qos=1)
+
+
+def handle(db, client, route, payload):
+    """
+    Handler de system/diag/mqtt-router: perfilado de CPU del router en caliente.
+
+      {"action": "start", "duration_s": 30, "interval_ms": 10, "top": 20}
+      {"action": "stop"}    -> termina antes de tiempo
+      {"action": "status"}
+
+    El estado se publica en system/diag/mqtt-router/status y, al terminar
+    la sesión, el hilo del perfilador publica el resumen de funciones más
+    costosas en .../result.
+    """
+
+    try:
+        # === Validación del payload ===
+        try:
+            msg = DiagRequest.from_payload(payload)
+        except MessageError as e:
+            logger.warning(f"[DIAG] Petición inválida: {e}")
+            _publish(client, STATUS_TOPIC, {"state": "error", "error": str(e)})
+            return
+
+        if msg.action == "start":
+            session = profiler.start(
+                msg.duration_s, msg.interval_ms, msg.top, msg.idle,
+                on_done=lambda result: _publish(client, RESULT_TOPIC, result)
+            )
+            if session is None:
+                logger.warning("[DIAG] Ya hay un perfilado en curso")
+                _publish(client, STATUS_TOPIC, {"error": "busy", **profiler.status()})
+                return
+            _publish(client, STATUS_TOPIC, session)
+
+        elif msg.action == "stop":
+            # Solo se avisa al hilo del perfilador: él publica el resultado
+            if profiler.stop(wait=False):
+                _publish(client, STATUS_TOPIC, {"state": "stopping"})
+            else:
+                _publish(client, STATUS_TOPIC, profiler.status())
+
+        else:
+            _publish(client, STATUS_TOPIC, profiler.status())
+
+    except Exception as e:
+        logger.error(f"[DIAG] Error procesando petición: {e}")
@@ -1,39 +1,28 @@
 from config import logger
-from datetime import datetime
-import json
-from handlers.utils import ensure_device, ensure_component
-
-def handle(db, client, topic, payload):
+from core.codec import decode
+from core.registry import registry
+from core.state_store import state_store, now
+from handlers.utils import ensure_device, ensure_component, sensor_value
+from database.last_seen import last_seen_tracker
+from database.log_writer import log_writer
+
+def handle(db, client, route, payload):
     """
     Handler de system/notify/#.
     Observa eventos internos, los registra y opcionalmente los almacena.
     """
 
     try:
-        parts = topic.split("/")
-
-        if len(parts) < 3:
-            logger.warning(f"[SYSTEM/NOTIFY] Tópico inválido: {topic}")
-            return
-
-        # === Detectar tipo de evento ===
-        # system/notify/<event>
-        if len(parts) == 3:
-            event_type = parts[2]
-
-        # system/notify/<device>/<event>
-        elif len(parts) >= 4:
-            event_type = parts[3]
-
-        else:
-            event_type = "unknown"
+        topic = route.topic
 
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # === Tipo de evento ===
+        # system/notify/<event> o system/notify/<device>/<event>
+        event_type = route.event
 
         # === Validación del payload ===
         if not isinstance(payload, dict):
             try:
-                payload = json.loads(payload)
+                payload = decode(payload)
             except Exception:
                 logger.warning(f"[SYSTEM/NOTIFY] Payload no JSON en {topic}")
                 return
@@ -41,8 +30,21 @@ def handle(db, client, topic, payload):
         # === Log detallado ===
         logger.info(f"[SYSTEM/NOTIFY] [{event_type.upper()}] {payload}")
 
+        # === Invalidación explícita de la caché (cambios hechos fuera del router) ===
+        # system/notify/invalidate {"device": ...} o system/notify/<device>/invalidate
+        if event_type == "invalidate":
+            device = route.get("device") or payload.get("device")
+            registry.invalidate(device)
+            if device:
+                state_store.reload_device(db, device)
+            else:
+                state_store.warm(db)
+            logger.info(f"[SYSTEM/NOTIFY] Caché invalidada ({device or 'completa'})")
+            return
+
         # === Persistir updates si vienen directamente por notify ===
-        if event_type == "update":
+        # (los publicados por el propio router ya están en BBDD)
+        if event_type == "update" and payload.get("source") != "mqtt-router":
             try:
                 device = payload.get("device")
                 comp_type = payload.get("type")
@@ -53,102 +55,96 @@ def handle(db, client, topic, payload):
                 elif comp_type not in ["sensor", "actuator"]:
                     logger.warning(f"[SYSTEM/NOTIFY] Tipo inválido: {comp_type}")
                 else:
-                    # Garantizar filas previas para que el UPDATE funcione
-                    ensure_device(db, device)
-                    ensure_component(
-                        db,
-                        comp_type,
-                        device,
-                        comp_id,
-                        payload.get("name"),
-                        payload.get("location"),
-                    )
-
-                    if comp_type == "sensor":
-                        value = payload.get("value")
-                        unit = payload.get("units") or payload.get("unit")
-
-                        # Si no viene unidad, intentar reutilizar la que ya tenga el sensor
-                        if unit in (None, ""):
-                            try:
-                                prev = db.execute(
-                                    "SELECT unit FROM sensors WHERE device_name=%s AND id=%s LIMIT 1",
-                                    (device, comp_id),
+                    # Todas las escrituras del update comparten un commit
+                    with db.transaction():
+                        # Garantizar filas previas para que el UPDATE funcione
+                        ensure_device(db, device)
+                        ensure_component(
+                            db,
+                            comp_type,
+                            device,
+                            comp_id,
+                            payload.get("name"),
+                            payload.get("location"),
+                        )
+
+                        # Columnas actualizadas (para la vista en memoria)
+                        fields = {}
+
+                        if comp_type == "sensor":
+                            value = payload.get("value")
+                            unit = payload.get("units") or payload.get("unit")
+
+                            # Si no viene unidad, intentar reutilizar la que ya tenga el sensor
+                            if unit in (None, ""):
+                                try:
+                                    prev = db.execute(
+                                        "SELECT unit FROM sensors WHERE device_name=%s AND id=%s LIMIT 1",
+                                        (device, comp_id),
+                                    )
+                                    if prev and prev[0].get("unit"):
+                                        unit = prev[0]["unit"]
+                                except Exception:
+                                    # Si falla la lectura, seguimos sin unidad
+                                    pass
+
+                            reading = sensor_value(value)
+                            if value is None:
+                                logger.warning(f"[SYSTEM/NOTIFY] Sensor sin valor ({device}/{comp_id})")
+                            elif reading is None:
+                                logger.warning(f"[SYSTEM/NOTIFY] Valor no numérico ({device}/{comp_id}): {value}")
+                            else:
+                                db.execute(
+                                    """
+                                    UPDATE sensors
+                                    SET value=%s, unit=%s, last_seen=NOW()
+                                    WHERE device_name=%s AND id=%s
+                                    """,
+                                    (reading, unit, device, comp_id)
                                 )
-                                if prev and prev[0].get("unit"):
-                                    unit = prev[0]["unit"]
-                            except Exception:
-                                # Si falla la lectura, seguimos sin unidad
-                                pass
-
-                        if value is None:
-                            logger.warning(f"[SYSTEM/NOTIFY] Sensor sin valor ({device}/{comp_id})")
+                                fields = {"value": reading, "unit": unit}
+                                logger.info(f"[DB] Sensor (notify) actualizado: {device}/{comp_id} -> {value} {unit or ''}")
                         else:
-                            db.execute(
-                                """
-                                UPDATE sensors
-                                SET value=%s, unit=%s, last_seen=NOW()
-                                WHERE device_name=%s AND id=%s
-                                """,
-                                (value, unit, device, comp_id),
-                                commit=True
-                            )
-                            logger.info(f"[DB] Sensor (notify) actualizado: {device}/{comp_id} -> {value} {unit or ''}")
-                    else:
-                        raw_state = payload.get("state")
+                            raw_state = payload.get("state")
 
-                        if raw_state is None:
-                            logger.warning(f"[SYSTEM/NOTIFY] Actuador sin estado ({device}/{comp_id})")
-                        else:
-                            if isinstance(raw_state, str):
-                                raw_state = raw_state.strip().lower()
-                                state = raw_state in ["1", "true", "on", "enabled"]
+                            if raw_state is None:
+                                logger.warning(f"[SYSTEM/NOTIFY] Actuador sin estado ({device}/{comp_id})")
                             else:
-                                state = bool(raw_state)
-
-                            db.execute(
-                                """
-                                UPDATE actuators
-                                SET state=%s, last_seen=NOW()
-                                WHERE device_name=%s AND id=%s
-                                """,
-                                (state, device, comp_id),
-                                commit=True
-                            )
-                            logger.info(
-                                f"[DB] Actuador (notify) actualizado: {device}/{comp_id} -> {state}"
-                            )
+                                if isinstance(raw_state, str):
+                                    raw_state = raw_state.strip().lower()
+                                    state = raw_state in ["1", "true", "on", "enabled"]
+                                else:
+                                    state = bool(raw_state)
+
+                                db.execute(
+                                    """
+                                    UPDATE actuators
+                                    SET state=%s, last_seen=NOW()
+                                    WHERE device_name=%s AND id=%s
+                                    """,
+                                    (state, device, comp_id)
+                                )
+                                fields = {"state": 1 if state else 0}
+                                logger.info(
+                                    f"[DB] Actuador (notify) actualizado: {device}/{comp_id} -> {state}"
+                                )
 
-                    # Mantener vivo el dispositivo si pudimos procesar algo
-                    if device:
-                        db.execute(
-                            "UPDATE devices SET last_seen=NOW() WHERE device_name=%s",
-                            (device,),
-                            commit=True
-                        )
+                        # Mantener vivo el dispositivo si pudimos procesar algo
+                        last_seen_tracker.touch(device)
+                        if fields:
+                            db.on_commit(
+                                lambda: state_store.upsert_component(
+                                    comp_type, device, comp_id, last_seen=now(), **fields
+                                )
+                            )
 
             except Exception as e:
                 logger.error(f"[SYSTEM/NOTIFY] Error persistiendo update: {e}")
 
-        # === Persistencia selectiva ===
+        # === Persistencia selectiva (auditoría en segundo plano) ===
         if event_type in ("announce", "alert"):
-            try:
-                query = """
-                    INSERT INTO system_logs (timestamp, topic, event_type, payload)
-                    VALUES (%s, %s, %s, %s)
-                """
-                db.execute(
-                    query,
-                    (timestamp, topic, event_type, json.dumps(payload)),
-                    commit=True
-                )
-                logger.info(
-                    f"[SYSTEM/NOTIFY] Evento '{event_type}' persistido en system_logs"
-                )
-            except Exception as e:
-                logger.error(
-                    f"[SYSTEM/NOTIFY] Error guardando log '{event_type}': {e}"
-                )
+            log_writer.add(topic, event_type, payload)
+            logger.debug(f"[SYSTEM/NOTIFY] Evento '{event_type}' encolado para system_logs")
 
     except Exception as e:
         logger.error(f"[SYSTEM/NOTIFY] Error procesando notificación: {e}")
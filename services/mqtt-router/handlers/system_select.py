@@ -1,53 +1,412 @@
-from config import logger
-from handlers.utils import safe_json_dumps
-from datetime import datetime
-import json
+from config import ALERT_CFG, HISTORY_CFG, logger
+from core.alert_suppressor import alert_suppressor
+from core.changelog import changelog, TABLES
+from core.codec import encode
+from core.command_queue import command_queue
+from core.dispatcher import dispatcher
+from core.inflight import inflight
+from core.outbound import outbound
+from core.messages import MessageError, SEVERITY_RANK
+from core.state_store import state_store
+from database.history import fetch_history, resolution_for
+from datetime import datetime, timedelta
 
 
-def handle(db, client, topic, payload):
+def _publish_pages(client, requester, req_type, rows, msg, extra=None):
+    """
+    Modo por lotes: publica las filas en páginas de msg.page_size en
+    system/response/<requester>/<req_type>/page/<n>.
+
+    Cada página incluye índice, nº total de páginas/filas y un cursor de
+    continuación (None en la última). 'cursor' y 'max_pages' en la petición
+    permiten reanudar un volcado o pedirlo por tramos.
+    """
+    total = len(rows)
+    page_size = msg.page_size
+    pages = max(1, -(-total // page_size))
+    offset = msg.cursor or 0
+    snapshot_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    sent = 0
+    while True:
+        page = offset // page_size
+        items = rows[offset:offset + page_size]
+        next_offset = offset + len(items)
+        complete = next_offset >= total
+
+        client.publish(
+            f"system/response/{requester}/{req_type}/page/{page}",
+            encode({
+                "request": req_type,
+                "page": page,
+                "pages": pages,
+                "page_size": page_size,
+                "total": total,
+                "count": len(items),
+                "items": items,
+                "cursor": None if complete else str(next_offset),
+                "complete": complete,
+                "snapshot_ts": snapshot_ts,
+                **(extra or {}),
+            }),
+            qos=1
+        )
+
+        sent += 1
+        offset = next_offset
+        if complete or (msg.max_pages and sent >= msg.max_pages):
+            break
+
+    logger.info(
+        f"[SYSTEM/SELECT] {req_type}: {sent} páginas enviadas a {requester} "
+        f"({total} filas, página={page_size})"
+    )
+
+
+def _inventory(db, table, device=None, comp_id=None):
+    """
+    Filas de devices/sensors/actuators. Se sirven desde la vista en memoria;
+    MariaDB solo se consulta en frío (si la precarga no ha sido posible).
+    Devuelve None si la lectura falla.
+    """
+    if state_store.warmed or state_store.warm(db):
+        return state_store.rows(table, device, comp_id)
+
+    if table == "devices":
+        return db.execute("SELECT * FROM devices ORDER BY device_name")
+    if device and comp_id is not None:
+        return db.execute(
+            f"SELECT * FROM {table} WHERE device_name=%s AND id=%s", (device, comp_id)
+        )
+    if device:
+        return db.execute(
+            f"SELECT * FROM {table} WHERE device_name=%s ORDER BY id", (device,)
+        )
+    return db.execute(f"SELECT * FROM {table} ORDER BY device_name, id")
+
+
+def _fetch_rows(db, table, keys):
+    """
+    Filas actuales de 'table' para las claves [(device, id|None), ...]
+    (memoria, o una sola consulta en frío). Devuelve {clave: fila} o None
+    si la lectura falla.
+    """
+    if state_store.warmed:
+        found = {}
+        for device, comp_id in keys:
+            row = state_store.get(table, device, comp_id)
+            if row is not None:
+                found[(device, comp_id)] = row
+        return found
+
+    if table == "devices":
+        marks = ", ".join(["%s"] * len(keys))
+        rows = db.execute(
+            f"SELECT * FROM devices WHERE device_name IN ({marks})",
+            [device for device, _ in keys]
+        )
+        if rows is None:
+            return None
+        return {(row["device_name"], None): row for row in rows}
+
+    marks = ", ".join(["(%s, %s)"] * len(keys))
+    rows = db.execute(
+        f"SELECT * FROM {table} WHERE (device_name, id) IN ({marks})",
+        [p for key in keys for p in key]
+    )
+    if rows is None:
+        return None
+    return {(row["device_name"], int(row["id"])): row for row in rows}
+
+
+def _publish_changes(db, client, requester, req_type, msg):
+    """
+    Sincronización delta: devuelve solo las filas insertadas, modificadas o
+    eliminadas después de msg.since. Si el epoch no coincide (el router se
+    reinició) o la secuencia es del futuro, se envía el estado completo
+    con full=true.
+    """
+    tables = TABLES if req_type == "all" else (req_type,)
+
+    # La secuencia se lee antes que las filas: un cambio concurrente como
+    # mucho se reenvía en la siguiente sincronización, nunca se pierde.
+    epoch, seq = changelog.current()
+    full = msg.epoch != epoch or msg.since > seq
+
+    items = []
+    if full:
+        for table in tables:
+            rows = _inventory(db, table)
+            if rows is None:
+                logger.error(f"[SYSTEM/SELECT] Error leyendo {table} para resync de {requester}")
+                return
+            for row in rows:
+                items.append({
+                    "seq": seq,
+                    "table": table,
+                    "op": "upsert",
+                    "device": row["device_name"],
+                    "id": row.get("id") if table != "devices" else None,
+                    "row": row,
+                })
+    else:
+        changes = [c for c in changelog.since(msg.since) if c[1] in tables]
+
+        by_table = {}
+        for _, table, device, comp_id, _ in changes:
+            by_table.setdefault(table, []).append((device, comp_id))
+
+        current = {}
+        for table, keys in by_table.items():
+            rows = _fetch_rows(db, table, keys)
+            if rows is None:
+                logger.error(f"[SYSTEM/SELECT] Error leyendo cambios de {table} para {requester}")
+                return
+            current[table] = rows
+
+        for change_seq, table, device, comp_id, op in changes:
+            row = current[table].get((device, comp_id))
+            # Una fila que ya no existe se notifica como eliminada
+            if row is None:
+                op = "delete"
+            items.append({
+                "seq": change_seq,
+                "table": table,
+                "op": op,
+                "device": device,
+                "id": comp_id,
+                "row": row if op != "delete" else None,
+            })
+
+    header = {"epoch": epoch, "since": msg.since, "seq": seq, "full": full}
+
+    if msg.page_size:
+        _publish_pages(client, requester, "changes", items, msg, extra=header)
+        return
+
+    client.publish(
+        f"system/response/{requester}/changes",
+        encode({"request": req_type, **header, "count": len(items), "changes": items}),
+        qos=1
+    )
+
+    logger.info(
+        f"[SYSTEM/SELECT] {'Resync completo' if full else 'Delta'} a {requester}: "
+        f"{len(items)} cambios (since={msg.since}, seq={seq})"
+    )
+
+
+# Orden de las alertas: columnas de la clave de paginación (todas DESC)
+ALERT_KEYS = {
+    "severity": ("severity_rank", "timestamp", "id"),
+    "time": ("timestamp", "id"),
+}
+
+
+def _alert_page(db, msg):
+    """
+    Una página del histórico de alertas con filtros y paginación por clave.
+
+    En lugar de OFFSET, 'before' lleva la clave de la última alerta recibida
+    (cursor 'next' de la página anterior) y la consulta continúa justo
+    después por el índice: el coste no depende de la profundidad de la
+    página ni del tamaño del histórico. Índices que sirven cada caso:
+      - severity (con o sin filtro de gravedad): (severity_rank, timestamp)
+      - order='time' con device: (device_name, timestamp)
+
+    limit=0 mantiene el comportamiento anterior (todas las alertas que
+    cumplan los filtros, sin tope ni cursor); el resto se acota a
+    ALERT_CFG["max_limit"].
+
+    Devuelve (filas, cursor_siguiente|None); filas es None si la lectura falla.
+    """
+    keys = ALERT_KEYS[msg.order]
+
+    if isinstance(msg.limit, int) and msg.limit == 0:
+        limit = None
+    else:
+        limit = ALERT_CFG["max_limit"]
+        if isinstance(msg.limit, int) and msg.limit > 0:
+            limit = min(msg.limit, limit)
+
+    where, params = [], []
+    if msg.severity:
+        where.append(f"severity_rank IN ({', '.join(['%s'] * len(msg.severity))})")
+        params.extend(SEVERITY_RANK[s] for s in msg.severity)
+    if msg.device:
+        where.append("device_name=%s")
+        params.append(msg.device)
+    if msg.comp_type:
+        where.append("component_type=%s")
+        params.append(msg.comp_type)
+    if msg.id is not None:
+        where.append("component_id=%s")
+        params.append(msg.id)
+    if msg.start:
+        where.append("timestamp >= %s")
+        params.append(msg.start)
+    if msg.end:
+        where.append("timestamp < %s")
+        params.append(msg.end)
+
+    if msg.before:
+        if len(msg.before) != len(keys):
+            raise MessageError(f"before no corresponde a order='{msg.order}': {msg.before}")
+        values = [
+            datetime.fromtimestamp(v) if key == "timestamp" else v
+            for key, v in zip(keys, msg.before)
+        ]
+        # (k1, k2, k3) < (v1, v2, v3) desarrollado para que use el índice
+        branches = []
+        for i, key in enumerate(keys):
+            branches.append(
+                "(" + " AND ".join([f"{k}=%s" for k in keys[:i]] + [f"{key} < %s"]) + ")"
+            )
+            params.extend(values[:i + 1])
+        where.append("(" + " OR ".join(branches) + ")")
+
+    query = "SELECT * FROM alerts"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY " + ", ".join(f"{k} DESC" for k in keys)
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit + 1)
+
+    rows = db.execute(query, params)
+    if rows is None:
+        return None, None
+
+    if limit is None or len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    cursor = ",".join(
+        str(int(last[k].timestamp())) if k == "timestamp" else str(int(last[k]))
+        for k in keys
+    )
+    return rows, cursor
+
+
+def _publish_history(db, client, requester, msg):
+    """
+    Serie temporal de un sensor entre msg.start y msg.end (por defecto la
+    última hora). Con resolution='auto' el nivel (bruto/1m/1h) se elige por
+    la amplitud del rango para acotar el nº de puntos.
+    """
+    device, sensor_id = msg.device, msg.id
+    if not device or sensor_id is None:
+        logger.warning("[SYSTEM/SELECT] history requiere 'device' e 'id'")
+        return
+
+    end = msg.end or datetime.now()
+    start = msg.start or end - timedelta(hours=1)
+    if start >= end:
+        logger.warning(f"[SYSTEM/SELECT] Rango de history vacío ({start} >= {end})")
+        return
+
+    resolution = msg.resolution
+    if resolution == "auto":
+        resolution = resolution_for(start, end)
+
+    limit = HISTORY_CFG["max_points"]
+    if isinstance(msg.limit, int) and msg.limit > 0:
+        limit = min(msg.limit, limit)
+
+    # Una fila de más para saber si la serie se ha truncado
+    rows = fetch_history(db, device, sensor_id, start, end, resolution, limit + 1)
+    if rows is None:
+        logger.error(f"[SYSTEM/SELECT] Error leyendo histórico de {device}/{sensor_id}")
+        return
+
+    truncated = len(rows) > limit
+    ts_fmt = "%Y-%m-%d %H:%M:%S.%f" if resolution == "raw" else "%Y-%m-%d %H:%M:%S"
+    points = []
+    for row in rows[:limit]:
+        ts = row["ts"].strftime(ts_fmt)
+        if resolution == "raw":
+            points.append({"ts": ts[:-3], "value": row["value"]})
+        else:
+            points.append({
+                "ts": ts,
+                "min": row["min_value"],
+                "max": row["max_value"],
+                "avg": row["avg_value"],
+                "samples": row["samples"],
+            })
+
+    header = {
+        "device": device,
+        "id": sensor_id,
+        "resolution": resolution,
+        "from": start.strftime("%Y-%m-%d %H:%M:%S"),
+        "to": end.strftime("%Y-%m-%d %H:%M:%S"),
+        "truncated": truncated,
+    }
+
+    if msg.page_size:
+        _publish_pages(client, requester, "history", points, msg, extra=header)
+        return
+
+    client.publish(
+        f"system/response/{requester}/history/{device}/{sensor_id}",
+        encode({"request": "history", **header, "count": len(points), "points": points}),
+        qos=1
+    )
+
+    logger.info(
+        f"[SYSTEM/SELECT] history {device}/{sensor_id} ({resolution}): "
+        f"{len(points)} puntos a {requester}"
+    )
+
+
+def handle(db, client, route, msg):
     """
     Handler para system/select/# (acceso a BBDD para microservicios internos).
     """
 
     try:
         # === Identificar requester ===
-        parts = topic.split("/")
-        requester = parts[2] if len(parts) > 2 else "unknown"
-
-        # === Extraer parámetros ===
-        req_type = payload.get("request")
-        device = payload.get("device")
-        comp_id = payload.get("id")
-
-        try:
-            comp_id = int(comp_id) if comp_id is not None else None
-        except ValueError:
-            logger.warning(f"[SYSTEM/SELECT] ID inválido: {comp_id}")
-            return
+        requester = route.requester
+
+        req_type, device, comp_id = msg.request, msg.device, msg.id
 
-        if not req_type:
-            logger.warning("[SYSTEM/SELECT] Falta campo 'request'")
+        # ===============================================================
+        # SINCRONIZACIÓN DELTA (since=<seq>)
+        # ===============================================================
+        if msg.since is not None:
+            if req_type != "all" and req_type not in TABLES:
+                logger.warning(f"[SYSTEM/SELECT] 'since' no soportado para '{req_type}'")
+                return
+            _publish_changes(db, client, requester, req_type, msg)
             return
 
+        # Punto de sincronización de los volcados por páginas (leído antes que las filas)
+        epoch, seq = changelog.current()
+        sync = {"epoch": epoch, "seq": seq}
+
         # ===============================================================
         # ALERTAS
         # ===============================================================
         if req_type == "alerts":
-            limit = payload.get("limit", 10)
-
-            if isinstance(limit, int) and limit == 0:
-                query = "SELECT * FROM alerts ORDER BY severity DESC, timestamp DESC"
-                params = ()
-            else:
-                query = "SELECT * FROM alerts ORDER BY severity DESC, timestamp DESC LIMIT %s"
-                params = (limit,)
+            try:
+                results, next_cursor = _alert_page(db, msg)
+            except MessageError as e:
+                logger.warning(f"[SYSTEM/SELECT] {e}")
+                return
+            if results is None:
+                logger.error(f"[SYSTEM/SELECT] Error leyendo alertas para {requester}")
+                return
 
-            results = db.execute(query, params)
+            if msg.page_size:
+                _publish_pages(client, requester, req_type, results, msg, extra={"next": next_cursor})
+                return
 
             if not results:
                 client.publish(
                     f"system/response/{requester}/alerts/empty",
-                    json.dumps({"status": "no_alerts"}),
+                    encode({"status": "no_alerts"}),
                     qos=1
                 )
                 return
@@ -55,7 +414,7 @@ def handle(db, client, topic, payload):
             for row in results:
                 client.publish(
                     f"system/response/{requester}/alerts/{row['id']}",
-                    safe_json_dumps(row),
+                    encode(row),
                     qos=1
                 )
 
@@ -66,12 +425,16 @@ def handle(db, client, topic, payload):
         # DISPOSITIVOS
         # ===============================================================
         if req_type == "devices":
-            results = db.execute("SELECT * FROM devices ORDER BY device_name")
+            results = _inventory(db, "devices")
+
+            if msg.page_size:
+                _publish_pages(client, requester, req_type, results or [], msg, extra=sync)
+                return
 
             if not results:
                 client.publish(
                     f"system/response/{requester}/devices/empty",
-                    json.dumps({"status": "no_devices"}),
+                    encode({"status": "no_devices"}),
                     qos=1
                 )
                 return
@@ -79,7 +442,7 @@ def handle(db, client, topic, payload):
             for row in results:
                 client.publish(
                     f"system/response/{requester}/devices/{row['device_name']}",
-                    safe_json_dumps(row),
+                    encode(row),
                     qos=1
                 )
             return
@@ -89,23 +452,16 @@ def handle(db, client, topic, payload):
         # ===============================================================
         if req_type in ["sensors", "actuators"]:
             table = req_type
+            results = _inventory(db, table, device, comp_id)
 
-            if device and comp_id is not None:
-                query = f"SELECT * FROM {table} WHERE device_name=%s AND id=%s"
-                params = (device, comp_id)
-            elif device:
-                query = f"SELECT * FROM {table} WHERE device_name=%s ORDER BY id"
-                params = (device,)
-            else:
-                query = f"SELECT * FROM {table} ORDER BY device_name, id"
-                params = ()
-
-            results = db.execute(query, params)
+            if msg.page_size:
+                _publish_pages(client, requester, req_type, results or [], msg, extra=sync)
+                return
 
             if not results:
                 client.publish(
                     f"system/response/{requester}/{table}/empty",
-                    json.dumps({"status": "no_results"}),
+                    encode({"status": "no_results"}),
                     qos=1
                 )
                 return
@@ -113,7 +469,7 @@ def handle(db, client, topic, payload):
             for row in results:
                 client.publish(
                     f"system/response/{requester}/{table}/{row['device_name']}/{row['id']}",
-                    safe_json_dumps(row),
+                    encode(row),
                     qos=1
                 )
             return
@@ -124,21 +480,56 @@ def handle(db, client, topic, payload):
         if req_type == "all":
             snapshot_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-            for table in ["devices", "sensors", "actuators"]:
-                results = db.execute(f"SELECT * FROM {table}")
+            if msg.page_size:
+                rows = []
+                for table in TABLES:
+                    for row in _inventory(db, table) or []:
+                        row["table"] = table
+                        rows.append(row)
+                _publish_pages(client, requester, req_type, rows, msg, extra=sync)
+                return
+
+            for table in TABLES:
+                results = _inventory(db, table) or []
 
                 for row in results:
                     row["snapshot_ts"] = snapshot_ts
                     row_id = row.get("id", row.get("device_name"))
                     client.publish(
                         f"system/response/{requester}/{table}/{row_id}",
-                        safe_json_dumps(row),
+                        encode(row),
                         qos=1
                     )
 
             logger.info("[SYSTEM/SELECT] Enviado dump completo del sistema")
             return
 
+        # ===============================================================
+        # HISTÓRICO DE UN SENSOR
+        # ===============================================================
+        if req_type == "history":
+            _publish_history(db, client, requester, msg)
+            return
+
+        # ===============================================================
+        # LATENCIA GET/SET (percentiles por dispositivo)
+        # ===============================================================
+        if req_type == "latency":
+            client.publish(
+                f"system/response/{requester}/latency",
+                encode({
+                    **inflight.stats(),
+                    "set": command_queue.stats(),
+                    "outbound": outbound.stats(),
+                    "alerts": alert_suppressor.stats(),
+                    "dispatch": dispatcher.stats(),
+                    "devices": inflight.latency(device),
+                    "delivery": inflight.delivery(device),
+                }),
+                qos=1
+            )
+            return
+
         # ===============================================================
         # DESCONOCIDO
         # ===============================================================
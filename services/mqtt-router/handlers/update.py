@@ -1,5 +1,10 @@
 from config import logger
-from handlers.utils import safe_json_dumps, ensure_device, ensure_component
+from core.codec import encode
+from core.state_store import state_store, now
+from handlers.utils import ensure_device, ensure_component
+from database.telemetry_buffer import telemetry_buffer
+from database.last_seen import last_seen_tracker
+from database.reading_writer import reading_writer
 from datetime import datetime
 
 
@@ -45,39 +50,18 @@ def _normalize_actuator_state_for_db(raw_state):
     return None
 
 
-def handle(db, client, topic, payload):
+def handle(db, client, route, msg):
     """
     Procesa 'update/#' desde ESP32:
     - sincroniza estado en BD
     - publica notificación de actualización
     """
     try:
-        # === Parseo del tópico ===
-        parts = topic.split("/")
-        if len(parts) < 4:
-            logger.warning(f"[UPDATE] Tópico inválido: {topic}")
-            return
+        # === Parámetros del tópico (ya validados por el router) ===
+        device, comp_type, comp_id = route.device, route.comp_type, route.comp_id
 
-        _, device, comp_type, comp_id = parts[:4]
-
-        try:
-            comp_id = int(comp_id)
-        except ValueError:
-            logger.warning(f"[UPDATE] ID inválido: {comp_id}")
-            return
-
-        if comp_type not in ["sensor", "actuator"]:
-            logger.warning(f"[UPDATE] Tipo no válido: {comp_type}")
-            return
-
-        # === Extraer valores ===
-        value = payload.get("value")
-        units = payload.get("units") or payload.get("unit")
-        raw_state = payload.get("state")
-
-        # === Asegurar existencia previa ===
-        ensure_device(db, device)
-        ensure_component(db, comp_type, device, comp_id)
+        # === Valores (UpdateMsg ya decodificado por el listener) ===
+        value, units, raw_state = msg.value, msg.unit, msg.state
 
         # === Actualizar BD ===
         state_db = None
@@ -88,16 +72,16 @@ def handle(db, client, topic, payload):
                 logger.warning(f"[UPDATE] Sensor sin valor ({device}/{comp_id})")
                 return
 
-            db.execute(
-                """
-                UPDATE sensors
-                SET value=%s, unit=%s, last_seen=NOW()
-                WHERE device_name=%s AND id=%s
-                """,
-                (value, units, device, comp_id),
-                commit=True
-            )
-            logger.info(f"[DB][UPDATE] Sensor {device}/{comp_id} -> {value} {units or ''}")
+            # Write-behind: device, sensor y last_seen se vuelcan en lote
+            if not telemetry_buffer.add(device, comp_id, value, units):
+                logger.warning(f"[UPDATE] Valor no numérico ({device}/{comp_id}): {value}")
+                return
+
+            reading_writer.add(device, comp_id, value)
+            last_seen_tracker.touch(device)
+            state_store.observe(comp_type, device, comp_id, value=value, units=units)
+
+            logger.info(f"[UPDATE] Sensor {device}/{comp_id} -> {value} {units or ''}")
 
         else:  # actuator
             if raw_state is None:
@@ -108,46 +92,58 @@ def handle(db, client, topic, payload):
             if isinstance(raw_state, str):
                 state_text = raw_state.strip()
 
-            # Persistimos solo si es estado estable
+            # Solo estados estables: un transitorio no responde a un GET
             if state_db is not None:
-                db.execute(
-                    """
-                    UPDATE actuators
-                    SET state=%s, last_seen=NOW()
-                    WHERE device_name=%s AND id=%s
-                    """,
-                    (state_db, device, comp_id),
-                    commit=True
-                )
-                logger.info(f"[DB][UPDATE] Actuador {device}/{comp_id} -> state={state_db}")
-            else:
-                # Al menos marcamos last_seen del actuador (sin tocar state)
-                db.execute(
-                    """
-                    UPDATE actuators
-                    SET last_seen=NOW()
-                    WHERE device_name=%s AND id=%s
-                    """,
-                    (device, comp_id),
-                    commit=True
-                )
-                logger.info(
-                    f"[DB][UPDATE] Actuador {device}/{comp_id} -> state no estable (no persistido): {raw_state}"
+                state_store.observe(
+                    comp_type, device, comp_id, state=state_db, state_text=state_text
                 )
 
-        # === Mantener vivo el dispositivo ===
-        db.execute(
-            "UPDATE devices SET last_seen=NOW() WHERE device_name=%s",
-            (device,),
-            commit=True
-        )
+            # === Escrituras del actuador en una sola transacción ===
+            with db.transaction():
+                # === Asegurar existencia previa ===
+                ensure_device(db, device)
+                ensure_component(db, comp_type, device, comp_id)
+
+                # Persistimos solo si es estado estable
+                if state_db is not None:
+                    db.execute(
+                        """
+                        UPDATE actuators
+                        SET state=%s, last_seen=NOW()
+                        WHERE device_name=%s AND id=%s
+                        """,
+                        (state_db, device, comp_id)
+                    )
+                    logger.info(f"[DB][UPDATE] Actuador {device}/{comp_id} -> state={state_db}")
+                else:
+                    # Al menos marcamos last_seen del actuador (sin tocar state)
+                    db.execute(
+                        """
+                        UPDATE actuators
+                        SET last_seen=NOW()
+                        WHERE device_name=%s AND id=%s
+                        """,
+                        (device, comp_id)
+                    )
+                    logger.info(
+                        f"[DB][UPDATE] Actuador {device}/{comp_id} -> state no estable (no persistido): {raw_state}"
+                    )
+
+                fields = {"last_seen": now()}
+                if state_db is not None:
+                    fields["state"] = state_db
+                db.on_commit(
+                    lambda: state_store.upsert_component(comp_type, device, comp_id, **fields)
+                )
 
         # === Publicar notificación (QoS 1) ===
         notify_msg = {
             "device": device,
             "type": comp_type,
             "id": comp_id,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            # Ya persistido: system/notify no debe volver a escribirlo
+            "source": "mqtt-router"
         }
 
         if comp_type == "sensor":
@@ -162,7 +158,7 @@ def handle(db, client, topic, payload):
         topic_notify = f"system/notify/{device}/update"
         client.publish(
             topic_notify,
-            safe_json_dumps(notify_msg),
+            encode(notify_msg),
             qos=1
         )
 
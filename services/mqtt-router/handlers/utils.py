@@ -1,23 +1,39 @@
-import json
-from datetime import datetime, date
 from config import logger
+from core.codec import encode
+from core.registry import registry
+from core.state_store import state_store, now
+from database.last_seen import last_seen_tracker
 
 def safe_json_dumps(obj):
-    def default(o):
-        if isinstance(o, (datetime, date)):
-            return o.strftime("%Y-%m-%d %H:%M:%S")
+    """Compatibilidad: JSON como str (fechas '%Y-%m-%d %H:%M:%S'). Ver core.codec."""
+    return encode(obj).decode("utf-8")
 
-        raise TypeError(f"Type {type(o)} not serializable")
 
-    return json.dumps(obj, default=default)
+def sensor_value(raw):
+    """
+    Valor de sensor tal como lo guarda la columna FLOAT (sensors.value),
+    para que la vista en memoria devuelva el mismo tipo que la BBDD.
+    None si no es numérico.
+    """
+    try:
+        return float(raw)
+    except (TypeError, ValueError):
+        return None
 
 
 def ensure_device(db, device):
-    """Crea o refresca el dispositivo para cumplir FK y mantener last_seen."""
+    """
+    Crea o refresca el dispositivo para cumplir FK y mantener last_seen.
+    Si el registro ya lo conoce, solo se anota el heartbeat (se persiste en lote).
+    """
     if not device:
         return
+
+    last_seen_tracker.touch(device)
+    if registry.has_device(device):
+        return
     try:
-        db.execute(
+        result = db.execute(
             """
             INSERT INTO devices (device_name, last_seen)
             VALUES (%s, NOW())
@@ -26,15 +42,24 @@ def ensure_device(db, device):
             (device,),
             commit=True
         )
+        if result is not None:
+            db.on_commit(lambda: registry.add_device(device))
+            db.on_commit(lambda: state_store.upsert_device(device, last_seen=now()))
     except Exception as e:
         logger.error(f"[DB] Error asegurando dispositivo {device}: {e}")
 
 
 def ensure_component(db, comp_type, device, comp_id, name=None, location=None):
-    """Garantiza que exista el componente en su tabla sin machacar datos previos."""
+    """
+    Garantiza que exista el componente en su tabla sin machacar datos previos.
+    Si el registro ya lo conoce (y no aporta name/location nuevos), no se toca la BBDD.
+    """
     if comp_type not in ["sensor", "actuator"] or device is None or comp_id is None:
         return
 
+    if registry.has_component(comp_type, device, comp_id, name, location):
+        return
+
     if comp_type == "sensor":
         query = """
             INSERT INTO sensors (id, device_name, name, location, last_seen)
@@ -55,6 +80,17 @@ def ensure_component(db, comp_type, device, comp_id, name=None, location=None):
         """
 
     try:
-        db.execute(query, (comp_id, device, name, location), commit=True)
+        result = db.execute(query, (comp_id, device, name, location), commit=True)
+        if result is not None:
+            db.on_commit(
+                lambda: registry.add_component(comp_type, device, comp_id, name, location)
+            )
+            db.on_commit(
+                lambda: state_store.upsert_component(
+                    comp_type, device, comp_id,
+                    fill={"name": name, "location": location},
+                    last_seen=now()
+                )
+            )
     except Exception as e:
         logger.error(f"[DB] Error asegurando {comp_type} {device}/{comp_id}: {e}")
@@ -1,8 +1,32 @@
-import json
+import signal
 import sys
 import paho.mqtt.client as mqtt
 from config import logger, MQTT_CFG
+from core.codec import decode, decode_as, DecodeError
+from core.alert_suppressor import alert_suppressor
+from core.command_queue import command_queue
+from core.dispatcher import dispatcher, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from core.inflight import inflight
+from core.messages import (
+    AnnounceMsg, UpdateMsg, AlertMsg, SetRequest, GetRequest, SelectRequest, MessageError
+)
+from core.metrics import (
+    metrics, metrics_server, instrument_publish,
+    MESSAGES, HANDLER_SECONDS, MQTT_CONNECTS, MQTT_DISCONNECTS,
+)
+from core.outbound import outbound
+from core.profiler import profiler
+from core.registry import registry
+from core.routes import TopicRouter, log_unrouted
+from core.state_store import state_store
 from database.db_manager import DBManager
+from database.telemetry_buffer import telemetry_buffer
+from database.last_seen import last_seen_tracker
+from database.reading_writer import reading_writer
+from database.history import history_rollup
+from database.retention import retention_job
+from database.log_writer import log_writer
+from database.migrations import run_migrations
 from handlers import (
     announce,
     update,
@@ -11,50 +35,78 @@ from handlers import (
     esp_set,
     esp_get,
     system_select,
-    system_notify
+    system_notify,
+    system_diag
 )
+from handlers.alert import publish_summary
 
 # ============================
-#  Mapeo tópico → handler
+#  Tabla de rutas tópico → handler (+ mensaje tipado del payload)
 # ============================
-HANDLERS = {
+router = (
+    TopicRouter()
     # ESP32 → Router
-    "announce": announce,
-    "update": update,
-    "alert": alert,
-    "response": response,
+    .add("announce/{device}/{comp_type:comp}/{comp_id:int}/#", announce, AnnounceMsg)
+    .add("update/{device}/{comp_type:comp}/{comp_id:int}/#", update, UpdateMsg)
+    .add("alert/{device}/{comp_type:comp}/{comp_id:int}/#", alert, AlertMsg)
+    .add("response/{device}/{comp_type:comp}/{comp_id:int}/#", response)
 
     # Sistema → Router -> ESP32/SYSTEM
-    "system/set": esp_set,
-    "system/get": esp_get,
-    "system/select": system_select,
-    "system/notify": system_notify,
-}
+    .add("system/set/{requester}/#", esp_set, SetRequest)
+    .add("system/get/{requester}/#", esp_get, GetRequest)
+    .add("system/select/{requester}/#", system_select, SelectRequest)
+    .add("system/notify/{event}", system_notify)
+    .add("system/notify/{device}/{event}/#", system_notify)
+
+    # Diagnóstico del propio router (valida él mismo: responde los errores)
+    .add("system/diag/mqtt-router", system_diag)
+)
 
 # Conexión global a la BBDD
 db = DBManager()
 
 
-def resolve_handler(topic: str):
+def shard_key(route):
     """
-    Devuelve el handler correspondiente a un topic MQTT.
+    Clave de particionado de una ruta:
+      - <acción>/<device>/...      -> device (orden garantizado por dispositivo)
+      - system/<acción>/<origen>   -> servicio origen
     """
-    parts = topic.split("/")
+    return route.get("device") or route.get("requester") or route.get("event")
 
-    # Casos simples: announce/#, update/#, alert/#, response/#
-    if parts[0] in HANDLERS:
-        return HANDLERS[parts[0]]
 
-    # Casos system/*
-    if len(parts) >= 2:
-        key = f"{parts[0]}/{parts[1]}"
-        return HANDLERS.get(key)
+# Prioridad por raíz del patrón: lo que espera un usuario (alertas, GET/SET
+# y sus respuestas) antes que la telemetría y los volcados de select
+PRIORITIES = {
+    "alert": PRIORITY_HIGH,
+    "response": PRIORITY_HIGH,
+    "system/set": PRIORITY_HIGH,
+    "system/get": PRIORITY_HIGH,
+    "system/diag": PRIORITY_HIGH,
+    "announce": PRIORITY_NORMAL,
+    "system/notify": PRIORITY_NORMAL,
+    "system/select": PRIORITY_LOW,
+}
+
+
+def priority_for(route):
+    """
+    (prioridad, coalesce_key) de una ruta. Solo la telemetría de sensores
+    (update/<device>/sensor/<id>) puede reducirse al último valor.
+    """
+    if route.pattern.startswith("update/"):
+        if route.comp_type == "sensor":
+            return PRIORITY_LOW, route.topic
+        return PRIORITY_NORMAL, None
 
-    return None
+    root = route.pattern.split("/", 2)
+    name = root[0] if root[0] != "system" else "/".join(root[:2])
+    return PRIORITIES.get(name, PRIORITY_NORMAL), None
 
 
 def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
+        MQTT_CONNECTS.inc()
         logger.info("[MQTT] Conectado correctamente al broker")
 
         for topic, qos in MQTT_CFG["topics"]:
@@ -64,30 +116,113 @@ def on_connect(client, userdata, flags, reason_code, properties):
         logger.error(f"[MQTT] Error al conectar: código {reason_code}")
 
 
+def on_disconnect(client, userdata, flags, reason_code, properties):
+    MQTT_DISCONNECTS.inc()
+    logger.warning(f"[MQTT] Desconectado del broker (código {reason_code})")
+
 
 def on_message(client, userdata, msg):
-    topic = msg.topic
-    raw_payload = msg.payload.decode("utf-8")
+    """
+    Callback de paho: resuelve la ruta (trie) y encola.
+    El parseo del JSON y el handler corren en el dispatcher.
+    """
+    route = router.resolve(msg.topic)
 
-    # Parse seguro del JSON
-    try:
-        payload = json.loads(raw_payload) if raw_payload.strip() else {}
-    except json.JSONDecodeError:
-        logger.warning(f"[MQTT] Payload no JSON en {topic}: {raw_payload}")
+    if route is None:
+        MESSAGES.inc(route="unrouted")
+        log_unrouted(router, msg.topic)
         return
 
-    handler = resolve_handler(topic)
+    MESSAGES.inc(route=route.pattern)
+
+    priority, coalesce_key = priority_for(route)
+    dispatcher.submit(
+        shard_key(route), process_message, client, route, msg.payload,
+        priority=priority, coalesce_key=coalesce_key
+    )
+
+
+def process_message(client, route, raw_bytes):
+    topic = route.topic
 
-    if handler is None:
-        logger.debug(f"[MQTT] No hay handler para {topic}")
+    # Parse seguro del JSON: directamente al mensaje tipado de la ruta
+    # (msgspec, una pasada) o a dict con el codec configurable
+    try:
+        if route.message is not None:
+            payload = decode_as(raw_bytes, route.message)
+        else:
+            payload = decode(raw_bytes)
+    except DecodeError:
+        logger.warning(f"[MQTT] Payload no JSON en {topic}: {raw_bytes[:200]!r}")
+        return
+    except MessageError as e:
+        logger.warning(f"[MQTT] Payload inválido en {topic}: {e}")
         return
 
     try:
-        handler(db, client, topic, payload)
+        # Una conexión del pool por mensaje/worker
+        with db.connection(), HANDLER_SECONDS.time(route=route.pattern):
+            route.handler(db, client, route, payload)
     except Exception as e:
         logger.error(f"[MQTT] Error ejecutando handler de {topic}: {e}")
 
 
+def _run_summary(client, summary):
+    """Resumen de alertas suprimidas con su propia conexión reservada."""
+    with db.connection():
+        publish_summary(db, client, summary)
+
+
+def register_metrics():
+    """Métricas leídas en cada scrape de los contadores que ya llevan los módulos."""
+    metrics.collect(
+        "mqtt_router_dispatch_queue_depth", "Mensajes pendientes por worker",
+        lambda: {(str(idx),): depth for idx, depth in enumerate(dispatcher.queue_depths())},
+        ("worker",)
+    )
+    metrics.collect(
+        "mqtt_router_dispatch_total", "Mensajes del dispatcher por resultado",
+        lambda: _dispatch_totals(dispatcher.stats()),
+        ("result", "priority"), kind="counter"
+    )
+    metrics.collect(
+        "mqtt_router_outbound_queue_depth", "Publicaciones hacia ESP32 en cola por dispositivo",
+        lambda: {(device,): depth for device, depth in outbound.queue_depths().items()},
+        ("device",)
+    )
+    metrics.collect(
+        "mqtt_router_inflight_pending", "Peticiones GET/SET en vuelo", inflight.pending
+    )
+    metrics.collect(
+        "mqtt_router_alerts_total", "Alertas por decisión de la supresión de tormentas",
+        lambda: {
+            (decision,): value for decision, value in alert_suppressor.stats().items()
+            if decision != "tracked"
+        },
+        ("decision",), kind="counter"
+    )
+    metrics.collect(
+        "mqtt_router_writer_pending", "Elementos pendientes de volcar por escritor en lote",
+        lambda: {
+            ("telemetry",): telemetry_buffer.pending(),
+            ("readings",): reading_writer.pending(),
+            ("system_logs",): log_writer.pending(),
+        },
+        ("writer",)
+    )
+
+
+def _dispatch_totals(stats):
+    totals = {
+        ("processed", ""): stats["processed"],
+        ("dropped", ""): stats["dropped"],
+        ("coalesced", "low"): stats["coalesced"],
+    }
+    for priority, count in stats["shed"].items():
+        totals[("shed", priority)] = count
+    return totals
+
+
 def start_router():
     client = mqtt.Client(
         callback_api_version=mqtt.CallbackAPIVersion.VERSION2
@@ -99,7 +234,9 @@ def start_router():
     )
 
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
     client.on_message = on_message
+    instrument_publish(client)
 
     client.connect(
         MQTT_CFG["host"],
@@ -107,15 +244,55 @@ def start_router():
         keepalive=60
     )
 
+    def _shutdown(signum, frame):
+        logger.info(f"[MQTT] Señal {signum} recibida. Deteniendo router...")
+        client.disconnect()
+
+    signal.signal(signal.SIGTERM, _shutdown)
+    signal.signal(signal.SIGINT, _shutdown)
+
+    register_metrics()
+    metrics_server.start()
+    db.start_maintenance()
+    run_migrations(db)
+    registry.warm(db)
+    state_store.warm(db)
+    telemetry_buffer.start(db)
+    last_seen_tracker.start(db)
+    reading_writer.start(db)
+    history_rollup.start(db)
+    log_writer.start(db)
+    retention_job.start(db)
+    inflight.start(client)
+    alert_suppressor.start(lambda summary: _run_summary(client, summary))
+    outbound.start()
+    dispatcher.start()
+
     logger.info("[MQTT] Router iniciado. Esperando mensajes...")
-    client.loop_forever()
+    try:
+        client.loop_forever()
+    finally:
+        dispatcher.stop()
+        profiler.stop()
+        command_queue.stop()
+        alert_suppressor.stop()
+        outbound.stop()
+        inflight.stop()
+        telemetry_buffer.stop()
+        last_seen_tracker.stop()
+        reading_writer.stop()
+        history_rollup.stop()
+        retention_job.stop()
+        metrics_server.stop()
+        log_writer.stop()
+        db.close()
 
 
 if __name__ == "__main__":
     # Healthcheck para Docker
     if "--healthcheck" in sys.argv:
         test_db = DBManager()
-        if test_db.conn and test_db.conn.is_connected():
+        if test_db.ping():
             logger.info("[HEALTHCHECK] OK")
             sys.exit(0)
 